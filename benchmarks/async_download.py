@@ -0,0 +1,149 @@
+"""
+Benchmark per-worker download throughput of the sync and async paths.
+
+Starts one gunicorn sync worker (the WSGI path) and one uvicorn worker
+(the ASGI path with the async views) against a fake S3 that answers
+after ``--s3-latency`` seconds, then downloads distinct icons from
+``--concurrency`` clients so every request misses the SVG cache::
+
+    python benchmarks/async_download.py --requests 400 --concurrency 32 --s3-latency 0.03
+"""
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.download import SVG, percentile  # noqa: E402
+from benchmarks.fake_s3 import FakeS3Server  # noqa: E402
+
+BUCKET = 'bench-icons'
+
+SERVERS = {
+    'sync': lambda port: [
+        'gunicorn', 'iconhub.wsgi:application', '--workers', '1', '--worker-class', 'sync',
+        '--bind', f'127.0.0.1:{port}',
+    ],
+    'async': lambda port: [
+        'uvicorn', 'iconhub.asgi:application', '--workers', '1', '--no-access-log', '--log-level', 'warning',
+        '--host', '127.0.0.1', '--port', str(port),
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def start_server(kind, port, env):
+    process = subprocess.Popen(SERVERS[kind](port), cwd=ROOT, env=env, stderr=subprocess.DEVNULL)
+    wait_for(port)
+    return process
+
+
+def load(port, paths, concurrency):
+    """
+    Fetch every path once from ``concurrency`` keep-alive connections and
+    return ``(elapsed seconds, latencies, errors)``
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = iter(paths)
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        while True:
+            with lock:
+                path = next(remaining, None)
+            if path is None:
+                break
+            started = time.perf_counter()
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                if response.status != 200:
+                    errors.append(response.status)
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--s3-latency', type=float, default=0.03)
+    args = parser.parse_args()
+
+    with FakeS3Server(latency=args.s3_latency) as s3:
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE='iconhub.settings',
+            AWS_S3_ENDPOINT_URL=s3.endpoint_url,
+            AWS_STORAGE_BUCKET_NAME=BUCKET,
+            AWS_ACCESS_KEY_ID='bench',
+            AWS_SECRET_ACCESS_KEY='bench',
+            ICON_METRICS='0',
+        )
+        print(
+            f"{args.requests} requests, concurrency {args.concurrency}, "
+            f"S3 latency {args.s3_latency * 1000:.0f} ms, one worker each"
+        )
+        for kind in SERVERS:
+            # Fresh keys per run, so both servers start with a cold SVG cache
+            keys = [f'icons/bench/{kind}-{i}.svg' for i in range(args.requests)]
+            for key in keys:
+                s3.store.put(BUCKET, key, SVG)
+            paths = [
+                '/download/?' + urlencode({'url': f'https://{BUCKET}.s3.amazonaws.com/{key}', 'name': 'icon'})
+                for key in keys
+            ]
+
+            port = free_port()
+            process = start_server(kind, port, env)
+            try:
+                elapsed, latencies, errors = load(port, paths, args.concurrency)
+            finally:
+                process.terminate()
+                process.wait()
+            print(
+                f"{kind:<6} {len(latencies) / elapsed:8.0f} req/s  "
+                f"p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+                f"p95 {percentile(latencies, 95) * 1000:7.1f} ms  "
+                f"errors {len(errors)}"
+            )
+
+
+if __name__ == '__main__':
+    main()
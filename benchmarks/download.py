@@ -0,0 +1,112 @@
+"""
+Benchmark ``download_icon`` against a local fake S3.
+
+Compares the pooled, streaming download path with the previous approach
+of building a boto3 client per request and buffering the body, and with
+the SVG cache in front of it::
+
+    python benchmarks/download.py --requests 2000 --concurrency 16
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.fake_s3 import FakeS3Server  # noqa: E402
+
+BUCKET = 'bench-icons'
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24"><path d="M12 2L2 22h20z"/></svg>'
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def consume(response):
+    if response.streaming:
+        b''.join(response.streaming_content)
+    else:
+        response.content
+    response.close()
+
+
+def run(label, fn, keys, requests, concurrency):
+    def timed(i):
+        start = time.perf_counter()
+        fn(keys[i % len(keys)])
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<10} {requests / elapsed:8.0f} req/s  "
+        f"p50 {statistics.median(latencies) * 1000:6.2f} ms  "
+        f"p95 {percentile(latencies, 95) * 1000:6.2f} ms  "
+        f"p99 {percentile(latencies, 99) * 1000:6.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--objects', type=int, default=100)
+    args = parser.parse_args()
+
+    with FakeS3Server() as s3:
+        os.environ.update({
+            'DJANGO_SETTINGS_MODULE': 'iconhub.settings',
+            'AWS_S3_ENDPOINT_URL': s3.endpoint_url,
+            'AWS_STORAGE_BUCKET_NAME': BUCKET,
+            'AWS_ACCESS_KEY_ID': 'bench',
+            'AWS_SECRET_ACCESS_KEY': 'bench',
+        })
+        import boto3
+        import django
+        django.setup()
+        from django.conf import settings
+        from django.test import RequestFactory
+        from icons.views import download_icon
+
+        keys = [f'icons/bench/icon-{i}.svg' for i in range(args.objects)]
+        for key in keys:
+            s3.store.put(BUCKET, key, SVG)
+
+        factory = RequestFactory()
+
+        def pooled(key):
+            request = factory.get('/download/', {'url': f'https://{BUCKET}.s3.amazonaws.com/{key}', 'name': 'icon'})
+            response = download_icon(request)
+            assert response.status_code == 200, response.status_code
+            consume(response)
+
+        def per_request_client(key):
+            client = boto3.client(
+                's3',
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region_name=settings.AWS_S3_REGION_NAME,
+                endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+            )
+            client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+        print(f"{args.requests} requests, concurrency {args.concurrency}, {len(SVG)} byte objects")
+        run('per-client', per_request_client, keys, args.requests, args.concurrency)
+        # Objects above MAX_ITEM_BYTES skip the SVG cache and go to S3
+        cache_options = settings.ICON_SVG_CACHE
+        settings.ICON_SVG_CACHE = dict(cache_options, MAX_ITEM_BYTES=-1)
+        run('pooled', pooled, keys, args.requests, args.concurrency)
+        settings.ICON_SVG_CACHE = cache_options
+        run('cached', pooled, keys, args.requests, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+A minimal in-process S3 stand-in for benchmarks.
+
+Implements just enough of the S3 REST API (path-style GET/HEAD/PUT/DELETE
+object, ListObjectsV2, DeleteObjects and multipart uploads) for boto3 to
+talk to it through ``AWS_S3_ENDPOINT_URL``. Objects live in a dict, so it measures our code
+and the HTTP stack rather than network latency to AWS.
+"""
+import hashlib
+import re
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape, unescape
+
+
+class FakeS3Store:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def put(self, bucket, key, body, content_type='image/svg+xml'):
+        with self.lock:
+            self.objects[(bucket, key)] = {
+                'body': body,
+                'etag': '"%s"' % hashlib.md5(body).hexdigest(),
+                'last_modified': formatdate(usegmt=True),
+                'content_type': content_type,
+            }
+
+    def get(self, bucket, key):
+        with self.lock:
+            return self.objects.get((bucket, key))
+
+    def delete(self, bucket, key):
+        with self.lock:
+            self.objects.pop((bucket, key), None)
+
+    def keys(self, bucket, prefix=''):
+        with self.lock:
+            return sorted(k for b, k in self.objects if b == bucket and k.startswith(prefix))
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store = None
+    latency = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _split(self):
+        parts = urlsplit(self.path)
+        bucket, _, key = parts.path.lstrip('/').partition('/')
+        return bucket, unquote(key), parse_qs(parts.query, keep_blank_values=True)
+
+    def _send(self, status, body=b'', headers=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _not_found(self, key):
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code>'
+            '<Message>The specified key does not exist.</Message><Key>%s</Key></Error>' % escape(key)
+        ).encode()
+        self._send(404, body, {'Content-Type': 'application/xml'})
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('x-amz-decoded-content-length') is not None:
+            body = self._decode_aws_chunked(body)
+        return body
+
+    @staticmethod
+    def _decode_aws_chunked(body):
+        # <hex size>[;chunk-signature=...]\r\n<data>\r\n ... 0\r\n<trailers>
+        decoded, position = bytearray(), 0
+        while True:
+            end = body.index(b'\r\n', position)
+            size = int(body[position:end].split(b';')[0], 16)
+            if size == 0:
+                return bytes(decoded)
+            decoded += body[end + 2:end + 2 + size]
+            position = end + 2 + size + 2
+
+    def do_GET(self):
+        bucket, key, query = self._split()
+        if not key:
+            return self._list(bucket, query)
+        obj = self.store.get(bucket, key)
+        if obj is None:
+            return self._not_found(key)
+        if self.headers.get('If-None-Match') == obj['etag']:
+            return self._send(304, b'', {'ETag': obj['etag']})
+        self._send(200, obj['body'], {
+            'Content-Type': obj['content_type'],
+            'ETag': obj['etag'],
+            'Last-Modified': obj['last_modified'],
+        })
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        bucket, key, query = self._split()
+        body = self._read_body()
+        if 'uploadId' in query:
+            upload = self.store.uploads[query['uploadId'][0]]
+            upload['parts'][int(query['partNumber'][0])] = body
+            return self._send(200, b'', {'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+        self.store.put(bucket, key, body, self.headers.get('Content-Type', 'binary/octet-stream'))
+        self._send(200, b'', {'ETag': self.store.get(bucket, key)['etag']})
+
+    def do_POST(self):
+        bucket, key, query = self._split()
+        body = self._read_body()
+        if 'delete' in query:
+            keys = [unescape(k) for k in re.findall(r'<Key>(.*?)</Key>', body.decode())]
+            for k in keys:
+                self.store.delete(bucket, k)
+            return self._xml('<DeleteResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"></DeleteResult>')
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.store.uploads[upload_id] = {
+                'parts': {}, 'content_type': self.headers.get('Content-Type', 'binary/octet-stream'),
+            }
+            return self._xml(
+                '<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                '</InitiateMultipartUploadResult>' % (escape(bucket), escape(key), upload_id)
+            )
+        if 'uploadId' in query:
+            upload = self.store.uploads.pop(query['uploadId'][0])
+            parts = upload['parts']
+            self.store.put(bucket, key, b''.join(parts[n] for n in sorted(parts)), upload['content_type'])
+            return self._xml(
+                '<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag>'
+                '</CompleteMultipartUploadResult>' % (escape(bucket), escape(key), self.store.get(bucket, key)['etag'])
+            )
+        self._send(400)
+
+    def _xml(self, document):
+        self._send(200, ('<?xml version="1.0" encoding="UTF-8"?>' + document).encode(), {'Content-Type': 'application/xml'})
+
+    def do_DELETE(self):
+        bucket, key, _ = self._split()
+        self.store.delete(bucket, key)
+        self._send(204)
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        start_after = query.get('continuation-token', query.get('start-after', ['']))[0]
+        keys = [k for k in self.store.keys(bucket, prefix) if k > start_after]
+        page, rest = keys[:max_keys], keys[max_keys:]
+        contents = []
+        for key in page:
+            obj = self.store.get(bucket, key)
+            if obj is None:
+                continue
+            contents.append(
+                '<Contents><Key>%s</Key><LastModified>2024-01-01T00:00:00.000Z</LastModified>'
+                '<ETag>%s</ETag><Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>'
+                % (escape(key), escape(obj['etag']), len(obj['body']))
+            )
+        truncated = 'true' if rest else 'false'
+        token = '<NextContinuationToken>%s</NextContinuationToken>' % escape(page[-1]) if rest else ''
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            '<Name>%s</Name><Prefix>%s</Prefix><KeyCount>%d</KeyCount><MaxKeys>%d</MaxKeys>'
+            '<IsTruncated>%s</IsTruncated>%s%s</ListBucketResult>'
+            % (escape(bucket), escape(prefix), len(contents), max_keys, truncated, token, ''.join(contents))
+        ).encode()
+        self._send(200, body, {'Content-Type': 'application/xml'})
+
+
+class FakeS3Server:
+    """
+    Run a fake S3 endpoint on a background thread::
+
+        with FakeS3Server() as s3:
+            s3.store.put('bucket', 'icons/a/b.svg', b'<svg/>')
+            os.environ['AWS_S3_ENDPOINT_URL'] = s3.endpoint_url
+
+    ``latency`` adds a delay in seconds to every response, to stand in for
+    the round trip to a real S3 region.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.store = FakeS3Store()
+        handler = type('Handler', (FakeS3Handler,), {'store': self.store, 'latency': latency})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def endpoint_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
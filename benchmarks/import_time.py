@@ -0,0 +1,74 @@
+"""
+Worker startup import cost, measured by ``manage.py check_import_time``.
+
+Runs what a gunicorn worker imports before its first request (the WSGI
+application and the URLconf) in a fresh interpreter under
+``python -X importtime`` and parses the per-module timings it prints to
+stderr. Timings are microseconds, as Python reports them.
+"""
+import subprocess
+import sys
+
+STARTUP_CODE = (
+    "import iconhub.wsgi\n"
+    "from django.urls import get_resolver\n"
+    "get_resolver().url_patterns\n"
+)
+
+
+def parse_importtime(output):
+    """
+    Return ``(module, self_us, cumulative_us, depth)`` for every line of
+    ``-X importtime`` output; depth 0 are the imports the code made itself
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        if not self_us.strip().isdigit():
+            continue  # the column header
+        stripped = name.lstrip()
+        depth = (len(name) - len(stripped) - 1) // 2
+        modules.append((stripped.rstrip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def measure_once(code=STARTUP_CODE, cwd=None):
+    # The child inherits DJANGO_SETTINGS_MODULE and the rest of the environment
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, cwd=cwd)
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup code failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def measure(runs=3, code=STARTUP_CODE, cwd=None):
+    """
+    Return the fastest of ``runs`` measurements as a dict: total
+    milliseconds, ``{module: cumulative ms}`` of the top-level imports,
+    and the set of every module imported. The first run also writes any
+    missing .pyc files, so taking the fastest leaves compilation out.
+    """
+    best = None
+    for _ in range(runs):
+        modules = measure_once(code, cwd)
+        total = sum(cumulative for _, _, cumulative, depth in modules if depth == 0)
+        if best is None or total < best[0]:
+            best = (total, modules)
+    total, modules = best
+    return {
+        'total_ms': total / 1000,
+        'top_level': {name: cumulative / 1000 for name, _, cumulative, depth in modules if depth == 0},
+        'slowest': sorted(((name, self_us / 1000) for name, self_us, _, _ in modules), key=lambda m: -m[1]),
+        'modules': {name for name, _, _, _ in modules},
+    }
+
+
+def loaded_lazy_modules(modules, lazy_modules):
+    """
+    The packages of ``lazy_modules`` that were imported anyway
+    """
+    return sorted(
+        lazy for lazy in lazy_modules
+        if any(name == lazy or name.startswith(lazy + '.') for name in modules)
+    )
@@ -0,0 +1,224 @@
+"""
+End-to-end benchmark suite, driven by ``manage.py benchmark``.
+
+For every catalogue size it fills a fake S3 bucket with synthetic icons,
+loads them with ``load_icons_from_s3`` (which is measured too), then hits
+the views with concurrent in-process clients and records latency
+percentiles, throughput and database queries per request. Results are
+plain dicts so they can be written to JSON and compared across commits.
+"""
+import io
+import random
+import statistics
+import threading
+import time
+
+from benchmarks.download import percentile
+
+WORDS = [
+    'arrow', 'bell', 'circle', 'cloud', 'file', 'heart', 'home', 'lock',
+    'search', 'star', 'sun', 'user', 'mail', 'camera', 'chart', 'gear',
+]
+SEARCH_TERM = 'arrow'
+
+# Scenarios are compared on these, with the direction that is worse
+METRICS = {
+    'p50_ms': 'higher',
+    'p95_ms': 'higher',
+    'throughput': 'lower',
+    'queries': 'higher',
+}
+
+
+def synthetic_svg(i):
+    x, y = i % 20 + 2, (i // 20) % 20 + 2
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" fill="none" stroke="currentColor">'
+        f'<path d="M{x} 2L2 {y}h20z"/><circle cx="{y}" cy="{x}" r="{i % 5 + 1}"/></svg>'
+    ).encode()
+
+
+def synthetic_keys(size, categories, prefix='icons/'):
+    """
+    Deterministic S3 keys for a catalogue of ``size`` icons spread evenly
+    over ``categories`` categories
+    """
+    for i in range(size):
+        name = f"{WORDS[i % len(WORDS)]}-{WORDS[(i // len(WORDS)) % len(WORDS)]}-{i}"
+        yield i, f"{prefix}category-{i % categories:02d}/{name}.svg"
+
+
+def seed_bucket(store, bucket, size, categories):
+    for i, key in synthetic_keys(size, categories):
+        store.put(bucket, key, synthetic_svg(i))
+
+
+def reset_catalogue():
+    """
+    Empty the (throwaway) benchmark database and every cache that holds
+    catalogue data
+    """
+    from django.core.cache import caches
+    from django.core.management import call_command
+    from icons.svg_cache import get_svg_cache
+
+    call_command('flush', interactive=False, verbosity=0)
+    for cache in caches.all():
+        cache.clear()
+    get_svg_cache().local.clear()
+
+
+def measure_import(bucket):
+    """
+    Time a cold ``load_icons_from_s3`` run into an empty catalogue
+    """
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    started = time.perf_counter()
+    with CaptureQueriesContext(connection) as queries:
+        call_command('load_icons_from_s3', bucket=bucket, no_sprites=True, stdout=io.StringIO())
+    elapsed = time.perf_counter() - started
+
+    from icons.models import Icon
+    loaded = Icon.objects.count()
+    return {
+        'icons': loaded,
+        'seconds': round(elapsed, 3),
+        'throughput': round(loaded / elapsed, 1) if elapsed else 0,
+        'queries': len(queries),
+    }
+
+
+def run_scenario(paths, requests, concurrency, warmup=10):
+    """
+    Issue ``requests`` GETs, cycling through ``paths``, from ``concurrency``
+    threads with one test client each
+    """
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    samples = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        client = Client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(paths[i % len(paths)])
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            latency = time.perf_counter() - started
+            response.close()
+            with lock:
+                samples.append((latency, len(queries)))
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+    warm = Client()
+    for path in paths[:warmup]:
+        warm.get(path).close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in samples]
+    return {
+        'requests': len(samples),
+        'errors': len(errors),
+        'throughput': round(len(samples) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p90_ms': round(percentile(latencies, 90) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries': round(statistics.mean(queries for _, queries in samples), 2),
+    }
+
+
+def scenario_paths(seed=0):
+    """
+    Request paths for every view scenario, in a reproducible order
+    """
+    from django.urls import reverse
+    from urllib.parse import urlencode
+    from icons.models import Icon, IconCategory
+
+    rng = random.Random(seed)
+    slugs = list(IconCategory.objects.values_list('slug', flat=True))
+    icons = list(Icon.objects.values_list('name', 's3_url'))
+    rng.shuffle(slugs)
+    sample = rng.sample(icons, min(len(icons), 1000))
+    return {
+        'home': [reverse('home')],
+        'home_search': [f"{reverse('home')}?{urlencode({'q': SEARCH_TERM})}"],
+        'category_icons': [reverse('category_icons', args=[slug]) for slug in slugs],
+        'download_icon': [
+            f"{reverse('download_icon')}?{urlencode({'url': url, 'name': name})}" for name, url in sample
+        ],
+    }
+
+
+def run_suite(store, bucket, sizes, categories, requests, concurrency, log=print):
+    """
+    Run every scenario for every catalogue size and return the results
+    keyed by size, then scenario
+    """
+    results = {}
+    for size in sizes:
+        log(f"Seeding {size} icons in {categories} categories")
+        store.objects.clear()
+        seed_bucket(store, bucket, size, categories)
+        reset_catalogue()
+
+        size_results = {'load_icons_from_s3': measure_import(bucket)}
+        log(f"  load_icons_from_s3: {size_results['load_icons_from_s3']}")
+        for name, paths in scenario_paths().items():
+            size_results[name] = run_scenario(paths, requests, concurrency)
+            log(f"  {name}: {size_results[name]}")
+        results[str(size)] = size_results
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return a description of every metric that got worse than the baseline
+    by more than ``threshold`` (a fraction, e.g. 0.2 for 20%). Query counts
+    do not depend on the machine, so they are held to within half a query
+    per request instead.
+    """
+    regressions = []
+    for size, scenarios in results.items():
+        for scenario, current in scenarios.items():
+            previous = baseline.get(size, {}).get(scenario)
+            if not previous:
+                continue
+            for metric, worse in METRICS.items():
+                if metric not in current or not previous.get(metric):
+                    continue
+                change = (current[metric] - previous[metric]) / previous[metric]
+                if worse == 'lower':
+                    change = -change
+                if metric == 'queries':
+                    regressed = current[metric] - previous[metric] > 0.5
+                else:
+                    regressed = change > threshold
+                if regressed:
+                    regressions.append(
+                        f"{size} icons, {scenario}: {metric} {previous[metric]} -> {current[metric]} "
+                        f"({change:+.0%} worse)"
+                    )
+    return regressions
@@ -0,0 +1,25 @@
+"""
+gunicorn settings, picked up from the working directory by
+``gunicorn iconhub.wsgi:application``.
+
+Every worker warms its caches (see icons/warmup.py) once the application
+is loaded and before it accepts connections, so the first requests it
+serves are as fast as the rest. ICON_WARM_ON_BOOT=0 turns this off.
+"""
+
+
+def post_worker_init(worker):
+    # Runs in the worker after the WSGI application, and with it Django, is
+    # loaded; post_fork would be too early for that without preload_app
+    from django.conf import settings
+
+    if not settings.ICON_STARTUP['WARM_ON_BOOT']:
+        return
+    from icons.warmup import warm_caches
+
+    # Warming can outlast the worker timeout, so keep the heartbeat going
+    results = warm_caches(progress=worker.notify)
+    worker.log.info(
+        "Worker %s warmed up: %s", worker.pid,
+        ', '.join(f"{step} {'failed' if count is None else count} ({elapsed:.2f}s)" for step, (count, elapsed) in results.items()),
+    )
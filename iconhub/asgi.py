@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iconhub.settings')
+# Serve S3-bound views with the async implementations in icons/async_views.py
+os.environ.setdefault('ICON_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
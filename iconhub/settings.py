@@ -12,14 +12,16 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Load environment variables from the .env file next to manage.py. Deployments
+# set them directly, so python-dotenv is only imported when there is one.
+if (BASE_DIR / '.env').exists():
+    from dotenv import load_dotenv
+    load_dotenv(BASE_DIR / '.env')
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
@@ -47,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'icons.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -145,6 +148,189 @@ AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME')
 AWS_S3_REGION_NAME = os.environ.get('AWS_S3_REGION_NAME', 'south-ap-1')
 AWS_S3_CUSTOM_DOMAIN = f"{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com"
+AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL')  # e.g. a local MinIO for benchmarks
+
+# Shared S3 client connection pool (see icons/s3.py)
+AWS_S3_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_S3_MAX_POOL_CONNECTIONS', 50))
+AWS_S3_CONNECT_TIMEOUT = 5
+AWS_S3_READ_TIMEOUT = 30
+ICON_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# How download_icon delivers bytes (see icons/delivery.py): 'proxy' streams them,
+# 'redirect' sends a 302 to the public URL, 'presigned' to a signed S3 URL
+ICON_DELIVERY = {
+    'MODE': os.environ.get('ICON_DELIVERY_MODE', 'proxy'),
+    'PUBLIC_BASE_URL': os.environ.get('ICON_PUBLIC_BASE_URL'),  # defaults to https://AWS_S3_CUSTOM_DOMAIN
+    # Keys without a public URL; 'redirect' falls back to PRIVATE_MODE for them
+    'PRIVATE_PREFIXES': [p for p in os.environ.get('ICON_PRIVATE_PREFIXES', '').split(',') if p],
+    'PRIVATE_MODE': 'presigned',
+    'PRESIGN_EXPIRES': 15 * 60,
+    'PRESIGN_MARGIN': 60,  # stop handing out a memoized URL this long before it expires
+    'PRESIGN_CACHE_SIZE': 10000,
+}
+
+# Hosts icon URLs are served from (see icons/cdn.py); each icon is pinned to one
+# of them by a hash of its key. Empty uses ICON_DELIVERY['PUBLIC_BASE_URL'], else
+# the custom domain. Over HTTP/2 one host is usually fastest; sharding only pays
+# off for clients stuck on HTTP/1.1 connection limits.
+ICON_CDN = {
+    'HOSTS': [h for h in os.environ.get('ICON_CDN_HOSTS', '').split(',') if h],  # e.g. https://i1.example.com
+}
+
+# S3 uploads and deletes queued by icon writes (see icons/outbox.py), applied by
+# manage.py process_s3_outbox or, with INLINE, by the web process itself;
+# SPOOL_DIR must be shared with the worker
+ICON_OUTBOX = {
+    'SPOOL_DIR': os.environ.get('ICON_OUTBOX_SPOOL_DIR', os.path.join(BASE_DIR, 'outbox')),
+    'BATCH_SIZE': 500,
+    'UPLOAD_WORKERS': 8,
+    'MULTIPART_THRESHOLD': 8 * 1024 * 1024,
+    'MULTIPART_CHUNKSIZE': 8 * 1024 * 1024,
+    'MULTIPART_CONCURRENCY': 4,  # parts in flight per multipart upload
+    'MAX_ATTEMPTS': 10,
+    'BACKOFF_BASE': 2,  # seconds before the first retry, doubling after that
+    'BACKOFF_MAX': 15 * 60,
+    'LEASE': 5 * 60,  # how long a claimed entry stays with one worker
+    'POLL_INTERVAL': 2,
+    # Apply entries in the web process that queued them, right after its
+    # transaction commits; for deployments without a process_s3_outbox
+    # worker (render.yaml). Harmless alongside one, claims are leased
+    'INLINE': os.environ.get('ICON_OUTBOX_INLINE', '1') != '0',
+}
+
+# Ingest-time SVG optimization and precompressed variants (see icons/ingest.py);
+# brotli variants need the brotli package and are skipped without it
+ICON_INGEST = {
+    'ENABLED': os.environ.get('ICON_INGEST', '1') == '1',
+    'PRECISION': 3,  # decimal places kept in coordinates
+    'MAX_BYTES': 1024 * 1024,  # larger files are stored as they are
+    'ENCODINGS': ['br', 'gzip'],
+    'GZIP_LEVEL': 9,
+    'BROTLI_QUALITY': 11,
+    'WORKERS': 8,  # objects optimized in parallel by load_icons_from_s3
+}
+
+# Content-addressed icon storage (see icons/blobs.py)
+ICON_BLOBS = {
+    'PREFIX': 'blobs/sha256/',
+    'MIGRATE_WORKERS': 8,  # parallel S3 transfers in migrate_icons_to_blobs
+}
+
+# Tiered cache for SVG payloads served by download_icon (see icons/svg_cache.py)
+ICON_SVG_CACHE = {
+    'MAX_BYTES': 32 * 1024 * 1024,  # in-process LRU budget per worker
+    'MAX_ITEM_BYTES': 256 * 1024,  # larger objects are streamed, not cached
+    'SHARED_CACHE': os.environ.get('ICON_SVG_SHARED_CACHE'),  # a CACHES alias, e.g. 'default'
+    'SHARED_TIMEOUT': 7 * 24 * 60 * 60,
+    'DISK_DIR': os.environ.get('ICON_SVG_CACHE_DIR'),
+    'MISS_TTL': 60,  # seconds a missing compressed variant is not asked for again
+    # Without a shared tier, seconds local and disk entries are served before
+    # S3 is asked whether their ETag still matches; 0 serves them until evicted
+    'REVALIDATE_SECONDS': 60,
+}
+
+# Server-side icon rendering (see icons/render.py); PNG/WebP need cairosvg + libcairo
+ICON_RENDER = {
+    'CACHE': 'default',  # CACHES alias holding rendered variants
+    'TIMEOUT': 30 * 24 * 60 * 60,
+    'MAX_CONCURRENCY': int(os.environ.get('ICON_RENDER_CONCURRENCY', 2)),  # renders per worker
+    'ACQUIRE_TIMEOUT': 5,  # seconds to wait for a render slot before answering 503
+    'MAX_SIZE': 1024,
+    'DEFAULT_RASTER_SIZE': 64,
+}
+
+# Streaming ZIP bundles served by /download/bundle/ (see icons/bundle.py)
+ICON_BUNDLE = {
+    'WORKERS': 8,  # concurrent S3 fetches per bundle
+    'MAX_ICONS': 5000,
+}
+
+# Async download and bundle views (see icons/async_views.py); iconhub/asgi.py
+# turns them on, e.g. uvicorn iconhub.asgi:application --workers 4
+ICON_ASYNC_VIEWS = os.environ.get('ICON_ASYNC_VIEWS') == '1'
+ICON_ASYNC = {
+    'REQUEST_TIMEOUT': float(os.environ.get('ICON_ASYNC_REQUEST_TIMEOUT', 10)),  # S3 call, or fetching one bundle member
+    'STREAM_TIMEOUT': float(os.environ.get('ICON_ASYNC_STREAM_TIMEOUT', 30)),  # each chunk of a streamed body
+}
+
+# Cursor-paginated JSON catalogue API (/api/icons/)
+ICON_API_PAGE_SIZE = 120
+ICON_API_MAX_PAGE_SIZE = 500
+
+# Read-only catalogue snapshot every worker maps (see icons/snapshot.py); PATH
+# must be on a filesystem all workers of a host share
+ICON_SNAPSHOT = {
+    'ENABLED': os.environ.get('ICON_SNAPSHOT', '1') != '0',
+    'PATH': os.environ.get('ICON_SNAPSHOT_PATH', os.path.join(BASE_DIR, 'snapshot', 'catalogue.snap')),
+    'LOCK_TIMEOUT': 60,  # seconds before a regeneration lock left by a dead worker is broken
+}
+
+# In-process prefix index behind /autocomplete/ (see icons/autocomplete.py)
+ICON_AUTOCOMPLETE = {
+    'LIMIT': 10,
+    'MAX_LIMIT': 50,
+    'PREFIX_CACHE_DEPTH': 2,  # prefixes up to this long get their top results precomputed
+    'MEMO_SIZE': 20000,  # answers memoized per index
+    'VERSION_CHECK_INTERVAL': 2,  # seconds between catalogue version checks per worker
+    'MAX_AGE': 10 * 60,  # rebuild at least this often to pick up new download counts
+    'DOWNLOAD_FLUSH_INTERVAL': 30,  # seconds download counts are buffered per worker
+    'DOWNLOAD_MAX_IDS': 10000,  # distinct icons buffered before a flush is due
+}
+
+# Pre-rendered category grids and sidebars (see icons/fragments.py); bypassed when DEBUG is on
+ICON_FRAGMENT_CACHE = {
+    'CACHE': 'default',  # CACHES alias holding the rendered HTML
+    'TIMEOUT': 7 * 24 * 60 * 60,  # keys carry versions, so this only bounds storage
+    'ENABLED': os.environ.get('ICON_FRAGMENT_CACHE', '1') != '0',
+}
+
+# Static copies of the home page, category pages and /catalogue.json that nginx
+# serves from disk (see icons/prerender.py and nginx.conf); refreshed by
+# manage.py prerender_catalogue, after imports and after admin edits. Unset
+# disables the automatic refreshes.
+ICON_PRERENDER = {
+    'OUTPUT_DIR': os.environ.get('ICON_PRERENDER_DIR'),
+    'GZIP_LEVEL': 9,  # for the .gz siblings nginx's gzip_static serves
+}
+
+# Worker startup (see icons/warmup.py and gunicorn.conf.py): each gunicorn worker
+# warms its caches before serving, and manage.py check_import_time fails when
+# importing the app takes longer than IMPORT_BUDGET_MS or pulls in a LAZY_MODULES
+# package that should only load on first use
+ICON_STARTUP = {
+    'WARM_ON_BOOT': os.environ.get('ICON_WARM_ON_BOOT', '1') != '0',
+    'WARM_SVG_ICONS': int(os.environ.get('ICON_WARM_SVG_ICONS', 200)),  # most downloaded first
+    'WARM_SVG_WORKERS': 8,  # concurrent S3 fetches while warming
+    'WARM_PAGES': ['home'],  # URL names rendered to compile templates and fill fragments
+    'IMPORT_BUDGET_MS': int(os.environ.get('ICON_IMPORT_BUDGET_MS', 600)),
+    'LAZY_MODULES': ['boto3', 'botocore', 'aiobotocore', 'requests', 'cairosvg', 'PIL', 'dotenv'],
+}
+
+# Request, database, S3 and cache metrics served at /metrics (see icons/metrics.py)
+ICON_METRICS = {
+    'ENABLED': os.environ.get('ICON_METRICS', '1') != '0',
+    # Remote addresses allowed to scrape /metrics; empty denies everyone.
+    # Behind a proxy this is the proxy's address, so the proxy has to
+    # restrict /metrics itself (see nginx.conf)
+    'ALLOWED_IPS': [ip for ip in os.environ.get('ICON_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip],
+    # Where every worker writes its values for /metrics to sum; must be
+    # shared by all workers of a host. Empty reports per-worker values
+    'DIR': os.environ.get('ICON_METRICS_DIR', os.path.join(BASE_DIR, 'metrics')),
+    'FLUSH_SECONDS': 5,
+    # Dump collapsed stacks of requests slower than this; unset disables the profiler
+    'PROFILE_SLOW_MS': int(os.environ.get('ICON_PROFILE_SLOW_MS', 0)),
+    'PROFILE_INTERVAL_MS': 5,
+    'PROFILE_DIR': os.environ.get('ICON_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles')),
+}
+
+# Cache-Control policies applied by icons.http.cache_policy
+ICON_CACHE_CONTROL = {
+    'svg': os.environ.get('ICON_SVG_CACHE_CONTROL', 'public, max-age=86400'),
+    'page': os.environ.get('ICON_PAGE_CACHE_CONTROL', 'public, max-age=0, must-revalidate'),
+    'sprite': 'public, max-age=31536000, immutable',  # sprite URLs carry their content hash
+    'redirect': 'public, max-age=3600',  # 302s to public icon URLs in ICON_DELIVERY 'redirect' mode
+    'blob': 'public, max-age=31536000, immutable',  # content-addressed blobs never change
+}
 
 # Use Nginx proxy for S3 URLs in development
 if DEBUG:
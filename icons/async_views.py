@@ -0,0 +1,135 @@
+"""
+Async versions of the S3-bound views, routed instead of the sync ones
+when ICON_ASYNC_VIEWS is on (which iconhub/asgi.py does). While a request
+waits on S3 the worker's event loop keeps serving other requests.
+"""
+import asyncio
+import logging
+from urllib.parse import unquote
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .autocomplete import flush_downloads
+from .bundle import aiter_bundle
+from .blobs import is_blob_key
+from .cdn import key_from_url
+from .delivery import delivery_response
+from .http import cache_policy, content_etag, vary_on_encoding
+from .ingest import accepted_encodings
+from .s3_async import afetch_variant, astream_body, get_async_s3_client, svg_cache_call
+from .svg_cache import conditional_get, get_svg_cache, is_not_modified
+from .views import bundle_request, cached_response, counted_download
+
+logger = logging.getLogger(__name__)
+
+
+@cache_policy('svg')
+@vary_on_encoding
+async def download_icon(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    url = unquote(request.GET.get('url', ''))
+    name = unquote(request.GET.get('name', 'icon'))
+
+    logger.debug("Async download request received: url=%s name=%s", url, name)
+
+    if not url:
+        return HttpResponse('No URL provided', status=400)
+    if counted_download(request):
+        await sync_to_async(flush_downloads)()
+
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    key = key_from_url(url)
+    if is_blob_key(key):
+        # Content-addressed, so the URL changes whenever the bytes do
+        request.cache_policy = 'blob'
+    delivered = delivery_response(key, f"{name}.svg")
+    if delivered is not None:
+        return delivered
+
+    for encoding in accepted_encodings(request.headers.get('Accept-Encoding', '')):
+        try:
+            variant = await afetch_variant(key, encoding)
+        except Exception as e:
+            # Fall back to the next encoding, then the uncompressed object
+            logger.error("Error getting %s variant from S3: %s", encoding, e)
+            continue
+        if variant is not None:
+            return cached_response(request, variant, name, encoding)
+
+    svg_cache = get_svg_cache()
+
+    cached = await svg_cache_call(svg_cache.get, key)
+    if cached is not None:
+        return cached_response(request, cached, name)
+
+    s3_client = await get_async_s3_client()
+    stale, conditional = await svg_cache_call(conditional_get, svg_cache, key)
+    try:
+        response = await asyncio.wait_for(
+            s3_client.get_object(Bucket=bucket, Key=key, **conditional), settings.ICON_ASYNC['REQUEST_TIMEOUT'],
+        )
+    except s3_client.exceptions.NoSuchKey:
+        logger.error("File not found in S3: %s", key)
+        return HttpResponse(f'File not found in S3: {key}', status=404)
+    except asyncio.TimeoutError:
+        logger.error("Timed out getting object from S3: %s", key)
+        return HttpResponse('Timed out getting file from S3', status=504)
+    except Exception as e:
+        if stale is not None and is_not_modified(e):
+            await svg_cache_call(svg_cache.revalidated, key, stale)
+            return cached_response(request, stale[:2], name)
+        logger.error("Error getting object from S3: %s", e)
+        return HttpResponse(f'Error getting file from S3: {str(e)}', status=500)
+
+    last_modified = response['LastModified'].timestamp() if response.get('LastModified') else None
+
+    if response['ContentLength'] <= settings.ICON_SVG_CACHE['MAX_ITEM_BYTES']:
+        # Small icons are read whole so they can be cached under a content hash
+        try:
+            async with response['Body'] as body:
+                content = await asyncio.wait_for(body.read(), settings.ICON_ASYNC['REQUEST_TIMEOUT'])
+        except asyncio.TimeoutError:
+            logger.error("Timed out reading object from S3: %s", key)
+            return HttpResponse('Timed out getting file from S3', status=504)
+        etag = content_etag(content)
+        await svg_cache_call(svg_cache.set, key, etag, content, response.get('ETag', ''))
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+        http_response = HttpResponse(content, content_type='image/svg+xml')
+    else:
+        etag = response.get('ETag')
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            response['Body'].close()
+            return not_modified
+        http_response = StreamingHttpResponse(astream_body(response['Body']), content_type='image/svg+xml')
+        http_response['Content-Length'] = response['ContentLength']
+    if etag:
+        http_response['ETag'] = etag
+    if last_modified:
+        http_response['Last-Modified'] = http_date(last_modified)
+
+    # Set the Content-Disposition header to trigger download
+    http_response['Content-Disposition'] = f'attachment; filename="{name}.svg"'
+
+    return http_response
+
+
+async def download_bundle(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    parsed = await sync_to_async(bundle_request)(request)
+    if isinstance(parsed, HttpResponse):
+        return parsed
+    icons, spec, filename = parsed
+    icons = await sync_to_async(list)(icons)
+
+    http_response = StreamingHttpResponse(aiter_bundle(icons, spec), content_type='application/zip')
+    http_response['Content-Disposition'] = f'attachment; filename="{filename}.zip"'
+    return http_response
@@ -0,0 +1,311 @@
+"""
+In-process prefix index for search-as-you-type.
+
+Every term (name words, tag words and category name words) is kept in
+one sorted list per field, so the terms starting with a prefix are the
+slice between two bisects. Each term points at an array of icon ranks,
+where rank 0 is the most downloaded icon; the union of a slice's arrays
+in rank order lists the matches most popular first, and its first
+``limit`` ranks are the answer. One- and two-letter prefixes, whose
+slices span a large part of the catalogue, get their top ranks
+precomputed at build time, and answers are memoized per index.
+
+The index is immutable. It is built on first use and, once the catalogue
+version moves or the download counts it ranked by are old, replaced by a
+rebuild on a background thread while lookups keep using the old one.
+"""
+import logging
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from .cdn import icon_key, public_url
+from .models import Icon, IconCategory
+from .search import PREFIX_SENTINEL, normalize_name, tokenize
+from .snapshot import get_snapshot
+from .versioning import get_version
+
+logger = logging.getLogger(__name__)
+
+MAX_ICON_ID = 2 ** 63 - 1  # Icon.id is a BigAutoField
+
+_rebuilds = ThreadPoolExecutor(max_workers=1, thread_name_prefix='autocomplete')
+_index = None
+_checked_at = 0.0
+_rebuilding = False
+_lock = threading.Lock()
+
+_downloads = Counter()
+_downloads_lock = threading.Lock()
+_flushed_at = time.monotonic()
+
+
+class TermIndex:
+    """
+    Sorted terms of one field and, for each, the ranks of the icons
+    carrying it in ascending order
+    """
+
+    def __init__(self, postings, cache_depth, cache_size):
+        self.terms = sorted(postings)
+        self.ranks = [array('I', postings[term]) for term in self.terms]
+        self.cache_size = cache_size
+        self.top = {}
+        for depth in range(1, cache_depth + 1):
+            for prefix in {term[:depth] for term in self.terms if len(term) >= depth}:
+                self.top[prefix] = self.head(prefix)
+
+    def slice(self, prefix):
+        lo = bisect_left(self.terms, prefix)
+        return self.ranks[lo:bisect_left(self.terms, prefix + PREFIX_SENTINEL, lo)]
+
+    def head(self, prefix):
+        """
+        The ``cache_size`` most popular icons with a term starting with
+        ``prefix``. Each array is sorted, so only their heads can make it.
+        """
+        size = self.cache_size
+        # Slices can span thousands of terms; a set union and sort run in
+        # C and beat merging the arrays one rank at a time
+        return array('I', sorted(set(chain.from_iterable(ranks[:size] for ranks in self.slice(prefix))))[:size])
+
+    def scan(self, prefix):
+        """
+        All icons with a term starting with ``prefix``, most popular first
+        """
+        return sorted(set(chain.from_iterable(self.slice(prefix))))
+
+    def matches(self, tokens, words):
+        """
+        Ranks of the icons with a term in this field starting with the
+        longest token and, in any field, terms starting with the others
+        """
+        if len(tokens) == 1:
+            cached = self.top.get(tokens[0])
+            return cached if cached is not None else self.head(tokens[0])
+        # The longest token usually has the narrowest slice
+        driving = max(range(len(tokens)), key=lambda i: len(tokens[i]))
+        others = tokens[:driving] + tokens[driving + 1:]
+        return (
+            rank for rank in self.scan(tokens[driving])
+            if all(any(word.startswith(token) for word in words[rank]) for token in others)
+        )
+
+
+class AutocompleteIndex:
+    def __init__(self, version):
+        options = settings.ICON_AUTOCOMPLETE
+        self.version = version
+        self.built_at = time.monotonic()
+
+        self.categories = list(IconCategory.objects.order_by('name').values_list('id', 'name', 'slug'))
+        self.category_names = {category_id: name for category_id, name, _ in self.categories}
+        self.category_words = [tuple(tokenize(name)) for _, name, _ in self.categories]
+
+        # What suggestions display is read from the shared catalogue
+        # snapshot when there is a current one, and kept here otherwise
+        self.snapshot = get_snapshot(version)
+        self.rows = array('I')
+        self.ids, self.category_ids = array('I'), array('I')
+        self.names, self.keys, self.words = [], [], []
+        exact, names, tags = defaultdict(list), defaultdict(list), defaultdict(list)
+        for rank, (icon_id, name, icon_tags, category_id, key, row) in enumerate(self.catalogue_rows()):
+            if self.snapshot is not None:
+                self.rows.append(row)
+            else:
+                self.ids.append(icon_id)
+                self.category_ids.append(category_id)
+                self.names.append(name)
+                self.keys.append(key)
+            full_name = sys.intern(normalize_name(name))
+            # Whole names only matter for exact matches; as prefixes they
+            # find nothing their first word does not
+            name_words = {sys.intern(word) for word in tokenize(name)}
+            tag_words = {sys.intern(word) for word in tokenize(f"{icon_tags} {self.category_names.get(category_id, '')}")}
+            exact[full_name].append(rank)
+            for word in name_words:
+                names[word].append(rank)
+            for word in tag_words - name_words:
+                tags[word].append(rank)
+            self.words.append(tuple(name_words | tag_words))
+
+        self.exact = {term: array('I', ranks) for term, ranks in exact.items()}
+        # Name matches may have to be skipped over before tag matches
+        # fill the page, so the cached lists hold two pages
+        cache_size = 2 * options['MAX_LIMIT']
+        self.fields = [
+            TermIndex(names, options['PREFIX_CACHE_DEPTH'], cache_size),
+            TermIndex(tags, options['PREFIX_CACHE_DEPTH'], cache_size),
+        ]
+        # Typing repeats the same prefixes over and over, and the index
+        # never changes, so answers are memoized until it is replaced
+        self.match = lru_cache(maxsize=options['MEMO_SIZE'])(self._match)
+
+    def catalogue_rows(self):
+        """
+        Yield ``(id, name, tags, category id, key, snapshot row)`` per icon,
+        most downloaded first; key is None when read from the snapshot and
+        the row None when not
+        """
+        icons = Icon.objects.order_by('-downloads', 'name', 'id')
+        snapshot = self.snapshot
+        if snapshot is None:
+            rows = icons.values_list('id', 'name', 'tags', 'category_id', 's3_url', 'category__name')
+            for icon_id, name, tags, category_id, s3_url, category_name in rows.iterator(chunk_size=5000):
+                yield icon_id, name, tags, category_id, icon_key(s3_url, category_name, name), None
+            return
+        # Only the order comes from the database
+        for icon_id in icons.values_list('id', flat=True).iterator(chunk_size=5000):
+            row = snapshot.row_for_id(icon_id)
+            if row is not None:
+                icon = snapshot.icon(row)
+                yield icon_id, icon.name, icon.tags, icon.category_id, None, row
+
+    def __len__(self):
+        return len(self.rows) if self.snapshot is not None else len(self.ids)
+
+    def category(self, i):
+        category_id, name, slug = self.categories[i]
+        return {'id': category_id, 'name': name, 'slug': slug}
+
+    def icon(self, rank):
+        if self.snapshot is not None:
+            icon = self.snapshot.icon(self.rows[rank])
+            return {'id': icon.id, 'name': icon.name, 'category': icon.category.name, 'url': icon.url}
+        return {
+            'id': self.ids[rank],
+            'name': self.names[rank],
+            'category': self.category_names.get(self.category_ids[rank]),
+            'url': public_url(self.keys[rank]),
+        }
+
+    def lookup(self, query, limit):
+        """
+        Return ``(icons, categories)`` matching every token of ``query`` as
+        a prefix: icons named exactly like the query first, then name
+        matches, then tag and category matches, each most downloaded
+        first
+        """
+        tokens = tuple(tokenize(query))
+        if not tokens or limit <= 0:
+            return [], []
+        ranks, categories = self.match(tokens, limit)
+        return [self.icon(rank) for rank in ranks], [self.category(i) for i in categories]
+
+    def _match(self, tokens, limit):
+        ranks = []
+        seen = set()
+        # Lazily, so tags are not looked at once names fill the page
+        candidates = chain(
+            self.exact.get('-'.join(tokens), ()),
+            chain.from_iterable(field.matches(tokens, self.words) for field in self.fields),
+        )
+        for rank in candidates:
+            if rank not in seen:
+                seen.add(rank)
+                ranks.append(rank)
+                if len(ranks) >= limit:
+                    break
+
+        categories = [
+            i for i, words in enumerate(self.category_words)
+            if all(any(word.startswith(token) for word in words) for token in tokens)
+        ][:limit]
+        return tuple(ranks), tuple(categories)
+
+
+def _rebuild(version):
+    global _index, _rebuilding
+    try:
+        started = time.perf_counter()
+        index = AutocompleteIndex(version)
+        _index = index
+        logger.info(
+            "Built autocomplete index of %d icons at version %s in %.2fs",
+            len(index), version, time.perf_counter() - started,
+        )
+    except Exception:
+        logger.exception("Autocomplete index rebuild failed")
+    finally:
+        _rebuilding = False
+        connections.close_all()
+
+
+def get_index():
+    """
+    The current index, built on first use. At most every
+    VERSION_CHECK_INTERVAL seconds the catalogue version is compared with
+    the index's, and a stale index is rebuilt in the background.
+    """
+    global _index, _checked_at, _rebuilding
+    options = settings.ICON_AUTOCOMPLETE
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = AutocompleteIndex(get_version()[0])
+                _checked_at = time.monotonic()
+        return _index
+
+    now = time.monotonic()
+    if now - _checked_at < options['VERSION_CHECK_INTERVAL']:
+        return _index
+    with _lock:
+        if now - _checked_at < options['VERSION_CHECK_INTERVAL'] or _rebuilding:
+            return _index
+        _checked_at = now
+        version, _ = get_version()
+        if version != _index.version or now - _index.built_at >= options['MAX_AGE']:
+            _rebuilding = True
+            _rebuilds.submit(_rebuild, version)
+    return _index
+
+
+def suggest(query, limit=None):
+    options = settings.ICON_AUTOCOMPLETE
+    limit = options['LIMIT'] if limit is None else min(limit, options['MAX_LIMIT'])
+    return get_index().lookup(query, limit)
+
+
+def record_download(icon_id):
+    """
+    Count a download of an icon. Counts are kept in memory, so a download
+    costs no query; returns True once DOWNLOAD_FLUSH_INTERVAL has passed,
+    or DOWNLOAD_MAX_IDS distinct ids are buffered, and the caller should
+    call flush_downloads. Ids are not checked here: the flush's UPDATE
+    skips the ones that match no icon, and the cap keeps made-up ones
+    from growing the buffer.
+    """
+    if not 0 < icon_id <= MAX_ICON_ID:
+        return False
+    options = settings.ICON_AUTOCOMPLETE
+    with _downloads_lock:
+        if icon_id in _downloads or len(_downloads) < options['DOWNLOAD_MAX_IDS']:
+            _downloads[icon_id] += 1
+        return (
+            len(_downloads) >= options['DOWNLOAD_MAX_IDS']
+            or time.monotonic() - _flushed_at >= options['DOWNLOAD_FLUSH_INTERVAL']
+        )
+
+
+def flush_downloads():
+    """
+    Add the buffered download counts to Icon.downloads, one UPDATE per
+    distinct count
+    """
+    global _downloads, _flushed_at
+    with _downloads_lock:
+        counts, _downloads = _downloads, Counter()
+        _flushed_at = time.monotonic()
+    by_count = defaultdict(list)
+    for icon_id, count in counts.items():
+        by_count[count].append(icon_id)
+    for count, icon_ids in by_count.items():
+        Icon.objects.filter(id__in=icon_ids).update(downloads=F('downloads') + count)
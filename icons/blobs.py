@@ -0,0 +1,219 @@
+"""
+Content-addressed storage for icon files.
+
+Every stored icon lives at ``blobs/sha256/<2 hex>/<sha256>.svg``, keyed
+by the hash of the bytes actually stored (after ingest), so the same SVG
+uploaded to two categories or imported twice is stored and cached once,
+and a blob never changes once written, which lets it be served with an
+immutable Cache-Control. Blob rows count the icons pointing at them;
+references are taken and dropped under a row lock, and the last release
+queues the S3 delete in the same transaction.
+"""
+import hashlib
+import logging
+import re
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from .ingest import ingest_object, variant_key, variant_keys
+from .models import Blob
+
+logger = logging.getLogger(__name__)
+
+
+def blob_key(digest):
+    return f"{settings.ICON_BLOBS['PREFIX']}{digest[:2]}/{digest}.svg"
+
+
+def is_blob_key(key):
+    return key.startswith(settings.ICON_BLOBS['PREFIX'])
+
+
+BLOB_NAME_RE = re.compile(r'^[0-9a-f]{2}/([0-9a-f]{64})\.svg$')
+
+
+def key_digest(key):
+    """
+    The digest a blob key is named after, or None for other keys
+    """
+    if not is_blob_key(key):
+        return None
+    match = BLOB_NAME_RE.match(key[len(settings.ICON_BLOBS['PREFIX']):])
+    return match.group(1) if match else None
+
+
+def content_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_digest(file):
+    """
+    Hash an uploaded file chunk by chunk
+    """
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def acquire_many(blobs):
+    """
+    Add references to several blobs in a handful of queries, creating the
+    rows that are missing: ``blobs`` maps digests to ``(size, count)``.
+    Returns ``({digest: blob}, created digests)``; the caller stores the
+    objects of the created ones.
+    """
+    if not blobs:
+        return {}, set()
+    digests = list(blobs)
+    with transaction.atomic():
+        # Rows are locked in digest order, so concurrent imports cannot
+        # deadlock on each other
+        existing = set(
+            Blob.objects.select_for_update().filter(sha256__in=digests).order_by('sha256').values_list('sha256', flat=True)
+        )
+        created = {digest for digest in digests if digest not in existing}
+        Blob.objects.bulk_create(
+            [Blob(sha256=digest, size=blobs[digest][0]) for digest in digests if digest in created],
+            ignore_conflicts=True,
+        )
+        rows = {blob.sha256: blob for blob in Blob.objects.select_for_update().filter(sha256__in=digests).order_by('sha256')}
+        by_count = {}
+        for digest, (_, count) in blobs.items():
+            by_count.setdefault(count, []).append(rows[digest].pk)
+        for count, ids in by_count.items():
+            Blob.objects.filter(pk__in=ids).update(refcount=F('refcount') + count)
+    return rows, created
+
+
+def acquire(digest, size, count=1):
+    """
+    Add ``count`` references to the blob for ``digest``, creating its row
+    if needed. Returns ``(blob, created)``; the caller stores the object
+    when ``created`` is True.
+    """
+    blobs, created = acquire_many({digest: (size, count)})
+    return blobs[digest], digest in created
+
+
+def release_many(blobs, delete_objects=True):
+    """
+    Drop references to several blobs: ``blobs`` maps blob ids to counts.
+    Dropping the last reference to one deletes its row and, unless
+    ``delete_objects`` is False, queues the deletion of the object and its
+    variants; an upload of the same bytes racing with it waits on the row
+    lock and then recreates both.
+    """
+    from .outbox import enqueue_deletes
+
+    if not blobs:
+        return
+    with transaction.atomic():
+        rows = list(Blob.objects.select_for_update().filter(pk__in=list(blobs)).order_by('sha256'))
+        by_count, gone = {}, []
+        for blob in rows:
+            count = blobs[blob.pk]
+            if blob.refcount > count:
+                by_count.setdefault(count, []).append(blob.pk)
+            else:
+                gone.append(blob)
+        for count, ids in by_count.items():
+            Blob.objects.filter(pk__in=ids).update(refcount=F('refcount') - count)
+        if gone:
+            Blob.objects.filter(pk__in=[blob.pk for blob in gone]).delete()
+            if delete_objects:
+                enqueue_deletes([key for blob in gone for key in [blob.key] + variant_keys(blob.key)])
+
+
+def release(blob_id, count=1, delete_objects=True):
+    """
+    Drop ``count`` references to a blob, as release_many() does
+    """
+    release_many({blob_id: count}, delete_objects)
+
+
+def put_blob(client, digest, content, variants):
+    """
+    Write a blob and its compressed variants straight to S3, for batch
+    jobs that do not go through the outbox
+    """
+    key = blob_key(digest)
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    cache_control = settings.ICON_CACHE_CONTROL['blob']
+    client.put_object(Bucket=bucket, Key=key, Body=content, ContentType='image/svg+xml', CacheControl=cache_control)
+    for encoding, compressed in variants.items():
+        client.put_object(
+            Bucket=bucket, Key=variant_key(key, encoding), Body=compressed,
+            ContentType='image/svg+xml', ContentEncoding=encoding, CacheControl=cache_control,
+        )
+
+
+def read_objects(pool, client, entries, optimize=True):
+    """
+    Read and ingest the ``(icon, key)`` objects in ``entries`` on
+    ``pool``, recording their sizes on the icons. Returns
+    ``[(icon, digest, content, variants)]``; objects that cannot be read
+    are logged and left out.
+    """
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+
+    def run(entry):
+        icon, key = entry
+        try:
+            return icon, ingest_object(client, bucket, key, optimize=optimize)
+        except Exception as e:
+            logger.error("Could not read %s: %s", key, e)
+            return icon, None
+
+    stored = []
+    for icon, result in pool.map(run, entries):
+        if result is not None:
+            content, variants, sizes = result
+            for field, value in sizes.items():
+                setattr(icon, field, value)
+            stored.append((icon, content_digest(content), content, variants))
+    return stored
+
+
+def put_missing_blobs(pool, client, stored, digests=None):
+    """
+    Upload the blobs of ``stored`` that have no Blob row yet (or just
+    those in ``digests``) in parallel and return the digests uploaded
+    """
+    contents = {digest: (content, variants) for _, digest, content, variants in stored}
+    if digests is None:
+        known = set(Blob.objects.filter(sha256__in=list(contents)).values_list('sha256', flat=True))
+        digests = set(contents) - known
+    futures = [pool.submit(put_blob, client, digest, *contents[digest]) for digest in digests]
+    for future in futures:
+        future.result()
+    return digests
+
+
+def attach_blobs(pool, client, stored, uploaded):
+    """
+    Point the icons of ``stored`` at their blobs, taking one reference per
+    icon, and return ``{blob id: count}`` of the references the icons held
+    before. Run inside the transaction that saves the icons, and pass the
+    result to release_many() once they are saved: blobs are protected
+    from deletion while icons still point at them.
+    """
+    blobs, released = {}, {}
+    for icon, digest, content, _ in stored:
+        size, count = blobs.get(digest, (len(content), 0))
+        blobs[digest] = (size, count + 1)
+        if icon.blob_id:
+            released[icon.blob_id] = released.get(icon.blob_id, 0) + 1
+
+    # Acquired before anything is released, so an icon whose bytes did not
+    # change never drops its blob to zero references
+    rows, created = acquire_many(blobs)
+    for icon, digest, _, _ in stored:
+        icon.blob = rows[digest]
+        icon.s3_url = blob_key(digest)
+    recreated = created - set(uploaded)
+    if recreated:
+        # Released by someone else between the existence check and the
+        # lock; write them again once the new references are committed
+        transaction.on_commit(lambda: put_missing_blobs(pool, client, stored, recreated))
+    return released
@@ -0,0 +1,151 @@
+import asyncio
+import io
+import logging
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .render import render_variant
+from .cdn import key_from_url
+from .s3_async import afetch_svg
+from .svg_cache import fetch_svg
+
+logger = logging.getLogger(__name__)
+
+
+class ZipStream(io.RawIOBase):
+    """
+    Write-only, unseekable sink for ZipFile; whatever the archive has
+    written so far is handed out by ``drain`` and then forgotten
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def build_member(icon, spec):
+    """
+    Return ``(archive name, bytes)`` for one ``(id, name, category, s3_url)``
+    row, rendered with ``spec`` when one is given
+    """
+    icon_id, name, category, s3_url = icon
+    etag, content = fetch_svg(key_from_url(s3_url))
+    extension = 'svg'
+    if spec:
+        content = render_variant(etag, content, spec)
+        extension = spec['format']
+    return f"{category}/{name}.{extension}", content
+
+
+def fetch_members(icons, spec, workers):
+    """
+    Fetch icon bodies on a thread pool, yielding ``(name, content, error)``
+    as they complete. At most ``workers * 2`` fetches are in flight, so
+    memory stays bounded however many icons are requested.
+    """
+    def result(future):
+        icon = futures.pop(future)
+        try:
+            return (*future.result(), None)
+        except Exception as e:
+            logger.error("Could not add icon %s to bundle: %s", icon[0], e)
+            return f"{icon[2]}/{icon[1]}", None, str(e)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for icon in icons:
+            futures[pool.submit(build_member, icon, spec)] = icon
+            if len(futures) >= workers * 2:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield result(future)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield result(future)
+
+
+def iter_bundle(icons, spec=None, workers=None):
+    """
+    Stream a ZIP archive of the given icon rows, yielding archive bytes
+    as each member is written
+    """
+    workers = workers or settings.ICON_BUNDLE['WORKERS']
+    stream = ZipStream()
+    errors = []
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content, error in fetch_members(icons, spec, workers):
+            if error:
+                errors.append(f"{name}: {error}")
+                continue
+            archive.writestr(name, content)
+            yield stream.drain()
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+    yield stream.drain()
+
+
+async def abuild_member(icon, spec):
+    """
+    Async counterpart of ``build_member``; rendering is CPU-bound, so it
+    runs in a thread
+    """
+    icon_id, name, category, s3_url = icon
+    etag, content = await afetch_svg(key_from_url(s3_url))
+    extension = 'svg'
+    if spec:
+        content = await sync_to_async(render_variant, thread_sensitive=False)(etag, content, spec)
+        extension = spec['format']
+    return f"{category}/{name}.{extension}", content
+
+
+async def aiter_bundle(icons, spec=None, workers=None):
+    """
+    Async counterpart of ``iter_bundle`` over a list of icon rows. At most
+    ``workers * 2`` fetches are in flight, and none are started while the
+    client is still receiving earlier members.
+    """
+    workers = workers or settings.ICON_BUNDLE['WORKERS']
+    stream = ZipStream()
+    errors = []
+    pending = {}
+    icons = iter(icons)
+    try:
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            while True:
+                for icon in icons:
+                    pending[asyncio.ensure_future(abuild_member(icon, spec))] = icon
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    icon = pending.pop(task)
+                    try:
+                        name, content = task.result()
+                    except Exception as e:
+                        logger.error("Could not add icon %s to bundle: %r", icon[0], e)
+                        errors.append(f"{icon[2]}/{icon[1]}: {e or type(e).__name__}")
+                        continue
+                    archive.writestr(name, content)
+                    yield stream.drain()
+            if errors:
+                archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+        yield stream.drain()
+    finally:
+        # The client went away; stop fetching for it
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,178 @@
+import base64
+import json
+from django.conf import settings
+from django.db.models import Count, Q
+from .cdn import icon_key, public_url
+from .models import Icon, IconCategory
+from .search import filter_icons
+from .sprites import attach_sprite_urls
+from .versioning import get_version
+
+
+def get_categories():
+    """
+    All categories with their icon totals annotated as ``icon_count`` and
+    their sprite URL as ``sprite_url``
+    """
+    return attach_sprite_urls(list(IconCategory.objects.annotate(icon_count=Count('icon')).order_by('id')))
+
+
+def get_icons(query='', category=None, order_by=('id',), limit=None, category_ids=None):
+    """
+    Icons with their category joined in, optionally filtered by a search
+    query, a single category and/or a list of category ids. Read from the
+    catalogue snapshot when it is current and covers the ordering, from
+    the database otherwise.
+    """
+    from .snapshot import get_snapshot
+
+    by_name = order_by == ('name',) and category is not None
+    snapshot = get_snapshot() if order_by == ('id',) or by_name else None
+    if snapshot is not None:
+        if category is not None:
+            category_ids = [category.id] if category_ids is None else [c for c in category_ids if c == category.id]
+        ids = None
+        if query:
+            ids = set(filter_icons(Icon.objects.all(), query).values_list('id', flat=True))
+        return snapshot.icons(category_ids=category_ids, by_name=by_name, ids=ids, limit=limit)
+
+    icons = Icon.objects.select_related('category').order_by(*order_by)
+    if category is not None:
+        icons = icons.filter(category=category)
+    if category_ids is not None:
+        icons = icons.filter(category_id__in=category_ids)
+    if query:
+        icons = filter_icons(icons, query)
+    if limit is not None:
+        icons = icons[:limit]
+    return list(icons)
+
+
+def build_catalogue(query=''):
+    """
+    Build the grouped home page catalogue in two queries: one for the
+    annotated categories and one for the icons. Each category gets an
+    ``icon_list`` holding its icons so templates walk every group once.
+    """
+    categories = get_categories()
+    icons = get_icons(query)
+    group_icons(categories, icons)
+    return categories, icons
+
+
+def group_icons(categories, icons):
+    """
+    Set ``icon_list`` on every category to its icons, in the given order
+    """
+    groups = {category.id: [] for category in categories}
+    for icon in icons:
+        groups.setdefault(icon.category_id, []).append(icon)
+
+    for category in categories:
+        category.icon_list = groups[category.id]
+
+
+# Fields the JSON API can project; values are the ORM lookups behind them.
+# 'url' is the icon's public URL, built from s3_url by api_row
+API_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'category': 'category__name',
+    'category_id': 'category_id',
+    'tags': 'tags',
+    'url': 's3_url',
+}
+DEFAULT_API_FIELDS = ('id', 'name', 'category', 'url')
+
+
+def api_row(row, lookups):
+    """
+    Project a ``.values()`` row of an icon onto the API fields in
+    ``lookups``
+    """
+    icon = {field: row[lookup] for field, lookup in lookups.items()}
+    if 'url' in icon:
+        icon['url'] = public_url(icon_key(row['s3_url'], row['category__name'], row['name']))
+    return icon
+
+
+def api_columns(lookups):
+    columns = set(lookups.values())
+    if 'url' in lookups:
+        # For the URL of icons stored before s3_url was always set
+        columns |= {'category__name', 'name'}
+    return columns
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(category_id, name, icon_id):
+    raw = json.dumps([category_id, name, icon_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        category_id, name, icon_id = json.loads(raw)
+        return int(category_id), str(name), int(icon_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+
+
+def get_icon_page(cursor=None, limit=None, category_id=None, query='', fields=DEFAULT_API_FIELDS):
+    """
+    One page of icons in (category, name) order using keyset pagination,
+    so the cost depends on the page size rather than how deep the page
+    is. Rows are plain dicts built with ``.values()``.
+
+    Returns ``(rows, next_cursor)``; next_cursor is None on the last page.
+    """
+    limit = limit or settings.ICON_API_PAGE_SIZE
+    # (category, name) is unique, so it orders rows completely and the
+    # database reads them straight off the unique index without sorting
+    icons = Icon.objects.order_by('category_id', 'name')
+    if category_id is not None:
+        icons = icons.filter(category_id=category_id)
+    if query:
+        icons = filter_icons(icons, query)
+    if cursor:
+        # Cursors still carry the icon id, which older ones needed as a
+        # tiebreaker
+        last_category, last_name, _ = decode_cursor(cursor)
+        # The leading category_id >= bound lets the database seek straight
+        # into the (category, name) index instead of scanning from the start
+        icons = icons.filter(
+            Q(category_id__gte=last_category),
+            Q(category_id__gt=last_category) | Q(name__gt=last_name)
+        )
+
+    # The keyset columns are always fetched; they build the next cursor
+    lookups = {field: API_FIELDS[field] for field in fields}
+    columns = api_columns(lookups) | {'id', 'name', 'category_id'}
+    rows = list(icons.values(*columns)[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last['category_id'], last['name'], last['id'])
+
+    return [api_row(row, lookups) for row in rows], next_cursor
+
+
+def catalogue_document():
+    """
+    The whole catalogue as one JSON-ready dict: every category with its
+    icon count, and every icon in the API's default fields and page order
+    """
+    version, _ = get_version()
+    categories = list(
+        IconCategory.objects.annotate(icon_count=Count('icon')).order_by('id').values('id', 'name', 'slug', 'icon_count')
+    )
+    lookups = {field: API_FIELDS[field] for field in DEFAULT_API_FIELDS}
+    rows = Icon.objects.order_by('category_id', 'name').values(*api_columns(lookups))
+    icons = [api_row(row, lookups) for row in rows.iterator()]
+    return {'version': version, 'categories': categories, 'icons': icons}
@@ -0,0 +1,100 @@
+"""
+The one place icon URLs are built and taken apart.
+
+An icon is stored as an object key, and ``Icon.s3_url`` holds the bare
+key, so no row depends on the domain or DEBUG setting it was written
+under. What browsers get is the public URL of the key, derived on
+demand: one of ICON_CDN['HOSTS'] picked by a stable hash of the key, so
+a given icon always comes from the same host and stays cached, while a
+page of icons spreads over all of them. Blob keys name their content
+(see icons/blobs.py), so their URLs are versioned by construction and
+served immutable. key_from_url() turns any of these URLs, and the older
+forms still found in links, bookmarks and rows written by earlier
+versions, back into the key.
+"""
+import re
+import zlib
+from functools import lru_cache
+from urllib.parse import quote, unquote, urlsplit
+from django.conf import settings
+
+# Path-style S3 URLs carry the bucket as the first path segment
+PATH_STYLE_HOST_RE = re.compile(r'^s3([.-][a-z0-9-]+)*\.amazonaws\.com$')
+
+
+def legacy_key(category_name, name):
+    """
+    Where icons without a stored URL were uploaded by earlier versions
+    """
+    return f"icons/{category_name}/{name}.svg"
+
+
+def public_hosts():
+    """
+    Base URLs icons are served from: ICON_CDN['HOSTS'], else the
+    delivery PUBLIC_BASE_URL, else the custom domain (through the nginx
+    S3 proxy with DEBUG on)
+    """
+    hosts = settings.ICON_CDN['HOSTS']
+    if hosts:
+        return tuple(host.rstrip('/') for host in hosts)
+    if settings.ICON_DELIVERY['PUBLIC_BASE_URL']:
+        return (settings.ICON_DELIVERY['PUBLIC_BASE_URL'].rstrip('/'),)
+    if settings.DEBUG:
+        return (f"http://{settings.AWS_S3_CUSTOM_DOMAIN}{getattr(settings, 'S3_PROXY_PREFIX', '')}",)
+    return (f"https://{settings.AWS_S3_CUSTOM_DOMAIN}",)
+
+
+def public_url(key):
+    hosts = public_hosts()
+    # crc32 rather than hash(), which differs from one worker to the next
+    host = hosts[zlib.crc32(key.encode()) % len(hosts)] if len(hosts) > 1 else hosts[0]
+    return f"{host}/{quote(key)}"
+
+
+def icon_key(s3_url, category_name, name):
+    """
+    The object key of an icon, from its stored key (or the URL earlier
+    versions stored) or, for rows without one, where it was uploaded by
+    earlier versions
+    """
+    return key_from_url(s3_url) if s3_url else legacy_key(category_name, name)
+
+
+@lru_cache(maxsize=16)
+def _url_prefixes(hosts, custom_domain):
+    """
+    ``{scheme://netloc: path prefix}`` of every base URL icons are served
+    or were stored under
+    """
+    prefixes = {}
+    for base in hosts:
+        parts = urlsplit(base)
+        prefixes[f"{parts.scheme}://{parts.netloc.lower()}"] = unquote(parts.path).strip('/')
+    # URLs stored by earlier versions; with DEBUG on the proxy serves the
+    # same domain over http
+    prefixes.setdefault(f"https://{custom_domain.lower()}", '')
+    return prefixes
+
+
+def key_from_url(url):
+    """
+    Extract the object key from a public, proxied, S3 or formerly stored URL, or
+    pass a bare key through, e.g.
+    https://bundled-icons-dev.s3.amazonaws.com/icons/actions/save.svg -> icons/actions/save.svg
+    """
+    parts = urlsplit(url)
+    path = unquote(parts.path).lstrip('/')
+    if not parts.netloc:
+        return path
+    host = parts.netloc.lower()
+    prefix = _url_prefixes(public_hosts(), settings.AWS_S3_CUSTOM_DOMAIN).get(f"{parts.scheme}://{host}")
+    proxy_prefix = getattr(settings, 'S3_PROXY_PREFIX', '')
+    if prefix is None and PATH_STYLE_HOST_RE.match(host):
+        prefix = settings.AWS_STORAGE_BUCKET_NAME or ''
+    elif prefix is None and proxy_prefix.strip('/'):
+        # Proxied URLs from another host name, e.g. http://127.0.0.1/s3/...
+        prefix = proxy_prefix.strip('/')
+    if prefix and path.startswith(prefix + '/'):
+        path = path[len(prefix) + 1:]
+    return path
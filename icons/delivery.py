@@ -0,0 +1,130 @@
+"""
+How download_icon hands out icon bytes: ``proxy`` streams them through
+Django, ``redirect`` sends the client to the public CDN/S3 URL and
+``presigned`` to a short-lived signed S3 URL. The mode is set per
+deployment in ICON_DELIVERY; keys under a private prefix fall back to
+PRIVATE_MODE on a per-request basis, since they have no public URL.
+"""
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponseRedirect
+from . import cdn
+from .s3 import get_s3_client
+
+PROXY = 'proxy'
+REDIRECT = 'redirect'
+PRESIGNED = 'presigned'
+MODES = (PROXY, REDIRECT, PRESIGNED)
+
+
+def content_disposition(filename):
+    return f'attachment; filename="{filename}"'
+
+
+def is_private(key):
+    return any(key.startswith(prefix) for prefix in settings.ICON_DELIVERY['PRIVATE_PREFIXES'])
+
+
+def delivery_mode(key):
+    """
+    The mode to serve ``key`` with: the deployment's mode, unless that
+    needs a public URL and the key is private
+    """
+    mode = settings.ICON_DELIVERY['MODE']
+    if mode not in MODES:
+        raise ImproperlyConfigured(f"ICON_DELIVERY['MODE'] must be one of {', '.join(MODES)}, not {mode!r}")
+    if mode == REDIRECT and is_private(key):
+        return settings.ICON_DELIVERY['PRIVATE_MODE']
+    return mode
+
+
+def public_url(key, filename=None):
+    url = cdn.public_url(key)
+    if filename:
+        url += '?' + urlencode({'response-content-disposition': content_disposition(filename)})
+    return url
+
+
+class PresignedURLCache:
+    """
+    Thread-safe LRU of presigned URLs by ``(key, filename)``. A URL is
+    reused until ``margin`` seconds before it expires, so signing happens
+    once per key per expiry window rather than on every request.
+    """
+
+    def __init__(self, expires_in, margin, max_entries):
+        self.expires_in = expires_in
+        self.margin = margin
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, filename=None):
+        """
+        Return ``(url, seconds it stays usable)``
+        """
+        now = time.monotonic()
+        cache_key = (key, filename)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[1] - self.margin > now:
+                self._entries.move_to_end(cache_key)
+                return entry[0], int(entry[1] - self.margin - now)
+
+        params = {'Bucket': settings.AWS_STORAGE_BUCKET_NAME, 'Key': key}
+        if filename:
+            params['ResponseContentDisposition'] = content_disposition(filename)
+        url = get_s3_client().generate_presigned_url('get_object', Params=params, ExpiresIn=self.expires_in)
+        expires_at = now + self.expires_in
+
+        with self._lock:
+            self._entries[cache_key] = (url, expires_at)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return url, self.expires_in - self.margin
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_presigned = None
+_presigned_lock = threading.Lock()
+
+
+def get_presigned_cache():
+    global _presigned
+    if _presigned is None:
+        with _presigned_lock:
+            if _presigned is None:
+                options = settings.ICON_DELIVERY
+                _presigned = PresignedURLCache(
+                    expires_in=options['PRESIGN_EXPIRES'],
+                    margin=options['PRESIGN_MARGIN'],
+                    max_entries=options['PRESIGN_CACHE_SIZE'],
+                )
+    return _presigned
+
+
+def delivery_response(key, filename):
+    """
+    Return the redirect that delivers ``key`` for the configured mode, or
+    None when the bytes should be proxied
+    """
+    mode = delivery_mode(key)
+    if mode == REDIRECT:
+        response = HttpResponseRedirect(public_url(key, filename))
+        response['Cache-Control'] = settings.ICON_CACHE_CONTROL['redirect']
+        return response
+    if mode == PRESIGNED:
+        url, max_age = get_presigned_cache().get(key, filename)
+        response = HttpResponseRedirect(url)
+        # Never let a cached redirect outlive the signature
+        response['Cache-Control'] = f'private, max-age={max(max_age, 0)}'
+        return response
+    return None
@@ -0,0 +1,95 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from .catalogue import get_icons, group_icons
+from .cdn import public_hosts
+from .metrics import CACHE_REQUESTS
+from .versioning import category_version_key, get_versions
+
+
+def fragments_enabled():
+    """
+    Fragments are always rendered fresh with DEBUG on, so template edits
+    show up immediately
+    """
+    return settings.ICON_FRAGMENT_CACHE['ENABLED'] and not settings.DEBUG
+
+
+def get_fragment_cache():
+    return caches[settings.ICON_FRAGMENT_CACHE['CACHE']]
+
+
+def fragment_key(name, *parts):
+    # Fragments embed icon URLs, so a change of CDN hosts must miss too
+    parts += public_hosts()
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+    return f"fragment:{name}:{digest}"
+
+
+def cached_fragment(name, parts, template_name, get_context):
+    """
+    Return the rendered HTML of a template, cached under ``name`` and the
+    version ``parts`` it depends on. ``get_context`` is only called on a
+    cache miss, so the data behind the fragment is only loaded then.
+    """
+    if not fragments_enabled():
+        return mark_safe(render_to_string(template_name, get_context()))
+
+    cache = get_fragment_cache()
+    key = fragment_key(name, *parts)
+    html = cache.get(key)
+    CACHE_REQUESTS.inc('fragment', 'miss' if html is None else 'hit')
+    if html is None:
+        html = render_to_string(template_name, get_context())
+        cache.set(key, html, timeout=settings.ICON_FRAGMENT_CACHE['TIMEOUT'])
+    return mark_safe(html)
+
+
+def render_category_grids(categories, query='', template_name='icons/_category_grid.html'):
+    """
+    Set ``grid_html`` on every category to its rendered icon grid.
+
+    Without a search query each grid is cached under the category's
+    version and sprite, and icons are only loaded for the categories
+    whose grid missed; the others are neither queried nor re-rendered.
+    Returns the icons that were loaded.
+    """
+    keys = {}
+    if fragments_enabled() and not query:
+        versions = get_versions([category_version_key(category.id) for category in categories])
+        keys = {
+            category.id: fragment_key(
+                'category-grid', category.id, versions[category_version_key(category.id)], category.sprite_url or ''
+            )
+            for category in categories
+        }
+
+    cache = get_fragment_cache()
+    cached = cache.get_many(list(keys.values())) if keys else {}
+    missing = [category for category in categories if keys.get(category.id) not in cached]
+    if keys:
+        CACHE_REQUESTS.inc('fragment', 'hit', amount=len(cached))
+        CACHE_REQUESTS.inc('fragment', 'miss', amount=len(missing))
+
+    icons = []
+    if missing:
+        category_ids = [category.id for category in missing] if cached else None
+        icons = get_icons(query, category_ids=category_ids)
+        group_icons(missing, icons)
+
+    rendered = {}
+    for category in categories:
+        key = keys.get(category.id)
+        if key in cached:
+            category.grid_html = mark_safe(cached[key])
+            continue
+        html = render_to_string(template_name, {'category': category, 'debug': settings.DEBUG})
+        category.grid_html = mark_safe(html)
+        if key:
+            rendered[key] = html
+
+    if rendered:
+        cache.set_many(rendered, timeout=settings.ICON_FRAGMENT_CACHE['TIMEOUT'])
+    return icons
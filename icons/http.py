@@ -0,0 +1,69 @@
+import asyncio
+import hashlib
+from functools import wraps
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from .versioning import get_request_version
+
+
+def content_etag(content):
+    """
+    Strong ETag derived from the payload bytes
+    """
+    return '"%s"' % hashlib.sha256(content).hexdigest()[:32]
+
+
+def page_etag(request, *args, **kwargs):
+    """
+    Weak ETag for rendered pages, tied to the catalogue version stamp
+    """
+    version, _ = get_request_version(request)
+    return 'W/"catalogue-%d"' % version
+
+
+def page_last_modified(request, *args, **kwargs):
+    _, updated_at = get_request_version(request)
+    return updated_at
+
+
+def response_decorator(apply):
+    """
+    Turn ``apply(request, response)`` into a view decorator that works on
+    sync and async views
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                return apply(request, await view(request, *args, **kwargs))
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return apply(request, view(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def cache_policy(name):
+    """
+    Set the Cache-Control header configured in ICON_CACHE_CONTROL[name] on
+    every response of a view, including 304s. Works on sync and async views.
+    A view can pick another policy for the request it is serving by setting
+    ``request.cache_policy``.
+    """
+    def apply(request, response):
+        policy = settings.ICON_CACHE_CONTROL.get(getattr(request, 'cache_policy', name))
+        if policy and response.status_code in (200, 304):
+            response['Cache-Control'] = policy
+        return response
+    return response_decorator(apply)
+
+
+def _vary_on_encoding(request, response):
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+# For views that pick a precompressed variant by Accept-Encoding
+vary_on_encoding = response_decorator(_vary_on_encoding)
@@ -0,0 +1,246 @@
+"""
+Ingest-time optimization of icon SVGs.
+
+Icons are minified at the XML level once, when they enter the bucket,
+instead of being shipped with editor metadata and 8-digit coordinates on
+every download. Gzip and brotli variants are stored next to each object
+as ``<key>.gz`` and ``<key>.br`` with their Content-Encoding set, so
+download_icon can hand them out without compressing per request.
+"""
+import gzip
+import logging
+import re
+import xml.etree.ElementTree as ET
+from django.conf import settings
+from django.db.models import Count, Sum
+from .metrics import INGEST_BYTES
+from .models import Icon
+from .render import SVG_NS
+
+logger = logging.getLogger(__name__)
+
+ET.register_namespace('xlink', 'http://www.w3.org/1999/xlink')
+
+# Encodings in order of preference and the suffix of their variant key
+VARIANT_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+SIZE_FIELDS = {'br': 'brotli_bytes', 'gzip': 'gzip_bytes'}
+INGEST_FIELDS = ['original_bytes', 'stored_bytes', 'gzip_bytes', 'brotli_bytes']
+
+# Namespaces only editors care about; their elements and attributes go
+EDITOR_NAMESPACES = {
+    'http://www.inkscape.org/namespaces/inkscape',
+    'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
+    'http://www.bohemiancoding.com/sketch/ns',
+    'http://www.serif.com/',
+    'http://ns.adobe.com/AdobeIllustrator/10.0/',
+    'http://ns.adobe.com/Extensibility/1.0/',
+    'http://ns.adobe.com/Graphs/1.0/',
+    'http://ns.adobe.com/SaveForWeb/1.0/',
+    'http://ns.adobe.com/Variables/1.0/',
+    'http://ns.adobe.com/ImageReplacement/1.0/',
+    'http://ns.adobe.com/AdobeSVGViewerExtensions/3.0/',
+    'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'http://purl.org/dc/elements/1.1/',
+    'http://creativecommons.org/ns#',
+}
+DROPPED_TAGS = {f'{{{SVG_NS}}}metadata'}
+# Whitespace is significant in text content
+TEXT_TAGS = {f'{{{SVG_NS}}}{tag}' for tag in ('text', 'tspan', 'textPath', 'style')}
+NUMERIC_ATTRIBUTES = {
+    'd', 'points', 'viewBox', 'transform', 'x', 'y', 'x1', 'y1', 'x2', 'y2',
+    'cx', 'cy', 'r', 'rx', 'ry', 'width', 'height', 'stroke-width', 'opacity',
+    'fill-opacity', 'stroke-opacity', 'offset',
+}
+# Only decimals are rounded; integers are left alone, which also keeps
+# compact arc flags like "a1 1 0 011 1" intact
+DECIMAL_RE = re.compile(r'-?(?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?|-?\d+[eE][-+]?\d+')
+ARC_RE = re.compile(r'[aA]')
+
+
+class IngestError(ValueError):
+    pass
+
+
+def variant_key(key, encoding):
+    return key + VARIANT_SUFFIXES[encoding]
+
+
+def variant_keys(key):
+    return [variant_key(key, encoding) for encoding in VARIANT_SUFFIXES]
+
+
+def _namespace(name):
+    return name[1:].split('}', 1)[0] if name.startswith('{') else None
+
+
+def _round_numbers(value, precision):
+    def replace(match):
+        number = f"{round(float(match.group()), precision):.{precision}f}".rstrip('0').rstrip('.')
+        if number in ('-0', ''):
+            number = '0'
+        if number.startswith('0.'):
+            number = number[1:]
+        elif number.startswith('-0.'):
+            number = '-' + number[2:]
+        # "1.0.5" must not turn into "1.5"
+        if '.' not in number and value[match.end():match.end() + 1] == '.':
+            number += ' '
+        return number
+    return DECIMAL_RE.sub(replace, value)
+
+
+def _clean(element, precision):
+    for child in list(element):
+        if (
+            not isinstance(child.tag, str)
+            or child.tag in DROPPED_TAGS
+            or _namespace(child.tag) in EDITOR_NAMESPACES
+        ):
+            element.remove(child)
+            continue
+        _clean(child, precision)
+
+    for attr in list(element.attrib):
+        if _namespace(attr) in EDITOR_NAMESPACES:
+            del element.attrib[attr]
+            continue
+        if attr in NUMERIC_ATTRIBUTES:
+            value = ' '.join(element.get(attr).split())
+            if not (attr == 'd' and ARC_RE.search(value)):
+                value = _round_numbers(value, precision)
+            element.set(attr, value)
+
+    if element.tag not in TEXT_TAGS:
+        if element.text and not element.text.strip():
+            element.text = None
+        for child in element:
+            if child.tail and not child.tail.strip():
+                child.tail = None
+
+
+def minify_svg(content, precision=None):
+    """
+    Return ``content`` without comments, metadata, editor namespaces and
+    insignificant whitespace, with decimals rounded to ``precision``
+    places. Raises IngestError for documents that do not parse.
+    """
+    precision = settings.ICON_INGEST['PRECISION'] if precision is None else precision
+    try:
+        root = ET.fromstring(content)
+    except ET.ParseError as e:
+        raise IngestError(f"Invalid SVG: {e}")
+    _clean(root, precision)
+    return ET.tostring(root, encoding='unicode').encode()
+
+
+def get_brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def compress(content, encoding):
+    options = settings.ICON_INGEST
+    if encoding == 'gzip':
+        # A fixed mtime keeps the variant (and its ETag) deterministic
+        return gzip.compress(content, compresslevel=options['GZIP_LEVEL'], mtime=0)
+    if encoding == 'br':
+        brotli = get_brotli()
+        if brotli is None:
+            return None
+        return brotli.compress(content, quality=options['BROTLI_QUALITY'])
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def ingest_svg(content):
+    """
+    Optimize an SVG for storage and return ``(content, variants, sizes)``:
+    the bytes to store, ``{encoding: compressed bytes}`` and the byte
+    counts to record on the Icon. Documents that do not parse, or do not
+    get smaller, are stored as they are.
+    """
+    options = settings.ICON_INGEST
+    original_size = len(content)
+    if options['ENABLED'] and original_size <= options['MAX_BYTES']:
+        try:
+            minified = minify_svg(content)
+        except IngestError as e:
+            logger.warning("Storing SVG unoptimized: %s", e)
+        else:
+            if len(minified) < original_size:
+                content = minified
+
+    variants = {}
+    if options['ENABLED']:
+        for encoding in options['ENCODINGS']:
+            compressed = compress(content, encoding)
+            # Tiny icons can come out larger than they went in
+            if compressed is not None and len(compressed) < len(content):
+                variants[encoding] = compressed
+
+    sizes = {'original_bytes': original_size, 'stored_bytes': len(content)}
+    for encoding, field in SIZE_FIELDS.items():
+        sizes[field] = len(variants[encoding]) if encoding in variants else None
+
+    INGEST_BYTES.inc('original', amount=original_size)
+    INGEST_BYTES.inc('stored', amount=len(content))
+    for encoding, compressed in variants.items():
+        INGEST_BYTES.inc(encoding, amount=len(compressed))
+    return content, variants, sizes
+
+
+def ingest_object(client, bucket, key, optimize=True):
+    """
+    Read an object and return ``(content, variants, sizes)`` as
+    ingest_svg does. With ``optimize`` False, or for objects that are
+    too large or already carry a Content-Encoding, the bytes are kept as
+    they are and no variants are made.
+    """
+    response = client.get_object(Bucket=bucket, Key=key)
+    original = response['Body'].read()
+    response['Body'].close()
+    if optimize and not response.get('ContentEncoding') and len(original) <= settings.ICON_INGEST['MAX_BYTES']:
+        return ingest_svg(original)
+    sizes = {'original_bytes': len(original), 'stored_bytes': len(original)}
+    sizes.update(dict.fromkeys(SIZE_FIELDS.values()))
+    return original, {}, sizes
+
+
+def accepted_encodings(accept_encoding):
+    """
+    The stored encodings the client accepts, in order of preference
+    """
+    if not settings.ICON_INGEST['ENABLED']:
+        return []
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[coding.strip().lower()] = quality
+
+    return [
+        encoding for encoding in VARIANT_SUFFIXES
+        if encoding in settings.ICON_INGEST['ENCODINGS'] and accepted.get(encoding, accepted.get('*', 0)) > 0
+    ]
+
+
+def ingest_totals():
+    """
+    Aggregate byte savings over all icons that went through ingest
+    """
+    totals = Icon.objects.filter(original_bytes__isnull=False).aggregate(
+        icons=Count('id'),
+        original=Sum('original_bytes'),
+        stored=Sum('stored_bytes'),
+        gzip=Sum('gzip_bytes'),
+        br=Sum('brotli_bytes'),
+    )
+    return {name: value or 0 for name, value in totals.items()}
@@ -0,0 +1,167 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from icons import metrics
+from icons.s3 import reset_s3_client
+from icons.svg_cache import reset_svg_cache
+
+BUCKET = 'bench-icons'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the catalogue views and the S3 importer against synthetic catalogues and a fake S3'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=str,
+            help='Comma-separated catalogue sizes to benchmark',
+            default='1000,10000,100000'
+        )
+        parser.add_argument(
+            '--categories',
+            type=int,
+            help='Number of categories the icons are spread over',
+            default=20
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            help='Requests per view scenario',
+            default=200
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Concurrent clients per view scenario',
+            default=8
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the results to this JSON file',
+            default='benchmark-results.json'
+        )
+        parser.add_argument(
+            '--baseline',
+            type=str,
+            help='Results JSON of an earlier run to compare against',
+            required=False
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            help='Fail when a latency or throughput metric is this fraction worse than the baseline',
+            default=0.2
+        )
+
+    def git_revision(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=settings.BASE_DIR,
+            ).stdout.strip() or None
+        except OSError:
+            return None
+
+    def scratch_settings(self, scratch):
+        """
+        Settings that point every file the app writes (snapshot,
+        prerendered pages, metrics, profiles, spooled uploads, SVG disk
+        cache) into ``scratch``, so the synthetic catalogue never
+        replaces what the real site serves. Features that are off stay off.
+        """
+        snapshot = {**settings.ICON_SNAPSHOT, 'PATH': os.path.join(scratch, 'snapshot', 'catalogue.snap')}
+        prerender = {**settings.ICON_PRERENDER}
+        if prerender['OUTPUT_DIR']:
+            prerender['OUTPUT_DIR'] = os.path.join(scratch, 'prerendered')
+        metrics_options = {**settings.ICON_METRICS, 'PROFILE_DIR': os.path.join(scratch, 'profiles')}
+        if metrics_options['DIR']:
+            metrics_options['DIR'] = os.path.join(scratch, 'metrics')
+        svg_cache = {**settings.ICON_SVG_CACHE}
+        if svg_cache['DISK_DIR']:
+            svg_cache['DISK_DIR'] = os.path.join(scratch, 'svg-cache')
+        return {
+            'ICON_SNAPSHOT': snapshot,
+            'ICON_PRERENDER': prerender,
+            'ICON_METRICS': metrics_options,
+            'ICON_OUTBOX': {**settings.ICON_OUTBOX, 'SPOOL_DIR': os.path.join(scratch, 'outbox')},
+            'ICON_SVG_CACHE': svg_cache,
+        }
+
+    def handle(self, *args, **options):
+        # Imported here so the benchmarks package is only needed by this command
+        from benchmarks.fake_s3 import FakeS3Server
+        from benchmarks.suite import compare, run_suite
+
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size]
+        except ValueError:
+            raise CommandError(f"Invalid --sizes value: {options['sizes']}")
+
+        baseline = None
+        if options.get('baseline'):
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+
+        # Everything runs against a throwaway test database, never the real one
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        scratch = tempfile.mkdtemp(prefix='benchmark-')
+        try:
+            with FakeS3Server() as s3, override_settings(
+                **self.scratch_settings(scratch),
+                DEBUG=False,
+                AWS_ACCESS_KEY_ID='bench',
+                AWS_SECRET_ACCESS_KEY='bench',
+                AWS_STORAGE_BUCKET_NAME=BUCKET,
+                AWS_S3_CUSTOM_DOMAIN=f"{BUCKET}.s3.amazonaws.com",
+                AWS_S3_ENDPOINT_URL=s3.endpoint_url,
+                ALLOWED_HOSTS=['*'],
+            ):
+                reset_s3_client()
+                reset_svg_cache()
+                results = run_suite(
+                    s3.store, BUCKET, sizes, options['categories'], options['requests'], options['concurrency'],
+                    log=self.stdout.write,
+                )
+        finally:
+            reset_s3_client()
+            # Keep the synthetic traffic out of the real metrics, which
+            # this process would otherwise write when it exits
+            reset_svg_cache()
+            metrics.reset()
+            shutil.rmtree(scratch, ignore_errors=True)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'meta': {
+                'revision': self.git_revision(),
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'categories': options['categories'],
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+            },
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is not None:
+            regressions = compare(results, baseline, options['threshold'])
+            if regressions:
+                for regression in regressions:
+                    self.stdout.write(self.style.ERROR(regression))
+                raise CommandError(f"{len(regressions)} metrics regressed beyond the baseline")
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
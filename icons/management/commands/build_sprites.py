@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from icons.models import CategorySprite, IconCategory
+from icons.sprites import build_sprite
+from icons.versioning import bump_version
+
+
+class Command(BaseCommand):
+    help = 'Build the per-category SVG sprite sheets'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--category',
+            type=str,
+            help='Only build the sprite of this category (by name)',
+            required=False
+        )
+        parser.add_argument(
+            '--missing-only',
+            action='store_true',
+            help='Only build sprites that do not exist yet',
+        )
+
+    def handle(self, *args, **options):
+        categories = IconCategory.objects.order_by('name')
+        if options.get('category'):
+            categories = categories.filter(name=options['category'])
+        if options['missing_only']:
+            categories = categories.exclude(id__in=CategorySprite.objects.values('category_id'))
+
+        for category in categories:
+            sprite = build_sprite(category)
+            self.stdout.write(f"{category.name}: {sprite.icon_count} icons, {len(sprite.content)} bytes ({sprite.digest[:12]})")
+        # Pages embed the sprite URLs, so their ETags have to change
+        if categories:
+            bump_version()
+
+        self.stdout.write(self.style.SUCCESS("Sprites built"))
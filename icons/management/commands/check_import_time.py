@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Measure what importing the app costs a new worker, and fail when it is over budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--budget',
+            type=float,
+            help='Milliseconds allowed (defaults to ICON_STARTUP["IMPORT_BUDGET_MS"])',
+            required=False
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            help='Measurements to take; the fastest counts',
+            default=3
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            help='Number of slowest modules to list',
+            default=15
+        )
+
+    def handle(self, *args, **options):
+        # Imported here so the benchmarks package is only needed by this command
+        from benchmarks.import_time import loaded_lazy_modules, measure
+
+        budget = options.get('budget')
+        if budget is None:
+            budget = settings.ICON_STARTUP['IMPORT_BUDGET_MS']
+        try:
+            result = measure(runs=max(options['runs'], 1), cwd=settings.BASE_DIR)
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("Slowest modules (self time):")
+        for name, ms in result['slowest'][:options['top']]:
+            self.stdout.write(f"  {ms:8.1f} ms  {name}")
+
+        problems = []
+        eager = loaded_lazy_modules(result['modules'], settings.ICON_STARTUP['LAZY_MODULES'])
+        if eager:
+            problems.append(f"Imported at startup but meant to load lazily: {', '.join(eager)}")
+        if result['total_ms'] > budget:
+            problems.append(f"Startup imports took {result['total_ms']:.0f} ms, over the {budget:.0f} ms budget")
+        for problem in problems:
+            self.stdout.write(self.style.ERROR(problem))
+        if problems:
+            raise CommandError('Import time check failed')
+        self.stdout.write(self.style.SUCCESS(f"Startup imports took {result['total_ms']:.0f} ms (budget {budget:.0f} ms)"))
@@ -1,11 +1,54 @@
-import boto3
-from django.core.management.base import BaseCommand
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from icons.blobs import attach_blobs, is_blob_key, put_missing_blobs, read_objects, release_many
+from icons.cdn import key_from_url
+from icons.ingest import INGEST_FIELDS, ingest_totals
 from icons.models import Icon, IconCategory
+from icons.prerender import prerender, prerender_enabled
+from icons.s3 import get_s3_client
+from icons.search import index_icons
+from icons.sprites import build_sprite
+from icons.svg_cache import invalidate_svg
+from icons.versioning import bump_version, category_version_key
 from django.conf import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+_DONE = object()
+
+
+def prefetch(iterable, depth):
+    """
+    Consume ``iterable`` on a background thread, keeping up to ``depth``
+    items ready, so S3 listing overlaps with database writes
+    """
+    items = queue.Queue(maxsize=depth)
+
+    def producer():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(_DONE)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
 class Command(BaseCommand):
     help = 'Load icons from S3 bucket into the database'
 
@@ -22,6 +65,43 @@ class Command(BaseCommand):
             help='Prefix/folder path in S3 bucket (e.g., "icons/")',
             default='icons/'
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of icons written per bulk_create/bulk_update transaction',
+            default=500
+        )
+        parser.add_argument(
+            '--since',
+            type=str,
+            help='Only process objects modified at or after this ISO date/time (e.g. "2025-06-01")',
+            required=False
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Skip objects whose ETag matches the one stored on the icon',
+        )
+        parser.add_argument(
+            '--prune',
+            action='store_true',
+            help='Delete icons under the prefix whose S3 objects no longer exist',
+        )
+        parser.add_argument(
+            '--no-optimize',
+            action='store_true',
+            help='Store new and changed objects as they are instead of minifying them and writing compressed variants',
+        )
+        parser.add_argument(
+            '--no-sprites',
+            action='store_true',
+            help='Do not rebuild the sprites of categories that changed',
+        )
+        parser.add_argument(
+            '--no-prerender',
+            action='store_true',
+            help='Do not refresh the static pages in ICON_PRERENDER["OUTPUT_DIR"]',
+        )
 
     def generate_tags(self, icon_name, category):
         base_tags = icon_name.split("-")
@@ -36,76 +116,247 @@ class Command(BaseCommand):
             'social': ['network', 'share'],
             'status': ['notification', 'state']
         }.get(category, [])
-        return ",".join(set(base_tags + category_tags + extra_tags))
+        return ",".join(sorted(set(base_tags + category_tags + extra_tags)))
+
+    def parse_since(self, value):
+        if not value:
+            return None
+        try:
+            since = datetime.fromisoformat(value)
+        except ValueError:
+            raise CommandError(f"Invalid --since value: {value}")
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return since
+
+    def list_objects(self, s3, bucket_name, prefix):
+        """
+        Yield the S3 objects under the prefix, one listing page at a time
+        """
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            yield from page.get('Contents', [])
+
+    def get_category(self, name):
+        category = self.categories.get(name)
+        if category is None:
+            category, created = IconCategory.objects.get_or_create(name=name)
+            self.categories[name] = category
+            if created:
+                self.stdout.write(f"Created new category: {name}")
+        return category
+
+    def write_batch(self, batch):
+        """
+        Create or update a batch of parsed objects in one transaction
+        """
+        # Later keys win when two of them map to the same category and name
+        batch = list({(item['category'].id, item['name']): item for item in batch}.values())
+
+        names_by_category = {}
+        for item in batch:
+            names_by_category.setdefault(item['category'].id, []).append(item['name'])
+
+        existing = {}
+        for category_id, names in names_by_category.items():
+            for icon in Icon.objects.filter(category_id=category_id, name__in=names):
+                existing[(category_id, icon.name)] = icon
+
+        to_create, to_update, stale_keys, new_content = [], [], [], []
+        for item in batch:
+            icon = existing.get((item['category'].id, item['name']))
+            if icon is None:
+                icon = Icon(name=item['name'], category=item['category'])
+                to_create.append(icon)
+                new_content.append((icon, item))
+            elif (
+                (icon.tags, icon.etag, icon.source_key) == (item['tags'], item['etag'], item['key'])
+                and icon.blob_id is not None
+            ):
+                self.stats['unchanged'] += 1
+                continue
+            else:
+                if icon.etag != item['etag'] or icon.blob_id is None:
+                    stale_keys.append(key_from_url(icon.s3_url))
+                    new_content.append((icon, item))
+                to_update.append(icon)
+            icon.tags = item['tags']
+            icon.source_key = item['key']
+            icon.etag = item['etag']
+
+        stored, uploaded = self.store_blobs(new_content)
+
+        with transaction.atomic():
+            released = attach_blobs(self.ingest_pool, get_s3_client(), stored, uploaded)
+            Icon.objects.bulk_create(to_create, batch_size=self.batch_size)
+            Icon.objects.bulk_update(
+                to_update, ['tags', 's3_url', 'etag', 'source_key', 'blob'] + INGEST_FIELDS,
+                batch_size=self.batch_size,
+            )
+            # Only now that no icon points at the old blobs can they go
+            release_many(released)
+            index_icons(to_create + to_update)
+            # Pruned icons bump their category versions through Icon signals
+            for category_id in {icon.category_id for icon in to_create + to_update}:
+                bump_version(category_version_key(category_id))
+
+        for key in stale_keys:
+            invalidate_svg(key)
+
+        self.touched_categories.update(icon.category_id for icon in to_create + to_update)
+        self.stats['created'] += len(to_create)
+        self.stats['updated'] += len(to_update)
+        if self.verbosity >= 2:
+            for icon in to_create:
+                self.stdout.write(f"Icon '{icon.name}' created in category '{icon.category.name}'")
+            for icon in to_update:
+                self.stdout.write(f"Icon '{icon.name}' updated in category '{icon.category.name}'")
+
+    def store_blobs(self, pending):
+        """
+        Read, optimize and store the source objects of new and changed
+        icons as blobs. Icons whose source cannot be read keep their
+        current URL (new ones point at the source) and are retried on the
+        next run.
+        """
+        s3 = get_s3_client()
+        stored = read_objects(self.ingest_pool, s3, [(icon, item['key']) for icon, item in pending], self.optimize)
+        read = {id(icon) for icon, _, _, _ in stored}
+        for icon, item in pending:
+            if id(icon) not in read:
+                icon.etag = ''
+                if not icon.blob_id:
+                    icon.s3_url = item['s3_url']
+        uploaded = put_missing_blobs(self.ingest_pool, s3, stored)
+        if self.optimize:
+            self.stats['optimized'] += len(stored)
+            self.saved_bytes += sum(icon.original_bytes - icon.stored_bytes for icon, _, _, _ in stored)
+        self.stats['blobs'] += len(uploaded)
+        return stored, uploaded
+
+    def prune(self, prefix, seen_keys):
+        """
+        Delete icons imported from under the prefix whose source keys were
+        not listed
+        """
+        rows = Icon.objects.filter(
+            Q(source_key__startswith=prefix) | Q(source_key='', s3_url__startswith=prefix)
+        ).values_list('id', 'source_key', 's3_url')
+        vanished = [
+            icon_id
+            for icon_id, source_key, s3_url in rows.iterator()
+            if (source_key or key_from_url(s3_url)) not in seen_keys
+        ]
+        for start in range(0, len(vanished), self.batch_size):
+            with transaction.atomic():
+                Icon.objects.filter(id__in=vanished[start:start + self.batch_size]).delete()
+        self.stats['pruned'] = len(vanished)
 
     def handle(self, *args, **options):
         bucket_name = options.get('bucket') or settings.AWS_STORAGE_BUCKET_NAME
         prefix = options.get('prefix')
+        self.batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+        since = self.parse_since(options.get('since'))
+        incremental = options['incremental']
 
         if not bucket_name:
             self.stdout.write(self.style.ERROR('No bucket name provided and AWS_STORAGE_BUCKET_NAME not set in settings'))
             return
 
-        # Initialize S3 client
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME
-        )
+        s3 = get_s3_client()
 
         self.stdout.write(f"Scanning S3 bucket: {bucket_name} with prefix: {prefix}")
 
-        # List all objects in the bucket with the given prefix
-        paginator = s3.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        started = time.perf_counter()
+        self.stats = {
+            'listed': 0, 'skipped': 0, 'unchanged': 0, 'created': 0, 'updated': 0, 'pruned': 0, 'optimized': 0,
+            'blobs': 0,
+        }
+        self.bucket_name = bucket_name
+        self.optimize = settings.ICON_INGEST['ENABLED'] and not options['no_optimize']
+        self.ingest_pool = ThreadPoolExecutor(max_workers=settings.ICON_INGEST['WORKERS'], thread_name_prefix='ingest')
+        self.saved_bytes = 0
+        self.categories = {category.name: category for category in IconCategory.objects.all()}
+        self.touched_categories = set()
+        known_etags = {}
+        if incremental:
+            known_etags = {
+                source_key or key_from_url(s3_url): etag
+                for source_key, s3_url, etag in Icon.objects.exclude(etag='').values_list('source_key', 's3_url', 'etag').iterator()
+            }
+
+        seen_keys = set()
+        batch = []
+        for obj in prefetch(self.list_objects(s3, bucket_name, prefix), depth=4000):
+            key = obj['Key']
+            self.stats['listed'] += 1
 
-        # Track categories we've seen
-        categories = set()
+            # Skip if not an SVG file, or one of our own blobs
+            if not key.endswith('.svg') or is_blob_key(key):
+                continue
 
-        for page in pages:
-            if 'Contents' not in page:
+            # Extract category and filename from the key
+            # Expected format: icons/category/filename.svg
+            parts = key.split('/')
+            if len(parts) < 3:
                 continue
 
-            for obj in page['Contents']:
-                key = obj['Key']
-                
-                # Skip if not an SVG file
-                if not key.endswith('.svg'):
-                    continue
-
-                # Extract category and filename from the key
-                # Expected format: icons/category/filename.svg
-                parts = key.split('/')
-                if len(parts) < 3:
-                    continue
-
-                category_name = parts[1]
-                filename = parts[-1]
-                name = filename.replace('.svg', '')
-
-                # Create or get category
-                category, created = IconCategory.objects.get_or_create(name=category_name)
-                if created:
-                    self.stdout.write(f"Created new category: {category_name}")
-
-                # Generate S3 URL
-                s3_url = f"https://{settings.AWS_S3_CUSTOM_DOMAIN}/{key}"
-                
-                # Generate tags
-                tags = self.generate_tags(name, category_name)
-
-                # Create or update icon
-                icon, created = Icon.objects.update_or_create(
-                    name=name,
-                    category=category,
-                    defaults={
-                        'tags': tags,
-                        's3_url': s3_url
-                    }
-                )
-
-                status = 'created' if created else 'updated'
-                self.stdout.write(f"Icon '{name}' {status} in category '{category_name}'")
-
-        self.stdout.write(self.style.SUCCESS("Successfully processed all icons from S3")) 
\ No newline at end of file
+            seen_keys.add(key)
+            etag = obj.get('ETag', '').strip('"')
+            if since and obj['LastModified'] < since:
+                self.stats['skipped'] += 1
+                continue
+            if incremental and known_etags.get(key) == etag:
+                self.stats['skipped'] += 1
+                continue
+
+            category_name = parts[1]
+            name = parts[-1].replace('.svg', '')
+            batch.append({
+                'key': key,
+                'name': name,
+                'category': self.get_category(category_name),
+                'tags': self.generate_tags(name, category_name),
+                's3_url': key,
+                'etag': etag,
+            })
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch)
+                batch = []
+
+        if batch:
+            self.write_batch(batch)
+        self.ingest_pool.shutdown()
+
+        if options['prune']:
+            self.prune(prefix, seen_keys)
+
+        # Pruned icons rebuild their sprites through Icon signals
+        if not options['no_sprites']:
+            for category in IconCategory.objects.filter(id__in=self.touched_categories):
+                build_sprite(category)
+
+        # After the sprites, which pages embed the URLs of
+        if self.stats['created'] or self.stats['updated'] or self.stats['pruned']:
+            bump_version()
+
+        if prerender_enabled() and not options['no_prerender']:
+            rendered = prerender()
+            self.stdout.write("Prerendered {rendered} pages: {written} files written, {removed} removed".format(**rendered))
+
+        elapsed = time.perf_counter() - started
+        rate = self.stats['listed'] / elapsed if elapsed else 0
+        self.stdout.write(
+            "Listed {listed}, created {created}, updated {updated}, unchanged {unchanged}, "
+            "skipped {skipped}, pruned {pruned}, new blobs {blobs}".format(**self.stats)
+        )
+        if self.optimize:
+            totals = ingest_totals()
+            self.stdout.write(
+                f"Optimized {self.stats['optimized']} objects, saving {self.saved_bytes} bytes; "
+                f"all icons: {totals['original']} bytes uploaded, {totals['stored']} stored, "
+                f"{totals['gzip']} gzip, {totals['br']} brotli"
+            )
+        self.stdout.write(f"Finished in {elapsed:.2f}s ({rate:.0f} objects/s)")
+        self.stdout.write(self.style.SUCCESS("Successfully processed all icons from S3"))
@@ -0,0 +1,96 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from icons.blobs import attach_blobs, is_blob_key, put_missing_blobs, read_objects, release_many
+from icons.cdn import key_from_url
+from icons.ingest import INGEST_FIELDS
+from icons.models import Icon
+from icons.s3 import get_s3_client
+from icons.svg_cache import invalidate_svg
+from icons.versioning import bump_version, category_version_key
+
+
+class Command(BaseCommand):
+    help = 'Move icons that still point at their own S3 object over to content-addressed blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Parallel S3 reads and writes (defaults to ICON_BLOBS["MIGRATE_WORKERS"])',
+            required=False
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Icons moved per transaction; bounds how many files are held in memory',
+            default=200
+        )
+        parser.add_argument(
+            '--no-optimize',
+            action='store_true',
+            help='Store the objects as they are instead of minifying them and writing compressed variants',
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or settings.ICON_BLOBS['MIGRATE_WORKERS']
+        batch_size = options['batch_size']
+        optimize = settings.ICON_INGEST['ENABLED'] and not options['no_optimize']
+        s3 = get_s3_client()
+
+        started = time.perf_counter()
+        moved = failed = uploaded_total = 0
+        categories = set()
+        last_id = 0
+        # Keyset pagination, so the command can be stopped and rerun; icons
+        # that failed are only retried by the next run
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='blobs') as pool:
+            while True:
+                icons = list(
+                    Icon.objects.filter(blob__isnull=True, id__gt=last_id)
+                    .exclude(s3_url='')
+                    .order_by('id')[:batch_size]
+                )
+                if not icons:
+                    break
+                last_id = icons[-1].id
+
+                entries = [(icon, key_from_url(icon.s3_url)) for icon in icons]
+                entries = [(icon, key) for icon, key in entries if not is_blob_key(key)]
+                stored = read_objects(pool, s3, entries, optimize)
+                uploaded = put_missing_blobs(pool, s3, stored)
+                old_keys = {id(icon): key for icon, key in entries}
+
+                with transaction.atomic():
+                    released = attach_blobs(pool, s3, stored, uploaded)
+                    for icon, _, _, _ in stored:
+                        # The old object stays as the icon's source: the
+                        # importer maps it back to this icon, and deleting
+                        # the icon deletes it as before
+                        icon.source_key = old_keys[id(icon)]
+                    Icon.objects.bulk_update(
+                        [icon for icon, _, _, _ in stored], ['blob', 's3_url', 'source_key'] + INGEST_FIELDS,
+                    )
+                    release_many(released)
+                    for category_id in {icon.category_id for icon, _, _, _ in stored}:
+                        bump_version(category_version_key(category_id))
+
+                for icon, key in entries:
+                    invalidate_svg(key)
+                categories.update(icon.category_id for icon, _, _, _ in stored)
+                moved += len(stored)
+                failed += len(entries) - len(stored)
+                uploaded_total += len(uploaded)
+                if options['verbosity'] >= 2:
+                    self.stdout.write(f"Moved {moved} icons so far")
+
+        if moved:
+            bump_version()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Moved {moved} icons to {uploaded_total} new blobs in {elapsed:.2f}s "
+            f"({moved - uploaded_total} deduplicated), {failed} failed"
+        )
+        self.stdout.write(self.style.SUCCESS("Finished moving icons to content-addressed storage"))
@@ -0,0 +1,41 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from icons.prerender import PrerenderError, prerender
+
+
+class Command(BaseCommand):
+    help = 'Write the home page, category pages and catalogue JSON as static files for nginx'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output-dir',
+            type=str,
+            help='Directory to write to (defaults to ICON_PRERENDER["OUTPUT_DIR"])',
+            required=False
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Render every page even if the catalogue has not changed since the last run',
+        )
+
+    def handle(self, *args, **options):
+        output_dir = options.get('output_dir') or settings.ICON_PRERENDER['OUTPUT_DIR']
+        if not output_dir:
+            raise CommandError('No --output-dir given and ICON_PRERENDER["OUTPUT_DIR"] is not set')
+
+        started = time.perf_counter()
+        try:
+            stats = prerender(output_dir, force=options['force'])
+        except PrerenderError as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - started
+
+        if not stats['rendered']:
+            self.stdout.write(self.style.SUCCESS(f"Catalogue unchanged, nothing to render ({elapsed:.2f}s)"))
+            return
+        self.stdout.write(
+            "Rendered {rendered} pages: {written} files written, {unchanged} unchanged, {removed} removed".format(**stats)
+        )
+        self.stdout.write(self.style.SUCCESS(f"Prerendered into {output_dir} in {elapsed:.2f}s"))
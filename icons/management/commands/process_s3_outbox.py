@@ -0,0 +1,62 @@
+import signal
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from icons.models import S3OutboxEntry
+from icons.outbox import make_pool, run_once
+
+
+class Command(BaseCommand):
+    help = 'Apply queued S3 uploads and deletes from the icon outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the entries that are due now and exit instead of polling',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Entries claimed per batch (defaults to ICON_OUTBOX["BATCH_SIZE"])',
+            required=False
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Make entries that ran out of attempts pending again before starting',
+        )
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        if options['retry_failed']:
+            count = S3OutboxEntry.objects.filter(status=S3OutboxEntry.FAILED).update(
+                status=S3OutboxEntry.PENDING, attempts=0, available_at=timezone.now(),
+            )
+            self.stdout.write(f"Requeued {count} failed entries")
+
+        applied_total = failed_total = 0
+        with make_pool() as pool:
+            while not self.stopping:
+                close_old_connections()
+                applied, failed = run_once(pool, options.get('batch_size'))
+                applied_total += applied
+                failed_total += failed
+                if applied or failed:
+                    if options['verbosity'] >= 2:
+                        self.stdout.write(f"Applied {applied}, failed {failed}")
+                    continue
+                if options['once']:
+                    break
+                time.sleep(settings.ICON_OUTBOX['POLL_INTERVAL'])
+
+        self.stdout.write(self.style.SUCCESS(f"Applied {applied_total} outbox entries, {failed_total} failures"))
+
+    def stop(self, signum, frame):
+        # Finish the current batch, then exit
+        self.stopping = True
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from icons.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the icon search index from the Icon table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of index rows written per bulk insert',
+            default=1000
+        )
+
+    def handle(self, *args, **options):
+        total = rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} search terms"))
@@ -0,0 +1,239 @@
+import time
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from icons.blobs import key_digest, release_many
+from icons.models import Blob, Icon, S3OutboxEntry
+from icons.outbox import DELETE_BATCH_SIZE, delete_keys
+from icons.reconcile import ReconcileError, bucket_keys, canonical_rows, merge_join, noncanonical_rows
+from icons.versioning import bump_version, category_version_key
+
+
+class Command(BaseCommand):
+    help = 'Compare the S3 bucket with the Icon table and optionally repair the differences'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prefix',
+            type=str,
+            help='Prefix/folder path in S3 bucket (defaults to the blob prefix, ICON_BLOBS["PREFIX"])',
+            required=False
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Rows fetched per chunk and fixes applied per batch',
+            default=DELETE_BATCH_SIZE
+        )
+        parser.add_argument(
+            '--fix-urls',
+            action='store_true',
+            help='Rewrite empty s3_urls, and URLs stored by earlier versions, to the bare key they refer to',
+        )
+        parser.add_argument(
+            '--delete-orphans',
+            action='store_true',
+            help='Delete icon objects no row points to',
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            help='Seconds an object must have existed before it counts as orphaned; '
+                 'imports upload blobs before committing their rows',
+            default=24 * 60 * 60,
+        )
+        parser.add_argument(
+            '--delete-dangling',
+            action='store_true',
+            help='Delete rows whose object is missing from the bucket',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.batch_size = options['batch_size']
+        self.delete_orphans = options['delete_orphans']
+        self.delete_dangling = options['delete_dangling']
+        self.cutoff = timezone.now() - timedelta(seconds=options['min_age'])
+        # Objects under icons/ are import sources, referenced through
+        # Icon.source_key rather than s3_url
+        prefix = options['prefix'] or settings.ICON_BLOBS['PREFIX']
+
+        started = time.perf_counter()
+        self.stats = {
+            'listed': 0, 'rows': 0, 'orphaned': 0, 'dangling': 0, 'mismatched': 0, 'in_flight': 0, 'recent': 0,
+            'blobs': 0, 'deleted_objects': 0, 'deleted_rows': 0, 'fixed_urls': 0,
+        }
+        self.touched_categories = set()
+
+        self.check_urls(prefix, options['fix_urls'])
+        if self.delete_orphans and self.stats['mismatched'] > self.stats['fixed_urls']:
+            # Their objects would look orphaned to the merge join below
+            self.stdout.write(self.style.WARNING(
+                "Not deleting orphans while rows with non-canonical URLs remain; run with --fix-urls"
+            ))
+            self.delete_orphans = False
+
+        orphans, dangling, variants = [], [], []
+        keys = bucket_keys(prefix, variants)
+        try:
+            for key, modified, icon_ids in merge_join(keys, canonical_rows(prefix, self.batch_size)):
+                self.stats['listed'] += modified is not None
+                self.stats['rows'] += len(icon_ids)
+                if not icon_ids:
+                    orphans.append((key, modified))
+                    if len(orphans) >= self.batch_size:
+                        self.handle_orphans(orphans)
+                        orphans = []
+                elif modified is None:
+                    dangling.append((key, icon_ids))
+                    if len(dangling) >= self.batch_size:
+                        self.handle_dangling(dangling)
+                        dangling = []
+                if len(variants) >= self.batch_size:
+                    self.handle_variants(variants)
+                    variants.clear()
+        except ReconcileError as e:
+            raise CommandError(str(e))
+        self.handle_orphans(orphans)
+        self.handle_dangling(dangling)
+        self.handle_variants(variants)
+
+        # bulk_update skips the signals that bump versions; deletes do not
+        if self.stats['fixed_urls']:
+            for category_id in self.touched_categories:
+                bump_version(category_version_key(category_id))
+            bump_version()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            "Listed {listed} objects and {rows} rows: {orphaned} orphaned objects, {dangling} dangling rows, "
+            "{mismatched} mismatched URLs, {in_flight} with outbox entries pending, {blobs} unreferenced blobs "
+            "still tracked, {recent} too recent to judge".format(**self.stats)
+        )
+        self.stdout.write(
+            "Deleted {deleted_objects} objects and {deleted_rows} rows, fixed {fixed_urls} URLs".format(**self.stats)
+        )
+        self.stdout.write(self.style.SUCCESS(f"Reconciled in {elapsed:.2f}s"))
+
+    def in_flight(self, keys):
+        """
+        Keys with a queued outbox upload or delete; the worker has yet to
+        make the bucket match the table for them
+        """
+        pending = set(S3OutboxEntry.objects.filter(key__in=keys).values_list('key', flat=True))
+        self.stats['in_flight'] += len(pending)
+        return pending
+
+    def check_urls(self, prefix, fix):
+        """
+        Report rows whose s3_url is not the bare key of their icon, and
+        rewrite them in bulk when ``fix`` is set
+        """
+        batch = []
+        for icon_id, category_id, url, key in noncanonical_rows(prefix, self.batch_size):
+            self.stats['mismatched'] += 1
+            if self.verbosity >= 2:
+                self.stdout.write(f"Mismatched URL on icon {icon_id}: {url or '(empty)'} -> {key}")
+            if fix:
+                batch.append(Icon(id=icon_id, category_id=category_id, s3_url=key))
+                if len(batch) >= self.batch_size:
+                    self.fix_urls(batch)
+                    batch = []
+        if batch:
+            self.fix_urls(batch)
+
+    def fix_urls(self, icons):
+        Icon.objects.bulk_update(icons, ['s3_url'])
+        self.touched_categories.update(icon.category_id for icon in icons)
+        self.stats['fixed_urls'] += len(icons)
+
+    def settled(self, objects):
+        """
+        Drop ``(key, last modified, ...)`` objects written after the
+        cutoff: an import uploads its blobs before it commits the rows
+        pointing at them
+        """
+        old = [obj for obj in objects if obj[-1] < self.cutoff]
+        self.stats['recent'] += len(objects) - len(old)
+        return old
+
+    def tracked(self, keys):
+        """
+        Blob keys among ``keys`` that still have a Blob row, e.g. taken by
+        an upload whose icon is not committed yet
+        """
+        digests = {key_digest(key): key for key in keys}
+        digests.pop(None, None)
+        return {digests[digest] for digest in Blob.objects.filter(sha256__in=digests).values_list('sha256', flat=True)}
+
+    def handle_orphans(self, objects):
+        if not objects:
+            return
+        keys = [key for key, modified in self.settled(objects)]
+        pending = self.in_flight(keys)
+        tracked = self.tracked(keys)
+        self.stats['blobs'] += len(tracked)
+        keys = [key for key in keys if key not in pending and key not in tracked]
+        self.stats['orphaned'] += len(keys)
+        if self.verbosity >= 2:
+            for key in keys:
+                self.stdout.write(f"Orphaned object: {key}")
+        if self.delete_orphans:
+            self.delete_objects(keys)
+
+    def handle_variants(self, variants):
+        """
+        Report and delete the compressed variants of icon keys that no row
+        or blob refers to, whether or not the icon object itself is left
+        """
+        variants = self.settled(variants)
+        if not variants:
+            return
+        bases = {base for key, base, modified in variants}
+        referenced = self.tracked(bases)
+        referenced.update(Icon.objects.filter(s3_url__in=bases).values_list('s3_url', flat=True))
+        pending = self.in_flight([key for key, base, modified in variants] + list(bases))
+        keys = [
+            key for key, base, modified in variants
+            if base not in referenced and key not in pending and base not in pending
+        ]
+        self.stats['orphaned'] += len(keys)
+        if self.verbosity >= 2:
+            for key in keys:
+                self.stdout.write(f"Orphaned variant: {key}")
+        if self.delete_orphans:
+            self.delete_objects(keys)
+
+    def delete_objects(self, keys):
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            errors = delete_keys(batch)
+            for key, error in errors.items():
+                self.stderr.write(f"Could not delete {key}: {error}")
+            self.stats['deleted_objects'] += len(batch) - len(errors)
+
+    def handle_dangling(self, dangling):
+        if not dangling:
+            return
+        pending = self.in_flight([key for key, icon_ids in dangling])
+        icon_ids = [icon_id for key, ids in dangling if key not in pending for icon_id in ids]
+        self.stats['dangling'] += len(icon_ids)
+        if self.verbosity >= 2:
+            for key, ids in dangling:
+                if key not in pending:
+                    self.stdout.write(f"Dangling row(s) {', '.join(map(str, ids))}: {key} is not in the bucket")
+        if not self.delete_dangling or not icon_ids:
+            return
+        with transaction.atomic():
+            icons = Icon.objects.filter(id__in=icon_ids)
+            blobs = Counter(icons.exclude(blob=None).values_list('blob_id', flat=True))
+            # The objects are already gone and the import sources may not
+            # be, so detach the rows from both first: post_delete then
+            # releases no blob and queues no S3 deletes
+            icons.update(s3_url='', source_key='', blob=None)
+            icons.delete()
+            release_many(blobs, delete_objects=False)
+        self.stats['deleted_rows'] += len(icon_ids)
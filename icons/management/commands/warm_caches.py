@@ -0,0 +1,37 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from icons.warmup import STEPS, warm_caches
+
+
+class Command(BaseCommand):
+    help = 'Build the catalogue snapshot, autocomplete index, hot SVG cache entries and page fragments ahead of traffic'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--steps',
+            type=str,
+            help=f"Comma-separated steps to run, of {', '.join(STEPS)}",
+            default=','.join(STEPS)
+        )
+        parser.add_argument(
+            '--svg-icons',
+            type=int,
+            help='Number of most downloaded icons to read into the SVG cache (defaults to ICON_STARTUP["WARM_SVG_ICONS"])',
+            required=False
+        )
+
+    def handle(self, *args, **options):
+        steps = [step for step in options['steps'].split(',') if step]
+        unknown = set(steps) - set(STEPS)
+        if unknown:
+            raise CommandError(f"Unknown steps: {', '.join(sorted(unknown))}")
+
+        started = time.perf_counter()
+        results = warm_caches(steps, svg_limit=options.get('svg_icons'))
+        failed = [step for step, (count, _) in results.items() if count is None]
+        for step, (count, elapsed) in results.items():
+            status = 'failed' if count is None else f"{count} items"
+            self.stdout.write(f"{step:<13} {status:>12}  {elapsed:.2f}s")
+        if failed:
+            raise CommandError(f"Warming up failed for: {', '.join(failed)}")
+        self.stdout.write(self.style.SUCCESS(f"Caches warmed in {time.perf_counter() - started:.2f}s"))
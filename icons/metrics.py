@@ -0,0 +1,517 @@
+"""
+In-process metrics exposed in the Prometheus text format at /metrics.
+
+Metrics are plain counters and histograms guarded by a lock, so
+recording one costs a dict lookup and a few additions. Each worker
+process writes its values to a file of its own in ICON_METRICS['DIR']
+every FLUSH_SECONDS, and whichever worker answers a scrape sums the
+files of all of them, so totals do not depend on the worker Prometheus
+happens to reach. Counters of workers that have exited are folded into
+an archive file and keep counting; their gauges are dropped. Without a
+DIR each worker reports only its own values.
+"""
+import atexit
+import bisect
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+ARCHIVE_FILE = 'archive.json'
+# Seconds before a lock left by a process that died holding it is broken
+LOCK_TIMEOUT = 10
+
+_registry = []
+_collectors = []
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs
+    )
+    return '{%s}' % ','.join(escaped)
+
+
+class Counter:
+    kind = 'counter'
+    buckets = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.reset()
+        _registry.append(self)
+
+    def reset(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        if _flusher is None:
+            _start_flusher()
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        """
+        ``{((label, value), ...): value}`` of every label combination
+        """
+        with self._lock:
+            return {tuple(zip(self.labels, labels)): value for labels, value in self._values.items()}
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.reset()
+        _registry.append(self)
+
+    def reset(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        if _flusher is None:
+            _start_flusher()
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one count per bucket plus +Inf, then the running sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def values(self):
+        """
+        ``{((label, value), ...): [count per bucket..., sum]}``
+        """
+        with self._lock:
+            return {tuple(zip(self.labels, labels)): list(counts) for labels, counts in self._values.items()}
+
+
+def collector(func):
+    """
+    Register a function yielding ``(name, kind, documentation, samples)``
+    computed at scrape time, where samples are ``(labels dict, value)``
+    """
+    _collectors.append(func)
+    return func
+
+
+REQUEST_LATENCY = Histogram(
+    'icons_http_request_duration_seconds', 'Time spent in the view and middleware', ['view', 'method', 'status'],
+)
+RESPONSE_SIZE = Histogram(
+    'icons_http_response_size_bytes', 'Size of non-streaming response bodies', ['view'], buckets=SIZE_BUCKETS,
+)
+DB_QUERIES = Counter('icons_db_queries_total', 'Database queries run by requests', ['view'])
+DB_QUERY_TIME = Counter('icons_db_query_seconds_total', 'Time requests spent in database queries', ['view'])
+S3_LATENCY = Histogram('icons_s3_request_duration_seconds', 'S3 API call latency', ['operation', 'status'])
+S3_BYTES = Counter('icons_s3_response_bytes_total', 'Body bytes returned by S3 API calls', ['operation'])
+CACHE_REQUESTS = Counter('icons_cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+INGEST_BYTES = Counter(
+    'icons_ingest_bytes_total', 'Icon bytes handled by the ingest pipeline: original, stored and per encoding', ['stage'],
+)
+
+
+@collector
+def svg_cache_metrics():
+    from .svg_cache import get_svg_cache
+
+    stats = get_svg_cache().stats()
+    yield (
+        'icons_svg_cache_hits_total', 'counter', 'SVG cache hits by tier',
+        [({'tier': tier}, count) for tier, count in sorted(stats['hits'].items())],
+    )
+    yield 'icons_svg_cache_misses_total', 'counter', 'SVG cache misses', [({}, stats['misses'])]
+    yield 'icons_svg_cache_evictions_total', 'counter', 'SVG cache LRU evictions', [({}, stats['evictions'])]
+    yield 'icons_svg_cache_entries', 'gauge', 'Entries in the in-process SVG cache', [({}, stats['entries'])]
+    yield 'icons_svg_cache_bytes', 'gauge', 'Bytes held by the in-process SVG cache', [({}, stats['bytes'])]
+
+
+def collect():
+    """
+    This process's metrics as ``{name: [kind, documentation, buckets,
+    {labels: value}]}``
+    """
+    metrics = {}
+    for metric in _registry:
+        metrics[metric.name] = [metric.kind, metric.documentation, metric.buckets, metric.values()]
+    for func in _collectors:
+        for name, kind, documentation, samples in func():
+            values = {tuple((label, str(value)) for label, value in labels.items()): value for labels, value in samples}
+            metrics[name] = [kind, documentation, None, values]
+    return metrics
+
+
+def merge(snapshots):
+    """
+    Sum ``(metrics, alive)`` pairs as returned by collect(), leaving out
+    the gauges of processes that are not alive
+    """
+    merged = {}
+    for metrics, alive in snapshots:
+        for name, (kind, documentation, buckets, values) in metrics.items():
+            if kind == 'gauge' and not alive:
+                continue
+            totals = merged.setdefault(name, [kind, documentation, buckets, {}])[3]
+            for labels, value in values.items():
+                current = totals.get(labels)
+                if current is None:
+                    totals[labels] = list(value) if kind == 'histogram' else value
+                elif kind == 'histogram':
+                    totals[labels] = [a + b for a, b in zip(current, value)]
+                else:
+                    totals[labels] = current + value
+    return merged
+
+
+def _dump(metrics):
+    return {
+        name: [kind, documentation, buckets, [[list(labels), value] for labels, value in values.items()]]
+        for name, (kind, documentation, buckets, values) in metrics.items()
+    }
+
+
+def _load(path):
+    with open(path) as f:
+        data = json.load(f)
+    return {
+        name: [kind, documentation, tuple(buckets) if buckets else None, {
+            tuple(tuple(pair) for pair in labels): value for labels, value in values
+        }]
+        for name, (kind, documentation, buckets, values) in data.items()
+    }
+
+
+def _write(directory, name, metrics):
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_dump(metrics), f)
+        os.replace(tmp, os.path.join(directory, name))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _is_alive(pid, path):
+    if os.name == 'nt':
+        # os.kill() would terminate the process there; a live worker's
+        # flusher rewrites its file every FLUSH_SECONDS
+        return time.time() - os.path.getmtime(path) < 3 * settings.ICON_METRICS['FLUSH_SECONDS']
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+_process_file = None
+
+
+def _process_file_name():
+    # The random part keeps a later process that reuses the pid from
+    # overwriting the values of the one that exited
+    global _process_file
+    if _process_file is None:
+        _process_file = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+    return _process_file
+
+
+def flush():
+    """
+    Write this process's values to ICON_METRICS['DIR'], if set
+    """
+    directory = settings.ICON_METRICS['DIR']
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    _write(directory, _process_file_name(), collect())
+
+
+def _flush_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except Exception as e:
+            print(f"Could not write metrics: {e}", file=sys.stderr)
+
+
+def _start_flusher():
+    # Started lazily by the first recorded value, so a forked worker gets
+    # its own thread and the master process none
+    global _flusher
+    with _flusher_lock:
+        if _flusher is not None:
+            return
+        if not settings.ICON_METRICS['DIR']:
+            _flusher = False
+            return
+        _flusher = threading.Thread(
+            target=_flush_forever, args=(settings.ICON_METRICS['FLUSH_SECONDS'],), name='metrics-flusher', daemon=True,
+        )
+        _flusher.start()
+        atexit.register(flush)
+
+
+def reset():
+    """
+    Zero every metric of this process, e.g. after a benchmark recorded
+    synthetic traffic
+    """
+    for metric in _registry:
+        metric.reset()
+
+
+def _after_fork():
+    # The child starts from zero: whatever the parent recorded is in the
+    # parent's file
+    global _flusher, _flusher_lock, _process_file
+    _flusher = None
+    _flusher_lock = threading.Lock()
+    _process_file = None
+    reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+@contextmanager
+def _directory_lock(directory):
+    # A lock file created exclusively, as in icons/snapshot.py, since
+    # fcntl is POSIX only
+    path = os.path.join(directory, '.lock')
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) >= LOCK_TIMEOUT:
+                    os.unlink(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+
+def collect_all(directory):
+    """
+    Read the values every process has written to ``directory`` as
+    ``(metrics, alive)`` pairs, first folding the counters and histograms
+    of processes that have exited into the archive
+    """
+    with _directory_lock(directory):
+        archive_path = os.path.join(directory, ARCHIVE_FILE)
+        archive = _load(archive_path) if os.path.exists(archive_path) else {}
+        snapshots, dead = [], []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json') or name == ARCHIVE_FILE:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                metrics = _load(path)
+            except (OSError, ValueError):
+                continue
+            pid = int(name.split('-', 1)[0])
+            if _is_alive(pid, path):
+                snapshots.append((metrics, True))
+            else:
+                dead.append((path, metrics))
+        if dead:
+            archive = merge([(archive, False)] + [(metrics, False) for _, metrics in dead])
+            _write(directory, ARCHIVE_FILE, archive)
+            for path, _ in dead:
+                os.unlink(path)
+    return [(archive, False)] + snapshots
+
+
+def render(metrics):
+    """
+    Format metrics as returned by collect() or merge() in the Prometheus
+    text exposition format
+    """
+    lines = []
+    for name, (kind, documentation, buckets, values) in metrics.items():
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(values.items()):
+            if kind != 'histogram':
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(tuple(buckets) + ('+Inf',), value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+def render_metrics():
+    """
+    Return every metric in the Prometheus text exposition format, summed
+    over all worker processes when ICON_METRICS['DIR'] is set
+    """
+    directory = settings.ICON_METRICS['DIR']
+    if not directory:
+        return render(collect())
+    flush()
+    return render(merge(collect_all(directory)))
+
+
+class QueryTimer:
+    """
+    ``connection.execute_wrapper`` hook counting queries and their time
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+
+
+def instrument_s3_client(client):
+    """
+    Record latency, status and response size of every call made through
+    a boto3 S3 client, using botocore's event hooks
+    """
+    def before_call(context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        started = context.get('metrics_started')
+        if started is None:
+            return
+        status = getattr(http_response, 'status_code', 0)
+        S3_LATENCY.observe(time.perf_counter() - started, model.name, str(status))
+        # Bodies are streamed, so read the size from the headers
+        size = (getattr(http_response, 'headers', None) or {}).get('content-length')
+        if size:
+            S3_BYTES.inc(model.name, amount=int(size))
+
+    client.meta.events.register('before-call.s3', before_call)
+    client.meta.events.register('after-call.s3', after_call)
+    return client
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests. One daemon thread samples the
+    stacks of every registered request thread each ``interval`` seconds;
+    when a request ends after ``threshold`` seconds its samples are
+    written in the collapsed ``frame;frame;frame count`` format read by
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, threshold, interval, directory):
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _ensure_sampler(self):
+        # Started lazily, so a forked worker gets its own sampler thread
+        if self._sampler is None or not self._sampler.is_alive():
+            self._sampler = threading.Thread(target=self._sample_forever, name='slow-request-profiler', daemon=True)
+            self._sampler.start()
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                threads = dict(self._threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for thread_id, stacks in threads.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        with self._lock:
+            self._ensure_sampler()
+            self._threads[threading.get_ident()] = StackCounter()
+
+    def stop(self, elapsed, label):
+        with self._lock:
+            stacks = self._threads.pop(threading.get_ident(), None)
+        if not stacks or elapsed < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{label}.folded")
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    """
+    Return the slow request profiler, or None unless
+    ICON_METRICS['PROFILE_SLOW_MS'] is set
+    """
+    global _profiler
+    options = settings.ICON_METRICS
+    if not options.get('PROFILE_SLOW_MS'):
+        return None
+    if _profiler is None:
+        with _profiler_lock:
+            if _profiler is None:
+                _profiler = SlowRequestProfiler(
+                    threshold=options['PROFILE_SLOW_MS'] / 1000,
+                    interval=options['PROFILE_INTERVAL_MS'] / 1000,
+                    directory=options['PROFILE_DIR'],
+                )
+    return _profiler
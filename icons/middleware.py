@@ -0,0 +1,75 @@
+import logging
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+from .metrics import DB_QUERIES, DB_QUERY_TIME, QueryTimer, REQUEST_LATENCY, RESPONSE_SIZE, get_profiler
+
+logger = logging.getLogger(__name__)
+
+
+def view_label(request):
+    match = request.resolver_match
+    return match.view_name if match else 'unresolved'
+
+
+class MetricsMiddleware:
+    """
+    Record latency, status, response size and database usage of every
+    request, labelled by URL name. Streaming responses are timed up to the
+    point the view returns them.
+
+    Under ASGI the middleware stays async so async views are not pushed
+    onto a thread. Database queries there run in sync_to_async threads on
+    other connections, so they are not counted, and the slow request
+    profiler (which samples one thread per request) is not used.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.ICON_METRICS['ENABLED']:
+            return self.get_response(request)
+
+        profiler = get_profiler()
+        if profiler is not None:
+            profiler.start()
+        timer = QueryTimer()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(timer):
+                response = self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler is not None:
+                path = profiler.stop(elapsed, view_label(request).replace(':', '-'))
+                if path:
+                    logger.warning("Slow request %s took %.0f ms, stacks written to %s", request.path, elapsed * 1000, path)
+
+        view = self.record(request, response, elapsed)
+        DB_QUERIES.inc(view, amount=timer.count)
+        DB_QUERY_TIME.inc(view, amount=timer.seconds)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.ICON_METRICS['ENABLED']:
+            return await self.get_response(request)
+
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - started)
+        return response
+
+    def record(self, request, response, elapsed):
+        view = view_label(request)
+        REQUEST_LATENCY.observe(elapsed, view, request.method, str(response.status_code))
+        if not response.streaming:
+            RESPONSE_SIZE.observe(len(response.content), view)
+        return view
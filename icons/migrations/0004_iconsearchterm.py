@@ -0,0 +1,68 @@
+# Generated by Django 4.2.30 on 2026-10-17 11:04
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Frozen copy of the tokenizer in icons.search as it stood when this
+# migration was written, so later changes to search do not alter what the
+# backfill produces
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+BATCH_SIZE = 1000
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def terms_for(name, tags):
+    terms = set()
+    full_name = '-'.join(tokenize(name))
+    if full_name:
+        terms.add((full_name, 'name'))
+    for word in tokenize(name):
+        terms.add((word, 'word'))
+    for tag in (tags or '').split(','):
+        for word in tokenize(tag):
+            terms.add((word, 'tag'))
+    return terms
+
+
+def build_search_index(apps, schema_editor):
+    Icon = apps.get_model('icons', 'Icon')
+    IconSearchTerm = apps.get_model('icons', 'IconSearchTerm')
+    batch = []
+    for icon_id, name, tags in Icon.objects.values_list('id', 'name', 'tags').iterator(chunk_size=BATCH_SIZE):
+        for term, field in terms_for(name, tags):
+            batch.append(IconSearchTerm(icon_id=icon_id, term=term[:100], field=field))
+        if len(batch) >= BATCH_SIZE:
+            IconSearchTerm.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        IconSearchTerm.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0003_alter_icon_s3_url'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IconSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100)),
+                ('field', models.CharField(choices=[('name', 'Name'), ('word', 'Name word'), ('tag', 'Tag')], max_length=4)),
+                ('icon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='icons.icon')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'field', 'icon'], name='icons_search_term_idx')],
+            },
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0005_catalogueversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icon',
+            name='etag',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
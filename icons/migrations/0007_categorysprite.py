@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-17 11:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0006_icon_etag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategorySprite',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField()),
+                ('digest', models.CharField(max_length=64)),
+                ('icon_count', models.PositiveIntegerField(default=0)),
+                ('built_at', models.DateTimeField(auto_now=True)),
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sprite', to='icons.iconcategory')),
+            ],
+        ),
+    ]
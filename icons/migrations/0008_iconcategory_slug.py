@@ -0,0 +1,60 @@
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils.text import slugify
+
+
+def backfill_slugs(apps, schema_editor):
+    IconCategory = apps.get_model('icons', 'IconCategory')
+    taken = set()
+    for category in IconCategory.objects.order_by('id'):
+        base = slugify(category.name) or 'category'
+        slug, suffix = base, 2
+        while slug in taken:
+            slug = f"{base}-{suffix}"
+            suffix += 1
+        taken.add(slug)
+        category.slug = slug
+        category.save(update_fields=['slug'])
+
+
+def check_duplicate_icons(apps, schema_editor):
+    # The unique constraint added next cannot be created while two icons
+    # share a (category, name) pair. Deleting rows here would bypass the
+    # signals that clean up their S3 objects, so stop and let them be
+    # resolved first, e.g. in the admin.
+    Icon = apps.get_model('icons', 'Icon')
+    duplicates = list(
+        Icon.objects.values('category_id', 'name')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .order_by('category_id', 'name')
+    )
+    if not duplicates:
+        return
+    lines = []
+    for row in duplicates[:50]:
+        ids = Icon.objects.filter(category_id=row['category_id'], name=row['name']).order_by('id').values_list('id', flat=True)
+        lines.append(f"  category {row['category_id']}, name {row['name']!r}: icons {', '.join(map(str, ids))}")
+    if len(duplicates) > 50:
+        lines.append(f"  ... and {len(duplicates) - 50} more")
+    raise RuntimeError(
+        f"{len(duplicates)} (category, name) pairs are used by more than one icon. Delete or rename the "
+        "extra icons, then run the migration again:\n" + '\n'.join(lines)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0007_categorysprite'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='iconcategory',
+            name='slug',
+            field=models.SlugField(max_length=110, null=True),
+        ),
+        migrations.RunPython(backfill_slugs, migrations.RunPython.noop),
+        migrations.RunPython(check_duplicate_icons, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0008_iconcategory_slug'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='iconcategory',
+            name='slug',
+            field=models.SlugField(blank=True, max_length=110, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='icon',
+            constraint=models.UniqueConstraint(fields=('category', 'name'), name='icons_icon_category_name_uniq'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0009_slug_unique_icon_category_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='S3OutboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('upload', 'Upload'), ('delete', 'Delete')], max_length=6)),
+                ('key', models.CharField(max_length=1024)),
+                ('source', models.CharField(blank=True, max_length=1024)),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('failed', 'Failed')], default='pending', max_length=7)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at', 'id'], name='icons_outbox_due_idx')],
+            },
+        ),
+    ]
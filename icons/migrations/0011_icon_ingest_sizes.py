@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-17 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0010_s3outboxentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icon',
+            name='original_bytes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='icon',
+            name='stored_bytes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='icon',
+            name='gzip_bytes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='icon',
+            name='brotli_bytes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='s3outboxentry',
+            name='content_encoding',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+    ]
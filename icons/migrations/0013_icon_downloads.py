@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0012_blob_icon_blob_icon_source_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='icon',
+            name='downloads',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
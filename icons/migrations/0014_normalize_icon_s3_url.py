@@ -0,0 +1,55 @@
+import re
+from urllib.parse import unquote, urlsplit
+
+from django.conf import settings
+from django.db import migrations
+
+# Path-style S3 URLs carry the bucket as the first path segment
+PATH_STYLE_HOST_RE = re.compile(r'^s3([.-][a-z0-9-]+)*\.amazonaws\.com$')
+
+
+def stored_key(s3_url, category_name, name):
+    # The object key of a stored URL (custom domain, debug proxy, virtual-
+    # hosted or path-style S3) or of a row without one. Kept here rather
+    # than imported from icons.cdn so the migration does not change with it.
+    if not s3_url:
+        return f"icons/{category_name}/{name}.svg"
+    parts = urlsplit(s3_url)
+    path = unquote(parts.path).lstrip('/')
+    if not parts.netloc:
+        return path
+    if PATH_STYLE_HOST_RE.match(parts.netloc.lower()):
+        prefix = getattr(settings, 'AWS_STORAGE_BUCKET_NAME', '') or ''
+    else:
+        prefix = getattr(settings, 'S3_PROXY_PREFIX', '').strip('/')
+    if prefix and path.startswith(prefix + '/'):
+        path = path[len(prefix) + 1:]
+    return path
+
+
+def normalize_s3_urls(apps, schema_editor):
+    # Store every s3_url as the bare object key, so rows do not depend on
+    # the domain or DEBUG setting they were written under
+    Icon = apps.get_model('icons', 'Icon')
+    rows = Icon.objects.order_by('id').values_list('id', 's3_url', 'name', 'category__name')
+    batch = []
+    for icon_id, s3_url, name, category_name in rows.iterator(chunk_size=2000):
+        key = stored_key(s3_url, category_name, name)
+        if key != s3_url:
+            batch.append(Icon(id=icon_id, s3_url=key))
+        if len(batch) >= 500:
+            Icon.objects.bulk_update(batch, ['s3_url'])
+            batch = []
+    if batch:
+        Icon.objects.bulk_update(batch, ['s3_url'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0013_icon_downloads'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_s3_urls, migrations.RunPython.noop),
+    ]
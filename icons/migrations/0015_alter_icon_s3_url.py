@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('icons', '0014_normalize_icon_s3_url'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='icon',
+            name='s3_url',
+            field=models.CharField(blank=True, max_length=1024),
+        ),
+    ]
@@ -1,39 +1,202 @@
-from django.db import models
-from django.conf import settings
-from .utils import upload_icon_to_s3, delete_icon_from_s3
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+from .cdn import icon_key, key_from_url, public_url
+from .utils import upload_icon_to_s3
+
+def unique_category_slug(name, exclude_id=None):
+    """
+    Slugify a category name, adding a numeric suffix if the slug is taken
+    """
+    base = slugify(name) or 'category'
+    slug, suffix = base, 2
+    taken = IconCategory.objects.exclude(id=exclude_id)
+    while taken.filter(slug=slug).exists():
+        slug = f"{base}-{suffix}"
+        suffix += 1
+    return slug
+
 
 class IconCategory(models.Model):
     name = models.CharField(max_length=100)
+    slug = models.SlugField(max_length=110, unique=True, blank=True)
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if not self.slug:
+            self.slug = unique_category_slug(self.name, exclude_id=self.id)
+        super().save(*args, **kwargs)
+
+class Blob(models.Model):
+    """
+    Content-addressed icon file stored once under blobs/sha256/ and shared
+    by every icon with the same bytes. ``refcount`` counts those icons; the
+    last one to let go deletes the object (see icons/blobs.py).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.refcount} refs)"
+
+    @property
+    def key(self):
+        from .blobs import blob_key
+        return blob_key(self.sha256)
+
+
 class Icon(models.Model):
     name = models.CharField(max_length=100)
     category = models.ForeignKey(IconCategory, on_delete=models.CASCADE)
     tags = models.CharField(max_length=250, blank=True)
-    s3_url = models.URLField(blank=True)
+    s3_url = models.CharField(max_length=1024, blank=True)  # object key, named for the URLs it once held
     file = models.FileField(upload_to='icons/', null=True, blank=True)
+    etag = models.CharField(max_length=64, blank=True)  # S3 ETag seen by the importer
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT, related_name='icons')
+    source_key = models.CharField(max_length=1024, blank=True)  # object under icons/ it was imported from
+    # Byte counts recorded by the ingest pipeline (see icons/ingest.py)
+    original_bytes = models.PositiveIntegerField(null=True, blank=True)
+    stored_bytes = models.PositiveIntegerField(null=True, blank=True)
+    gzip_bytes = models.PositiveIntegerField(null=True, blank=True)
+    brotli_bytes = models.PositiveIntegerField(null=True, blank=True)
+    # Buffered per worker and flushed in batches (see icons/autocomplete.py)
+    downloads = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also serves the importer's (category, name) lookups and the
+            # API's (category, name) keyset ordering
+            models.UniqueConstraint(fields=['category', 'name'], name='icons_icon_category_name_uniq'),
+        ]
 
     def __str__(self):
         return self.name
 
-    def get_s3_url(self):
-        if settings.DEBUG:
-            return f"http://{settings.AWS_S3_CUSTOM_DOMAIN}{settings.S3_PROXY_PREFIX}/icons/{self.category.name}/{self.name}.svg"
-        return f"https://{settings.AWS_S3_CUSTOM_DOMAIN}/icons/{self.category.name}/{self.name}.svg"
+    @property
+    def key(self):
+        return icon_key(self.s3_url, self.category.name, self.name)
+
+    @property
+    def url(self):
+        """
+        Where browsers fetch the icon from (see icons/cdn.py)
+        """
+        return public_url(self.key)
 
     def save(self, *args, **kwargs):
-        if self.file and not self.s3_url:
-            # Upload to S3 and get URL
-            self.s3_url = upload_icon_to_s3(self.file, self.category.name)
-        elif not self.s3_url:
-            # Generate S3 URL if not present
-            self.s3_url = self.get_s3_url()
-        super().save(*args, **kwargs)
+        # The S3 upload is queued in the same transaction as the row and
+        # applied by the process_s3_outbox worker
+        with transaction.atomic():
+            if self.file and not self.s3_url:
+                self.s3_url, self.blob, sizes = upload_icon_to_s3(self.file)
+                for field, value in sizes.items():
+                    setattr(self, field, value)
+            elif not self.s3_url:
+                self.s3_url = self.key
+            super().save(*args, **kwargs)
 
-    def delete(self, *args, **kwargs):
-        # Delete from S3 before deleting the model
+            # Keep the search index in step with the name and tags
+            from .search import index_icon
+            index_icon(self)
+        self.invalidate_cached_svg()
+
+    def invalidate_cached_svg(self):
+        from .svg_cache import invalidate_svg
         if self.s3_url:
-            delete_icon_from_s3(self.s3_url)
-        super().delete(*args, **kwargs)
+            invalidate_svg(key_from_url(self.s3_url))
+
+
+class IconSearchTerm(models.Model):
+    """
+    Inverted index row mapping a normalized search term to an icon
+    """
+    NAME = 'name'
+    WORD = 'word'
+    TAG = 'tag'
+    FIELD_CHOICES = [
+        (NAME, 'Name'),
+        (WORD, 'Name word'),
+        (TAG, 'Tag'),
+    ]
+
+    icon = models.ForeignKey(Icon, on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=100)
+    field = models.CharField(max_length=4, choices=FIELD_CHOICES)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'field', 'icon'], name='icons_search_term_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.term} ({self.field})"
+
+
+class CatalogueVersion(models.Model):
+    """
+    Monotonic version stamp bumped whenever the catalogue changes; used to
+    build validators and cache keys for rendered pages
+    """
+    key = models.CharField(max_length=100, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} v{self.version}"
+
+
+class CategorySprite(models.Model):
+    """
+    Pre-built <symbol> sprite holding every icon of a category
+    """
+    category = models.OneToOneField(IconCategory, on_delete=models.CASCADE, related_name='sprite')
+    content = models.TextField()
+    digest = models.CharField(max_length=64)
+    icon_count = models.PositiveIntegerField(default=0)
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.category.name} sprite ({self.digest[:12]})"
+
+
+class S3OutboxEntry(models.Model):
+    """
+    S3 side effect of an icon write, committed with the write itself and
+    applied later by the process_s3_outbox worker
+    """
+    UPLOAD = 'upload'
+    DELETE = 'delete'
+    ACTION_CHOICES = [
+        (UPLOAD, 'Upload'),
+        (DELETE, 'Delete'),
+    ]
+    PENDING = 'pending'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (FAILED, 'Failed'),
+    ]
+
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+    key = models.CharField(max_length=1024)
+    source = models.CharField(max_length=1024, blank=True)  # spooled file to upload
+    content_type = models.CharField(max_length=100, blank=True)
+    content_encoding = models.CharField(max_length=20, blank=True)
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # When the entry is next due; pushed forward while a worker holds it
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at', 'id'], name='icons_outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.action} {self.key} ({self.status})"
@@ -0,0 +1,295 @@
+"""
+Durable outbox for the S3 side effects of icon writes.
+
+Model writes only spool the file and insert an S3OutboxEntry in their
+own transaction. The process_s3_outbox worker claims due entries under a
+lease, runs uploads concurrently (multipart for large files), batches
+deletes into DeleteObjects calls and retries failures with exponential
+backoff. An entry is deleted once S3 has applied it.
+
+Where no such worker runs, e.g. a single web service with a disk of its
+own, ICON_OUTBOX['INLINE'] has the process that queued the entries apply
+them in a background thread once its transaction commits; retries then
+wait for the next write from that process.
+"""
+import logging
+import os
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+from .blobs import is_blob_key
+from .models import S3OutboxEntry
+from .s3 import get_s3_client
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_SIZE = 1000  # the DeleteObjects limit
+
+_inline = ThreadPoolExecutor(max_workers=1, thread_name_prefix='s3-outbox-inline')
+_inline_pool = None
+_inline_scheduled = False
+_inline_lock = threading.Lock()
+
+
+def enqueue_upload(key, file, content_type='', content_encoding=''):
+    """
+    Spool ``file`` to disk chunk by chunk and queue it for upload to
+    ``key``. Call inside the transaction that writes the model.
+    """
+    options = settings.ICON_OUTBOX
+    os.makedirs(options['SPOOL_DIR'], exist_ok=True)
+    fd, source = tempfile.mkstemp(dir=options['SPOOL_DIR'], suffix=os.path.splitext(key)[1])
+    with os.fdopen(fd, 'wb') as spool:
+        for chunk in file.chunks():
+            spool.write(chunk)
+    entry = S3OutboxEntry.objects.create(
+        action=S3OutboxEntry.UPLOAD, key=key, source=source,
+        content_type=content_type, content_encoding=content_encoding,
+    )
+    schedule_inline()
+    return entry
+
+
+def spooled_sources(keys):
+    """
+    ``{key: spooled file}`` of the uploads still queued for ``keys``, the
+    latest one per key
+    """
+    return dict(
+        S3OutboxEntry.objects.filter(action=S3OutboxEntry.UPLOAD, key__in=keys)
+        .order_by('id').values_list('key', 'source')
+    )
+
+
+def enqueue_delete(key):
+    entry = S3OutboxEntry.objects.create(action=S3OutboxEntry.DELETE, key=key)
+    schedule_inline()
+    return entry
+
+
+def enqueue_deletes(keys):
+    entries = S3OutboxEntry.objects.bulk_create([S3OutboxEntry(action=S3OutboxEntry.DELETE, key=key) for key in keys])
+    if entries:
+        schedule_inline()
+    return entries
+
+
+def schedule_inline():
+    """
+    With ICON_OUTBOX['INLINE'], drain the outbox in this process once the
+    current transaction commits
+    """
+    if settings.ICON_OUTBOX['INLINE']:
+        transaction.on_commit(_submit_inline)
+
+
+def _submit_inline():
+    global _inline_scheduled
+    with _inline_lock:
+        if _inline_scheduled:
+            return
+        _inline_scheduled = True
+    _inline.submit(_drain_inline)
+
+
+def _drain_inline():
+    global _inline_pool, _inline_scheduled
+    with _inline_lock:
+        # Entries committed from here on schedule another pass
+        _inline_scheduled = False
+        if _inline_pool is None:
+            _inline_pool = make_pool()
+    try:
+        while any(run_once(_inline_pool)):
+            pass
+    except Exception:
+        logger.exception("Applying the S3 outbox inline failed")
+    finally:
+        connections.close_all()
+
+
+def backoff(attempts):
+    """
+    Seconds to wait before retry number ``attempts``: exponential with
+    full jitter, capped at BACKOFF_MAX
+    """
+    options = settings.ICON_OUTBOX
+    ceiling = min(options['BACKOFF_MAX'], options['BACKOFF_BASE'] * 2 ** (attempts - 1))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def claim(limit):
+    """
+    Lease up to ``limit`` due entries to this worker. A worker that dies
+    holding a lease just lets it expire and another one picks it up.
+
+    Operations on a key are applied in the order they were queued: an
+    entry is left alone while an earlier one for its key is still pending
+    outside this batch, leased to another worker or waiting to be
+    retried, so e.g. a retried blob delete cannot remove an object that
+    was uploaded again after it.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            S3OutboxEntry.objects.select_for_update(skip_locked=True)
+            .filter(status=S3OutboxEntry.PENDING, available_at__lte=now)
+            .order_by('id')[:limit]
+        )
+        if entries:
+            blocked_after = {}
+            earlier = (
+                S3OutboxEntry.objects.filter(status=S3OutboxEntry.PENDING, key__in={entry.key for entry in entries})
+                .exclude(id__in=[entry.id for entry in entries])
+                .filter(id__lt=entries[-1].id)
+                .values_list('key', 'id')
+            )
+            for key, entry_id in earlier:
+                blocked_after[key] = min(entry_id, blocked_after.get(key, entry_id))
+            entries = [entry for entry in entries if entry.id < blocked_after.get(entry.key, entry.id + 1)]
+        if entries:
+            S3OutboxEntry.objects.filter(id__in=[entry.id for entry in entries]).update(
+                available_at=now + timedelta(seconds=settings.ICON_OUTBOX['LEASE'])
+            )
+    return entries
+
+
+def coalesce(entries):
+    """
+    Split claimed entries into the ones to apply and the ones superseded
+    by a later entry for the same key (only the last write to a key
+    matters)
+    """
+    latest = {}
+    superseded = []
+    for entry in entries:
+        previous = latest.get(entry.key)
+        if previous is not None:
+            superseded.append(previous)
+        latest[entry.key] = entry
+    return list(latest.values()), superseded
+
+
+def upload(entry, transfer_config):
+    """
+    Upload a spooled file with boto3's managed transfer, which streams it
+    from disk and switches to a concurrent multipart upload above the
+    multipart threshold
+    """
+    extra_args = {}
+    if entry.content_type:
+        extra_args['ContentType'] = entry.content_type
+    if entry.content_encoding:
+        extra_args['ContentEncoding'] = entry.content_encoding
+    if is_blob_key(entry.key):
+        extra_args['CacheControl'] = settings.ICON_CACHE_CONTROL['blob']
+    get_s3_client().upload_file(
+        entry.source, settings.AWS_STORAGE_BUCKET_NAME, entry.key,
+        ExtraArgs=extra_args or None, Config=transfer_config,
+    )
+
+
+def delete_keys(keys):
+    """
+    Delete up to 1000 keys in one DeleteObjects call and return
+    ``{key: error message}`` for the ones S3 could not delete
+    """
+    response = get_s3_client().delete_objects(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+    )
+    return {error['Key']: f"{error.get('Code')}: {error.get('Message')}" for error in response.get('Errors', [])}
+
+
+def discard_source(entry):
+    if entry.source:
+        try:
+            os.unlink(entry.source)
+        except FileNotFoundError:
+            pass
+
+
+def complete(entries):
+    S3OutboxEntry.objects.filter(id__in=[entry.id for entry in entries]).delete()
+    for entry in entries:
+        if entry.action == S3OutboxEntry.UPLOAD:
+            discard_source(entry)
+
+
+def fail(entry, error):
+    entry.attempts += 1
+    entry.last_error = str(error)
+    if entry.attempts >= settings.ICON_OUTBOX['MAX_ATTEMPTS']:
+        entry.status = S3OutboxEntry.FAILED
+        logger.error("Giving up on S3 %s of %s after %d attempts: %s", entry.action, entry.key, entry.attempts, error)
+    else:
+        entry.available_at = timezone.now() + timedelta(seconds=backoff(entry.attempts))
+        logger.warning("S3 %s of %s failed (attempt %d): %s", entry.action, entry.key, entry.attempts, error)
+    entry.save(update_fields=['attempts', 'last_error', 'status', 'available_at'])
+
+
+def process(entries, pool):
+    """
+    Apply claimed entries and return ``(applied, failed)`` counts
+    """
+    entries, superseded = coalesce(entries)
+    complete(superseded)
+
+    applied, failed = len(superseded), 0
+    uploads = [entry for entry in entries if entry.action == S3OutboxEntry.UPLOAD]
+    deletes = [entry for entry in entries if entry.action == S3OutboxEntry.DELETE]
+
+    from boto3.s3.transfer import TransferConfig
+
+    options = settings.ICON_OUTBOX
+    transfer_config = TransferConfig(
+        multipart_threshold=options['MULTIPART_THRESHOLD'],
+        multipart_chunksize=options['MULTIPART_CHUNKSIZE'],
+        max_concurrency=options['MULTIPART_CONCURRENCY'],
+    )
+    futures = {pool.submit(upload, entry, transfer_config): entry for entry in uploads}
+
+    for start in range(0, len(deletes), DELETE_BATCH_SIZE):
+        batch = deletes[start:start + DELETE_BATCH_SIZE]
+        try:
+            errors = delete_keys([entry.key for entry in batch])
+        except Exception as e:
+            errors = {entry.key: e for entry in batch}
+        for entry in batch:
+            if entry.key in errors:
+                fail(entry, errors[entry.key])
+                failed += 1
+        done = [entry for entry in batch if entry.key not in errors]
+        complete(done)
+        applied += len(done)
+
+    for future, entry in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            fail(entry, e)
+            failed += 1
+        else:
+            complete([entry])
+            applied += 1
+
+    return applied, failed
+
+
+def run_once(pool, limit=None):
+    """
+    Claim and apply one batch; returns ``(applied, failed)``
+    """
+    entries = claim(limit or settings.ICON_OUTBOX['BATCH_SIZE'])
+    if not entries:
+        return 0, 0
+    return process(entries, pool)
+
+
+def make_pool():
+    return ThreadPoolExecutor(max_workers=settings.ICON_OUTBOX['UPLOAD_WORKERS'], thread_name_prefix='s3-outbox')
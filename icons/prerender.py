@@ -0,0 +1,224 @@
+"""
+Static copies of the catalogue pages for nginx to serve from disk.
+
+The home page, every category page and /catalogue.json are rendered by
+their own views and written under ICON_PRERENDER['OUTPUT_DIR'] at the
+path of their URL (``/icons/<slug>/`` becomes ``icons/<slug>/index.html``),
+each with a ``.gz`` sibling for gzip_static. Files are replaced
+atomically and only when their bytes changed, so nginx never serves a
+half-written page and unchanged pages keep their mtime. A manifest
+records the catalogue version and sprites the files were rendered from;
+runs that find both unchanged do nothing.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections, transaction
+from django.http import HttpRequest
+from django.urls import resolve, reverse
+from .cdn import public_hosts
+from .models import CategorySprite, IconCategory
+from .versioning import get_version
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = '.prerender.json'
+
+# Runs triggered by model changes happen here, one at a time, outside the
+# request that caused them
+_runs = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prerender')
+_pending = False
+_pending_lock = threading.Lock()
+# Keeps a triggered run and the management command in one process apart
+_run_lock = threading.Lock()
+
+
+class PrerenderError(Exception):
+    pass
+
+
+def prerender_enabled():
+    return bool(settings.ICON_PRERENDER['OUTPUT_DIR'])
+
+
+def catalogue_stamp():
+    """
+    Identify what the pages are rendered from: the catalogue version, the
+    current sprite of every category and the hosts icon URLs point at
+    """
+    version, _ = get_version()
+    sprites = CategorySprite.objects.order_by('category_id').values_list('category_id', 'digest')
+    parts = [f"{category_id}:{digest}" for category_id, digest in sprites] + list(public_hosts())
+    digest = hashlib.sha256(';'.join(parts).encode())
+    return f"{version}:{digest.hexdigest()[:16]}"
+
+
+def page_paths():
+    paths = [reverse('home'), reverse('catalogue_json')]
+    for slug in IconCategory.objects.order_by('id').values_list('slug', flat=True):
+        paths.append(reverse('category_icons', args=[slug]))
+    return paths
+
+
+def file_path(path):
+    """
+    The file, relative to the output directory, that holds the page at a
+    URL path
+    """
+    relative = path.lstrip('/')
+    if not relative or relative.endswith('/'):
+        relative += 'index.html'
+    return relative
+
+
+def render_page(path):
+    """
+    Render the page at ``path`` through its view, as for an anonymous
+    GET without a query string
+    """
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = path
+    request.META = {'REQUEST_METHOD': 'GET', 'SERVER_NAME': 'prerender', 'SERVER_PORT': '80'}
+    match = resolve(path)
+    response = match.func(request, *match.args, **match.kwargs)
+    if response.status_code != 200:
+        raise PrerenderError(f"{path} answered {response.status_code}")
+    return response.content
+
+
+def write_if_changed(path, content):
+    """
+    Atomically replace ``path`` with ``content`` unless it already holds
+    exactly those bytes. Returns True if the file was written.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file private to us; nginx needs to read it
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return True
+
+
+def read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def remove_file(output_dir, relative):
+    path = os.path.join(output_dir, relative)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+    # Drop the directories of deleted categories once they are empty
+    directory = os.path.dirname(path)
+    while directory != output_dir and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+    return True
+
+
+def prerender(output_dir=None, force=False):
+    """
+    Bring the static copies in ``output_dir`` up to date with the
+    catalogue and return counts of pages rendered, files written, files
+    left unchanged and stale files removed. Without ``force`` nothing is
+    rendered if the catalogue has not changed since the last run.
+    """
+    output_dir = os.path.abspath(output_dir or settings.ICON_PRERENDER['OUTPUT_DIR'])
+    stats = {'rendered': 0, 'written': 0, 'unchanged': 0, 'removed': 0}
+    with _run_lock:
+        manifest = read_manifest(output_dir)
+        # Taken before rendering: a change that lands mid-run leaves a
+        # stale stamp behind, so the next run renders again
+        stamp = catalogue_stamp()
+        previous = manifest.get('files', [])
+        if (
+            not force and manifest.get('stamp') == stamp
+            and all(os.path.exists(os.path.join(output_dir, relative)) for relative in previous)
+        ):
+            return stats
+
+        files = []
+        level = settings.ICON_PRERENDER['GZIP_LEVEL']
+        for path in page_paths():
+            content = render_page(path)
+            stats['rendered'] += 1
+            relative = file_path(path)
+            # A fixed mtime keeps unchanged pages byte-identical
+            for name, data in ((relative, content), (relative + '.gz', gzip.compress(content, level, mtime=0))):
+                files.append(name)
+                if write_if_changed(os.path.join(output_dir, name), data):
+                    stats['written'] += 1
+                else:
+                    stats['unchanged'] += 1
+
+        current = set(files)
+        for relative in previous:
+            if relative not in current and remove_file(output_dir, relative):
+                stats['removed'] += 1
+
+        manifest = json.dumps({'stamp': stamp, 'files': files}, indent=1).encode()
+        write_if_changed(os.path.join(output_dir, MANIFEST), manifest)
+    logger.info(
+        "Prerendered %d pages into %s: %d files written, %d unchanged, %d removed",
+        stats['rendered'], output_dir, stats['written'], stats['unchanged'], stats['removed'],
+    )
+    return stats
+
+
+def schedule_prerender():
+    """
+    Refresh the static pages in the background once the current
+    transaction commits. Does nothing when ICON_PRERENDER['OUTPUT_DIR'] is
+    unset.
+    """
+    if prerender_enabled():
+        transaction.on_commit(_schedule)
+
+
+def _schedule():
+    global _pending
+    with _pending_lock:
+        if _pending:
+            return
+        _pending = True
+    _runs.submit(_run)
+
+
+def _run():
+    global _pending
+    with _pending_lock:
+        _pending = False
+    try:
+        prerender()
+    except Exception:
+        logger.exception("Prerendering the catalogue failed")
+    finally:
+        connections.close_all()
@@ -0,0 +1,138 @@
+"""
+Bucket/database reconciliation for the reconcile_icons command.
+
+Both sides are streamed in key order and merge-joined, so memory stays
+flat however many keys there are: S3 lists keys in UTF-8 byte order, and
+rows whose s3_url is the bare key, the canonical form, sort the same way
+when ordered by s3_url under a binary collation. Rows that are empty or
+still hold a URL are handled in a separate pass.
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Collate
+from .cdn import key_from_url, legacy_key
+from .ingest import VARIANT_SUFFIXES
+from .models import Icon
+from .s3 import get_s3_client
+
+# Collations that compare strings by code point / UTF-8 bytes, like S3
+BINARY_COLLATIONS = {
+    'sqlite': 'BINARY',
+    'postgresql': 'C',
+    'mysql': 'utf8mb4_bin',
+}
+
+
+# Rows whose s3_url is not a bare key
+NONCANONICAL = Q(s3_url='') | Q(s3_url__contains='://')
+
+
+class ReconcileError(Exception):
+    pass
+
+
+def is_icon_key(key):
+    # Blobs and import sources, not their .gz/.br variants
+    return key.endswith('.svg') and key.count('/') >= 2
+
+
+def variant_base(key):
+    """
+    The icon key a .gz/.br variant was compressed from, or None
+    """
+    for suffix in VARIANT_SUFFIXES.values():
+        if key.endswith(suffix) and is_icon_key(key[:-len(suffix)]):
+            return key[:-len(suffix)]
+    return None
+
+
+def bucket_keys(prefix, variants=None):
+    """
+    Yield ``(key, last modified)`` for the icon objects under ``prefix``,
+    one listing page at a time. Compressed variants do not sort with the
+    icon they belong to, so they are appended to ``variants`` as ``(key,
+    icon key, last modified)`` instead, when it is given.
+    """
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if is_icon_key(key):
+                yield key, obj['LastModified']
+            elif variants is not None:
+                base = variant_base(key)
+                if base is not None:
+                    variants.append((key, base, obj['LastModified']))
+
+
+def canonical_rows(prefix, chunk_size):
+    """
+    Yield ``(key, icon id)`` for rows with a canonical s3_url under
+    ``prefix``, in key order
+    """
+    collation = BINARY_COLLATIONS.get(connection.vendor)
+    order = Collate('s3_url', collation) if collation else 's3_url'
+    rows = (
+        Icon.objects.filter(s3_url__startswith=prefix)
+        .exclude(NONCANONICAL)
+        .order_by(order, 'id')
+        .values_list('s3_url', 'id')
+    )
+    return rows.iterator(chunk_size=chunk_size)
+
+
+def noncanonical_rows(prefix, chunk_size):
+    """
+    Yield ``(icon id, category id, s3_url, key)`` for rows under ``prefix``
+    whose s3_url is not canonical. Rows without a URL get the key the
+    importer would give them.
+    """
+    rows = (
+        Icon.objects.filter(NONCANONICAL)
+        .order_by('id')
+        .values_list('id', 'category_id', 's3_url', 'category__name', 'name')
+    )
+    for icon_id, category_id, url, category_name, name in rows.iterator(chunk_size=chunk_size):
+        key = key_from_url(url) if url else legacy_key(category_name, name)
+        if key.startswith(prefix):
+            yield icon_id, category_id, url, key
+
+
+def ascending(pairs, side, strict):
+    """
+    Pass ``(key, value)`` pairs through, failing loudly if they are out of
+    order, since a merge join over unsorted input silently reports
+    matching keys as missing
+    """
+    previous = None
+    for pair in pairs:
+        key = pair[0]
+        if previous is not None and (key < previous or (strict and key == previous)):
+            raise ReconcileError(f"{side} keys are not in byte order: {key!r} after {previous!r}")
+        previous = key
+        yield pair
+
+
+def merge_join(keys, rows):
+    """
+    Merge sorted ``(key, last modified)`` bucket keys with sorted ``(key,
+    icon id)`` rows and yield ``(key, last modified, icon ids)`` once per
+    distinct key: an orphaned object has no ids, a dangling key is not in
+    the bucket and has no last modified time
+    """
+    keys = ascending(keys, 'Bucket', strict=True)
+    rows = ascending(rows, 'Row', strict=False)
+    key = next(keys, None)
+    row = next(rows, None)
+    while key is not None or row is not None:
+        current = min(pair[0] for pair in (key, row) if pair is not None)
+        icon_ids = []
+        while row is not None and row[0] == current:
+            icon_ids.append(row[1])
+            row = next(rows, None)
+        modified = None
+        if key is not None and key[0] == current:
+            modified = key[1]
+            key = next(keys, None)
+        yield current, modified, icon_ids
@@ -0,0 +1,176 @@
+import hashlib
+import io
+import re
+import threading
+import xml.etree.ElementTree as ET
+from django.conf import settings
+from django.core.cache import caches
+from .metrics import CACHE_REQUESTS
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+ET.register_namespace('', SVG_NS)
+
+FORMATS = {
+    'svg': 'image/svg+xml',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+HEX_COLOR_RE = re.compile(r'^#?([0-9a-fA-F]{3}|[0-9a-fA-F]{6})$')
+STYLE_COLOR_RE = re.compile(r'(?P<prop>fill|stroke)\s*:\s*(?!none\b|url\()[^;]+')
+
+_render_slots = threading.BoundedSemaphore(settings.ICON_RENDER['MAX_CONCURRENCY'])
+
+
+class RenderError(Exception):
+    """
+    Raised for render parameters or sources we cannot handle; ``status``
+    is the HTTP status the view should answer with
+    """
+    status = 400
+
+
+class InvalidSVG(RenderError):
+    status = 422
+
+
+class RasterUnavailable(RenderError):
+    status = 501
+
+
+class RenderBusy(RenderError):
+    """
+    Raised when every render slot in this worker is taken
+    """
+    status = 503
+
+
+def _parse_color(value, name):
+    if not value or value in ('none', 'transparent'):
+        return None
+    match = HEX_COLOR_RE.match(value)
+    if not match:
+        raise RenderError(f"{name} must be a hex color like #4338ca")
+    return '#' + match.group(1).lower()
+
+
+def parse_render_spec(params):
+    """
+    Validate render parameters (color, size, background, format) from a
+    QueryDict or dict into a normalized spec dict
+    """
+    fmt = (params.get('format') or 'svg').lower()
+    if fmt not in FORMATS:
+        raise RenderError(f"format must be one of {', '.join(FORMATS)}")
+    size = params.get('size')
+    if size:
+        try:
+            size = int(size)
+        except ValueError:
+            raise RenderError("size must be an integer")
+        if not 1 <= size <= settings.ICON_RENDER['MAX_SIZE']:
+            raise RenderError(f"size must be between 1 and {settings.ICON_RENDER['MAX_SIZE']}")
+    elif fmt != 'svg':
+        size = settings.ICON_RENDER['DEFAULT_RASTER_SIZE']
+    return {
+        'color': _parse_color(params.get('color'), 'color'),
+        'size': size or None,
+        'background': _parse_color(params.get('background'), 'background'),
+        'format': fmt,
+    }
+
+
+def spec_digest(source_etag, spec):
+    """
+    Content address of a rendered variant: the source version plus every
+    parameter that affects the output
+    """
+    parts = [source_etag, spec['color'] or '', str(spec['size'] or ''), spec['background'] or '', spec['format']]
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+
+def transform_svg(content, spec):
+    """
+    Apply color, size and background to an SVG document at the XML level
+    """
+    try:
+        root = ET.fromstring(content)
+    except ET.ParseError as e:
+        raise InvalidSVG(f"Invalid SVG: {e}")
+
+    if spec['color']:
+        color = spec['color']
+        root.set('color', color)  # resolves currentColor
+        if 'fill' not in root.attrib:
+            root.set('fill', color)
+        for element in root.iter():
+            for attr in ('fill', 'stroke'):
+                value = element.get(attr)
+                if value and value not in ('none', 'currentColor') and not value.startswith('url('):
+                    element.set(attr, color)
+            style = element.get('style')
+            if style:
+                element.set('style', STYLE_COLOR_RE.sub(lambda m: f"{m.group('prop')}:{color}", style))
+
+    if spec['size']:
+        if 'viewBox' not in root.attrib:
+            width = re.match(r'[\d.]+', root.get('width', '24'))
+            height = re.match(r'[\d.]+', root.get('height', '24'))
+            if width and height:
+                root.set('viewBox', f"0 0 {width.group()} {height.group()}")
+        root.set('width', str(spec['size']))
+        root.set('height', str(spec['size']))
+
+    if spec['background']:
+        background = ET.Element(f'{{{SVG_NS}}}rect', {
+            'width': '100%', 'height': '100%', 'fill': spec['background'],
+        })
+        root.insert(0, background)
+
+    return ET.tostring(root, encoding='utf-8')
+
+
+def rasterize(svg, spec):
+    """
+    Turn an SVG document into PNG or WebP bytes. Needs the optional
+    cairosvg package (and the cairo system library).
+    """
+    try:
+        import cairosvg
+    except (ImportError, OSError):
+        raise RasterUnavailable("Raster formats require cairosvg and libcairo to be installed")
+
+    png = cairosvg.svg2png(bytestring=svg, output_width=spec['size'], output_height=spec['size'])
+    if spec['format'] == 'png':
+        return png
+
+    from PIL import Image
+    output = io.BytesIO()
+    Image.open(io.BytesIO(png)).save(output, format='WEBP', lossless=True)
+    return output.getvalue()
+
+
+def render_variant(source_etag, content, spec):
+    """
+    Return the rendered bytes for a spec, from the render cache when
+    possible. Rendering itself is limited to MAX_CONCURRENCY threads per
+    worker so CPU-heavy rasterization cannot starve the other views.
+    """
+    cache = caches[settings.ICON_RENDER['CACHE']]
+    cache_key = f"render:{spec_digest(source_etag, spec)}"
+    rendered = cache.get(cache_key)
+    CACHE_REQUESTS.inc('render', 'miss' if rendered is None else 'hit')
+    if rendered is not None:
+        return rendered
+
+    if not _render_slots.acquire(timeout=settings.ICON_RENDER['ACQUIRE_TIMEOUT']):
+        raise RenderBusy("All render slots are busy, try again shortly")
+    try:
+        rendered = transform_svg(content, spec)
+        if spec['format'] != 'svg':
+            rendered = rasterize(rendered, spec)
+    finally:
+        _render_slots.release()
+
+    cache.set(cache_key, rendered, timeout=settings.ICON_RENDER['TIMEOUT'])
+    return rendered
@@ -0,0 +1,59 @@
+import threading
+from django.conf import settings
+from .metrics import instrument_s3_client
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Return the process-wide S3 client, creating it on first use.
+    boto3 clients are thread-safe, so every request shares one client and
+    its connection pool instead of paying for a new TLS handshake. boto3
+    is imported here rather than at module load, where it would add a
+    tenth of a second to every worker's startup.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import boto3
+                from botocore.config import Config
+
+                _client = boto3.client(
+                    's3',
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    region_name=settings.AWS_S3_REGION_NAME,
+                    endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+                    config=Config(
+                        max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS,
+                        connect_timeout=settings.AWS_S3_CONNECT_TIMEOUT,
+                        read_timeout=settings.AWS_S3_READ_TIMEOUT,
+                        retries={'max_attempts': 3, 'mode': 'standard'},
+                        tcp_keepalive=True,
+                    ),
+                )
+                instrument_s3_client(_client)
+    return _client
+
+
+def reset_s3_client():
+    """
+    Drop the shared client, e.g. after forking or changing settings
+    """
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def stream_body(body, chunk_size=None):
+    """
+    Yield an S3 StreamingBody in chunks, releasing the pooled connection
+    once the response is finished or closed early
+    """
+    try:
+        yield from body.iter_chunks(chunk_size or settings.ICON_DOWNLOAD_CHUNK_SIZE)
+    finally:
+        body.close()
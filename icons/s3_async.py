@@ -0,0 +1,171 @@
+"""
+Non-blocking S3 access for the async views served under ASGI.
+
+Uses aiobotocore (an optional dependency, like cairosvg for rendering).
+Each event loop gets one shared client, and with it one connection pool,
+sized and timed out like the sync client in icons/s3.py.
+"""
+import asyncio
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .http import content_etag
+from .metrics import instrument_s3_client
+from .ingest import variant_key
+from .svg_cache import conditional_get, get_svg_cache, is_not_modified
+
+_clients = weakref.WeakKeyDictionary()
+_client_locks = weakref.WeakKeyDictionary()
+
+
+class AsyncS3Unavailable(RuntimeError):
+    pass
+
+
+async def get_async_s3_client():
+    """
+    Return the S3 client of the running event loop, creating it on first
+    use. The client is kept open for the life of the loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is not None:
+        return client
+
+    lock = _client_locks.setdefault(loop, asyncio.Lock())
+    async with lock:
+        client = _clients.get(loop)
+        if client is None:
+            try:
+                from aiobotocore.config import AioConfig
+                from aiobotocore.session import get_session
+            except ImportError:
+                raise AsyncS3Unavailable("Async S3 access requires aiobotocore to be installed")
+
+            context = get_session().create_client(
+                's3',
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region_name=settings.AWS_S3_REGION_NAME,
+                endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+                config=AioConfig(
+                    max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS,
+                    connect_timeout=settings.AWS_S3_CONNECT_TIMEOUT,
+                    read_timeout=settings.AWS_S3_READ_TIMEOUT,
+                    retries={'max_attempts': 3, 'mode': 'standard'},
+                    tcp_keepalive=True,
+                ),
+            )
+            client = await context.__aenter__()
+            instrument_s3_client(client)
+            _clients[loop] = client
+    return client
+
+
+async def close_async_s3_client():
+    """
+    Close the client of the running event loop, if it has one
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.__aexit__(None, None, None)
+
+
+async def svg_cache_call(method, *args):
+    """
+    Call an SVG cache method. Lookups that only touch the in-process tier
+    run inline; shared and disk tiers do blocking I/O, so they run in a
+    thread.
+    """
+    svg_cache = get_svg_cache()
+    if svg_cache.shared is None and svg_cache.disk is None:
+        return method(*args)
+    return await sync_to_async(method, thread_sensitive=False)(*args)
+
+
+async def read_object(client, key, **kwargs):
+    """
+    ``(content, S3 ETag)`` of an object
+    """
+    response = await client.get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=key, **kwargs)
+    async with response['Body'] as body:
+        return await body.read(), response.get('ETag', '')
+
+
+async def afetch_svg(key, timeout=None):
+    """
+    Async counterpart of ``svg_cache.fetch_svg``: return ``(etag, content)``
+    for an S3 key through the SVG cache, giving up after ``timeout``
+    seconds. S3 errors propagate.
+    """
+    svg_cache = get_svg_cache()
+    cached = await svg_cache_call(svg_cache.get, key)
+    if cached is not None:
+        return cached
+
+    client = await get_async_s3_client()
+    stale, conditional = await svg_cache_call(conditional_get, svg_cache, key)
+    try:
+        content, s3_etag = await asyncio.wait_for(
+            read_object(client, key, **conditional), timeout or settings.ICON_ASYNC['REQUEST_TIMEOUT'],
+        )
+    except Exception as e:
+        if stale is None or not is_not_modified(e):
+            raise
+        await svg_cache_call(svg_cache.revalidated, key, stale)
+        return stale[:2]
+    etag = content_etag(content)
+    if len(content) <= settings.ICON_SVG_CACHE['MAX_ITEM_BYTES']:
+        await svg_cache_call(svg_cache.set, key, etag, content, s3_etag)
+    return etag, content
+
+
+async def afetch_variant(key, encoding, timeout=None):
+    """
+    Async counterpart of ``svg_cache.fetch_variant``
+    """
+    svg_cache = get_svg_cache()
+    cache_key = variant_key(key, encoding)
+    if svg_cache.is_missing(cache_key):
+        return None
+    cached = await svg_cache_call(svg_cache.get, cache_key)
+    if cached is not None and cached[0]:
+        return cached
+
+    client = await get_async_s3_client()
+    stale, conditional = await svg_cache_call(conditional_get, svg_cache, cache_key)
+    try:
+        content, s3_etag = await asyncio.wait_for(
+            read_object(client, cache_key, **conditional), timeout or settings.ICON_ASYNC['REQUEST_TIMEOUT'],
+        )
+    except client.exceptions.NoSuchKey:
+        svg_cache.mark_missing(cache_key)
+        return None
+    except Exception as e:
+        if stale is None or not is_not_modified(e):
+            raise
+        await svg_cache_call(svg_cache.revalidated, cache_key, stale)
+        return stale[:2]
+    etag = content_etag(content)
+    if len(content) <= settings.ICON_SVG_CACHE['MAX_ITEM_BYTES']:
+        await svg_cache_call(svg_cache.set, cache_key, etag, content, s3_etag)
+    return etag, content
+
+
+async def astream_body(body, chunk_size=None, timeout=None):
+    """
+    Yield an aiobotocore StreamingBody in chunks. Only one chunk is read
+    ahead of the client: the ASGI server waits for each chunk to be sent
+    before asking for the next, so slow clients throttle the S3 read
+    instead of filling memory. Each read has its own timeout.
+    """
+    chunk_size = chunk_size or settings.ICON_DOWNLOAD_CHUNK_SIZE
+    timeout = timeout or settings.ICON_ASYNC['STREAM_TIMEOUT']
+    try:
+        while True:
+            chunk = await asyncio.wait_for(body.read(chunk_size), timeout)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        body.close()
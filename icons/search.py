@@ -0,0 +1,154 @@
+import re
+from django.db import transaction
+from django.db.models import Case, IntegerField, Max, Q, When
+from .models import Icon, IconSearchTerm
+
+# Ranking weights: an exact name beats a name prefix, which beats a tag
+EXACT_NAME = 3
+NAME_PREFIX = 2
+TAG = 1
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Upper bound for a prefix range scan; keeps the lookup on the B-tree index
+# on every backend instead of falling back to LIKE
+PREFIX_SENTINEL = '\uffff'
+
+
+def tokenize(text):
+    """
+    Split text into lowercase alphanumeric tokens
+    """
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def normalize_name(text):
+    """
+    Canonical form of an icon name, e.g. "Arrow Left" -> "arrow-left"
+    """
+    return '-'.join(tokenize(text))
+
+
+def terms_for(name, tags):
+    """
+    Return the (term, field) pairs to index for an icon name and its
+    comma separated tags
+    """
+    terms = set()
+    full_name = normalize_name(name)
+    if full_name:
+        terms.add((full_name, IconSearchTerm.NAME))
+    for word in tokenize(name):
+        terms.add((word, IconSearchTerm.WORD))
+    for tag in (tags or '').split(','):
+        for word in tokenize(tag):
+            terms.add((word, IconSearchTerm.TAG))
+    return terms
+
+
+def index_icon(icon):
+    """
+    Replace the search terms stored for a single icon
+    """
+    with transaction.atomic():
+        IconSearchTerm.objects.filter(icon=icon).delete()
+        IconSearchTerm.objects.bulk_create([
+            IconSearchTerm(icon=icon, term=term[:100], field=field)
+            for term, field in terms_for(icon.name, icon.tags)
+        ])
+
+
+def index_icons(icons):
+    """
+    Replace the search terms for many icons at once, e.g. after bulk
+    writes that bypass Icon.save
+    """
+    icons = list(icons)
+    with transaction.atomic():
+        IconSearchTerm.objects.filter(icon_id__in=[icon.id for icon in icons]).delete()
+        IconSearchTerm.objects.bulk_create([
+            IconSearchTerm(icon_id=icon.id, term=term[:100], field=field)
+            for icon in icons
+            for term, field in terms_for(icon.name, icon.tags)
+        ])
+
+
+def rebuild_index(batch_size=1000):
+    """
+    Rebuild the whole search index from Icon rows, returning the number
+    of terms written
+    """
+    total = 0
+    with transaction.atomic():
+        IconSearchTerm.objects.all().delete()
+        batch = []
+        for icon_id, name, tags in Icon.objects.values_list('id', 'name', 'tags').iterator(chunk_size=batch_size):
+            for term, field in terms_for(name, tags):
+                batch.append(IconSearchTerm(icon_id=icon_id, term=term[:100], field=field))
+            if len(batch) >= batch_size:
+                IconSearchTerm.objects.bulk_create(batch)
+                total += len(batch)
+                batch = []
+        IconSearchTerm.objects.bulk_create(batch)
+        total += len(batch)
+    return total
+
+
+def _prefix(token):
+    return Q(term__gte=token, term__lt=token + PREFIX_SENTINEL)
+
+
+def filter_icons(queryset, query):
+    """
+    Restrict an Icon queryset to icons matching every token of the query,
+    either as a name word prefix or a tag prefix
+    """
+    for token in tokenize(query):
+        matching = IconSearchTerm.objects.filter(_prefix(token)).values('icon_id')
+        queryset = queryset.filter(id__in=matching)
+    return queryset
+
+
+def search_icons(query, limit=DEFAULT_LIMIT):
+    """
+    Return up to ``limit`` icons matching the query, best match first.
+    Each icon carries its rank as ``score``.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+
+    phrase = '-'.join(tokens)
+    match = Q()
+    for token in tokens:
+        match |= _prefix(token)
+
+    ranked = (
+        IconSearchTerm.objects
+        .filter(match, icon_id__in=filter_icons(Icon.objects.all(), query).values('id'))
+        .values('icon_id')
+        .annotate(score=Max(Case(
+            When(field=IconSearchTerm.NAME, term=phrase, then=EXACT_NAME),
+            When(field__in=[IconSearchTerm.NAME, IconSearchTerm.WORD], then=NAME_PREFIX),
+            default=TAG,
+            output_field=IntegerField(),
+        )))
+        .order_by('-score', 'icon_id')[:limit]
+    )
+    scores = {row['icon_id']: row['score'] for row in ranked}
+
+    from .snapshot import get_snapshot
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        icons = snapshot.icons_by_id(scores)
+    else:
+        icons = Icon.objects.select_related('category').in_bulk(list(scores))
+    results = []
+    for icon_id, score in scores.items():
+        icon = icons[icon_id]
+        icon.score = score
+        results.append(icon)
+    return results
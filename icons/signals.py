@@ -0,0 +1,49 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .models import Icon, IconCategory
+from .prerender import schedule_prerender
+from .sprites import invalidate_sprite
+from .utils import delete_icon_from_s3
+from .versioning import bump_version, category_version_key
+
+
+@receiver(post_save, sender=Icon)
+@receiver(post_delete, sender=Icon)
+@receiver(post_save, sender=IconCategory)
+@receiver(post_delete, sender=IconCategory)
+def catalogue_changed(sender, **kwargs):
+    bump_version()
+    schedule_prerender()
+
+
+@receiver(pre_save, sender=Icon)
+def remember_category(sender, instance, **kwargs):
+    # An icon moved to another category changes the grids of both
+    instance._previous_category_id = None
+    if instance.pk:
+        instance._previous_category_id = (
+            Icon.objects.filter(pk=instance.pk).values_list('category_id', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Icon)
+@receiver(post_delete, sender=Icon)
+def icon_changed(sender, instance, **kwargs):
+    invalidate_sprite(instance.category_id)
+    bump_version(category_version_key(instance.category_id))
+    previous = getattr(instance, '_previous_category_id', None)
+    if previous and previous != instance.category_id:
+        invalidate_sprite(previous)
+        bump_version(category_version_key(previous))
+
+
+@receiver(post_delete, sender=Icon)
+def icon_deleted(sender, instance, **kwargs):
+    # Runs for queryset and cascade deletes too, inside their transaction
+    delete_icon_from_s3(instance)
+    instance.invalidate_cached_svg()
+
+
+@receiver(post_save, sender=IconCategory)
+def category_changed(sender, instance, **kwargs):
+    bump_version(category_version_key(instance.id))
@@ -0,0 +1,383 @@
+"""
+Read-only catalogue snapshot shared by every worker through mmap.
+
+The listing and search paths need little more than id, name, category,
+tags and object key per icon, yet used to load them as model instances in every
+worker. The snapshot keeps those fields for the whole catalogue in one
+file: uint32 columns plus a pool of UTF-8 strings, each distinct string
+stored once. Workers map it read-only, so the operating system keeps a
+single copy in the page cache however many workers there are, and rows
+are only decoded into small objects for the icons a request touches.
+
+Layout, all integers in native byte order::
+
+    MAGIC, uint32 header length, JSON header, padding to 8 bytes
+    columns, each 8-byte aligned, as listed in the header
+
+A snapshot is only handed out while its version equals the catalogue
+version of the database it was written from, so a page rendered from it
+is never cached under a newer version; the header names that database,
+since another one sharing the path (a benchmark's test database, a
+staging site) can be at the same version number. When the catalogue moves on, callers fall back to the database
+and one worker writes the new file beside the old and os.replace()s it;
+workers still mapping the old file keep reading it until they let go.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from django.conf import settings
+from django.db import connection, connections
+from .cdn import icon_key, public_url
+from .models import Icon, IconCategory
+from .versioning import get_version
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ICONSNP2'
+ICON_COLUMNS = ('id', 'category', 'name', 'tags', 'key', 'by_id', 'by_name')
+CATEGORY_COLUMNS = ('category_id', 'category_name', 'category_slug', 'category_start')
+
+_regenerations = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+_snapshot = None
+_regenerating = False
+_lock = threading.Lock()
+
+
+class SnapshotCategory:
+    __slots__ = ('id', 'name', 'slug')
+
+    def __init__(self, category_id, name, slug):
+        self.id, self.name, self.slug = category_id, name, slug
+
+    def __str__(self):
+        return self.name
+
+
+class SnapshotIcon:
+    """
+    The fields of an Icon the listing and search paths use, with its
+    category attached as a SnapshotCategory
+    """
+    __slots__ = ('id', 'name', 'tags', 'key', 'category', 'score')
+
+    def __init__(self, icon_id, name, tags, key, category):
+        self.id, self.name, self.tags, self.key, self.category = icon_id, name, tags, key, category
+
+    @property
+    def category_id(self):
+        return self.category.id
+
+    @property
+    def s3_url(self):
+        return self.key
+
+    @property
+    def url(self):
+        # Derived on read, so changing ICON_CDN needs no new snapshot
+        return public_url(self.key)
+
+    def __str__(self):
+        return self.name
+
+
+class CatalogueSnapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a catalogue snapshot")
+        header_length, = struct.unpack_from('I', buffer, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(bytes(buffer[start:start + header_length]))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path} was written on a {header['byteorder']}-endian machine")
+
+        self.version = header['version']
+        self.database = header.get('database')
+        self.size = len(self._mmap)
+        columns = {}
+        for name, (offset, length, typecode) in header['columns'].items():
+            column = buffer[offset:offset + length]
+            columns[name] = column.cast(typecode)
+        self.ids = columns['id']
+        self.category_rows = columns['category']
+        self.names = columns['name']
+        self.tags = columns['tags']
+        self.keys = columns['key']
+        self.by_id = columns['by_id']
+        self.by_name = columns['by_name']
+        self.category_start = columns['category_start']
+        self.string_offsets = columns['string_offsets']
+        self.string_data = columns['string_data']
+        # Small, and needed by nearly every row that is read
+        self.categories = [
+            SnapshotCategory(category_id, self.string(name), self.string(slug))
+            for category_id, name, slug in zip(columns['category_id'], columns['category_name'], columns['category_slug'])
+        ]
+        self.category_index = {category.id: i for i, category in enumerate(self.categories)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def string(self, i):
+        return str(self.string_data[self.string_offsets[i]:self.string_offsets[i + 1]], 'utf-8')
+
+    def icon(self, row):
+        return SnapshotIcon(
+            self.ids[row], self.string(self.names[row]), self.string(self.tags[row]),
+            self.string(self.keys[row]), self.categories[self.category_rows[row]],
+        )
+
+    def row_for_id(self, icon_id):
+        # Rows are stored in id order
+        row = bisect_left(self.ids, icon_id)
+        if row < len(self.ids) and self.ids[row] == icon_id:
+            return row
+        return None
+
+    def icons_by_id(self, icon_ids):
+        """
+        Return ``{id: SnapshotIcon}`` for the ids present in the snapshot
+        """
+        rows = (self.row_for_id(icon_id) for icon_id in icon_ids)
+        return {icon.id: icon for icon in (self.icon(row) for row in rows if row is not None)}
+
+    def category_rows_in(self, order, category_id):
+        i = self.category_index.get(category_id)
+        if i is None:
+            return ()
+        return order[self.category_start[i]:self.category_start[i + 1]]
+
+    def icons(self, category_ids=None, by_name=False, ids=None, limit=None):
+        """
+        Icons in id order, or in (name, id) order within each category
+        with ``by_name``, optionally restricted to some categories and/or
+        a set of icon ids
+        """
+        if category_ids is None:
+            rows = self.by_name if by_name else range(len(self.ids))
+        elif by_name:
+            rows = chain.from_iterable(self.category_rows_in(self.by_name, c) for c in category_ids)
+        else:
+            # Row numbers follow ids, so sorting them restores id order
+            rows = sorted(chain.from_iterable(self.category_rows_in(self.by_id, c) for c in category_ids))
+
+        result = []
+        for row in rows:
+            if ids is not None and self.ids[row] not in ids:
+                continue
+            result.append(self.icon(row))
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+
+def database_identity():
+    """
+    Which database a snapshot was written from: its engine, host, port
+    and name
+    """
+    database = connection.settings_dict
+    return ':'.join(str(database.get(part) or '') for part in ('ENGINE', 'HOST', 'PORT', 'NAME'))
+
+
+def _is_current(snapshot, version):
+    return snapshot is not None and snapshot.version == version and snapshot.database == database_identity()
+
+
+def _aligned(offset):
+    return (offset + 7) & ~7
+
+
+def write_snapshot(path, version):
+    """
+    Write the snapshot of the current catalogue to a temporary file next
+    to ``path`` and move it into place
+    """
+    strings = {}
+    string_offsets, string_data = array('I', [0]), bytearray()
+
+    def intern(value):
+        i = strings.get(value)
+        if i is None:
+            i = strings[value] = len(strings)
+            string_data.extend(value.encode())
+            string_offsets.append(len(string_data))
+        return i
+
+    columns = {name: array('I') for name in ICON_COLUMNS + CATEGORY_COLUMNS}
+    categories = list(IconCategory.objects.order_by('id').values_list('id', 'name', 'slug'))
+    category_rows = {}
+    for i, (category_id, name, slug) in enumerate(categories):
+        category_rows[category_id] = i
+        columns['category_id'].append(category_id)
+        columns['category_name'].append(intern(name))
+        columns['category_slug'].append(intern(slug))
+
+    sort_names = []
+    rows = Icon.objects.order_by('id').values_list('id', 'category_id', 'name', 'tags', 's3_url')
+    for row, (icon_id, category_id, name, tags, s3_url) in enumerate(rows.iterator(chunk_size=5000)):
+        category = category_rows[category_id]
+        columns['id'].append(icon_id)
+        columns['category'].append(category)
+        columns['name'].append(intern(name))
+        columns['tags'].append(intern(tags))
+        columns['key'].append(intern(icon_key(s3_url, categories[category][1], name)))
+        sort_names.append((category, name, icon_id, row))
+
+    # Both orders group rows by category; category_start[i] is where
+    # category i begins in either of them
+    sort_names.sort()
+    columns['by_name'] = array('I', (row for _, _, _, row in sort_names))
+    columns['by_id'] = array('I', sorted(range(len(columns['id'])), key=lambda row: columns['category'][row]))
+    counts = [0] * len(categories)
+    for category in columns['category']:
+        counts[category] += 1
+    start = 0
+    for count in counts:
+        columns['category_start'].append(start)
+        start += count
+    columns['category_start'].append(start)
+    columns['string_offsets'] = string_offsets
+    columns['string_data'] = array('B', string_data)
+
+    # The header lists the column offsets, which start after the header;
+    # grow the space left for it until it fits
+    base = 0
+    while True:
+        layout, offset = {}, base
+        for name, column in columns.items():
+            layout[name] = [offset, len(column) * column.itemsize, column.typecode]
+            offset = _aligned(offset + len(column) * column.itemsize)
+        header = {
+            'version': version, 'database': database_identity(), 'byteorder': sys.byteorder,
+            'icons': len(columns['id']), 'columns': layout,
+        }
+        header_bytes = json.dumps(header).encode()
+        needed = _aligned(len(MAGIC) + 4 + len(header_bytes))
+        if needed <= base:
+            break
+        base = needed
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + struct.pack('I', len(header_bytes)) + header_bytes)
+            for name, column in columns.items():
+                f.write(b'\0' * (layout[name][0] - f.tell()))
+                column.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    logger.info("Wrote catalogue snapshot %s: version %s, %d icons, %d bytes", path, version, len(columns['id']), offset)
+
+
+def open_snapshot(path):
+    try:
+        return CatalogueSnapshot(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Ignoring unreadable catalogue snapshot %s: %s", path, e)
+        return None
+
+
+def regenerate(version=None):
+    """
+    Write the snapshot for the current catalogue unless the file already
+    holds ``version`` of this database. A lock file keeps workers that notice the same
+    change from all writing it; one left behind by a crashed worker is
+    ignored after LOCK_TIMEOUT seconds.
+    """
+    options = settings.ICON_SNAPSHOT
+    path = options['PATH']
+    if version is None:
+        version, _ = get_version()
+    lock = path + '.lock'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock) < options['LOCK_TIMEOUT']:
+                return False
+            os.unlink(lock)
+        except FileNotFoundError:
+            pass
+        return regenerate(version)
+    try:
+        current = open_snapshot(path)
+        if _is_current(current, version):
+            return False
+        write_snapshot(path, version)
+        return True
+    finally:
+        os.close(fd)
+        os.unlink(lock)
+
+
+def _regenerate(version):
+    global _regenerating
+    try:
+        regenerate(version)
+    except Exception:
+        logger.exception("Writing the catalogue snapshot failed")
+    finally:
+        _regenerating = False
+        connections.close_all()
+
+
+def get_snapshot(version=None):
+    """
+    The mapped snapshot if it matches catalogue ``version`` (looked up if
+    not given), else None, in which case the caller reads the database
+    and the snapshot is rewritten in the background. Always None when
+    ICON_SNAPSHOT['ENABLED'] is off.
+    """
+    global _snapshot, _regenerating
+    options = settings.ICON_SNAPSHOT
+    if not options['ENABLED']:
+        return None
+    if version is None:
+        version, _ = get_version()
+    snapshot = _snapshot
+    if _is_current(snapshot, version):
+        return snapshot
+
+    with _lock:
+        if _is_current(_snapshot, version):
+            return _snapshot
+        # Another worker may have written it already
+        try:
+            inode = os.stat(options['PATH']).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode is not None and (_snapshot is None or _snapshot.inode != inode):
+            opened = open_snapshot(options['PATH'])
+            if opened is not None:
+                _snapshot = opened
+        if _is_current(_snapshot, version):
+            return _snapshot
+        if not _regenerating:
+            _regenerating = True
+            _regenerations.submit(_regenerate, version)
+    return None
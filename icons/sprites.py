@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import re
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections, transaction
+from django.urls import reverse
+from .models import CategorySprite, Icon, IconCategory
+from .outbox import spooled_sources
+from .prerender import schedule_prerender
+from .render import SVG_NS
+from .cdn import key_from_url
+from .svg_cache import fetch_svg
+from .versioning import bump_version
+
+logger = logging.getLogger(__name__)
+
+# Root attributes worth carrying over to the <symbol>; they are inherited
+# by the icon's shapes
+INHERITED_ATTRIBUTES = (
+    'fill', 'stroke', 'stroke-width', 'stroke-linecap', 'stroke-linejoin',
+    'stroke-miterlimit', 'fill-rule', 'clip-rule',
+)
+DROPPED_TAGS = {f'{{{SVG_NS}}}{tag}' for tag in ('metadata', 'title', 'desc')}
+LOCAL_REF_RE = re.compile(r'url\(#([^)]+)\)')
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+# Sprite rebuilds triggered by model changes run here, one at a time,
+# outside the request that caused them
+_rebuilds = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sprites')
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _minify(element):
+    for child in list(element):
+        if child.tag in DROPPED_TAGS or not isinstance(child.tag, str):
+            element.remove(child)
+            continue
+        _minify(child)
+    if element.text and not element.text.strip():
+        element.text = None
+    if element.tail and not element.tail.strip():
+        element.tail = None
+
+
+def svg_to_symbol(symbol_id, content):
+    """
+    Turn a standalone SVG document into a minified <symbol>. Internal ids
+    are prefixed with the symbol id so gradients and clip paths from
+    different icons cannot collide.
+    """
+    root = ET.fromstring(content)
+    symbol = ET.Element(f'{{{SVG_NS}}}symbol', {'id': symbol_id})
+    view_box = root.get('viewBox') or f"0 0 {root.get('width', '24')} {root.get('height', '24')}"
+    symbol.set('viewBox', view_box)
+    for attr in INHERITED_ATTRIBUTES:
+        if attr in root.attrib:
+            symbol.set(attr, root.get(attr))
+
+    for child in root:
+        symbol.append(child)
+    _minify(symbol)
+
+    for element in symbol.iter():
+        if element is not symbol and 'id' in element.attrib:
+            element.set('id', f"{symbol_id}-{element.get('id')}")
+        for attr, value in element.attrib.items():
+            if attr in ('href', XLINK_HREF) and value.startswith('#'):
+                element.set(attr, f"#{symbol_id}-{value[1:]}")
+            elif 'url(#' in value:
+                element.set(attr, LOCAL_REF_RE.sub(lambda m: f"url(#{symbol_id}-{m.group(1)})", value))
+    return symbol
+
+
+def read_svg(key, spooled=None):
+    """
+    The SVG stored at ``key``, read from the outbox spool file ``spooled``
+    while its upload is still queued
+    """
+    if spooled:
+        try:
+            with open(spooled, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass  # uploaded since
+    _, content = fetch_svg(key)
+    return content
+
+
+def build_sprite(category):
+    """
+    Fetch every icon of a category and store its sprite, returning the
+    CategorySprite row. Rebuilds run as soon as the icon write commits,
+    usually before the outbox worker has uploaded the new files, so
+    those are read from the spool.
+    """
+    rows = [
+        (icon_id, key_from_url(s3_url))
+        for icon_id, s3_url in Icon.objects.filter(category=category).order_by('id').values_list('id', 's3_url')
+    ]
+    spooled = spooled_sources({key for _, key in rows})
+
+    def symbol_for(row):
+        icon_id, key = row
+        try:
+            return svg_to_symbol(f"icon-{icon_id}", read_svg(key, spooled.get(key)))
+        except Exception as e:
+            logger.error("Skipping icon %s in %s sprite: %s", icon_id, category.name, e)
+            return None
+
+    sprite = ET.Element(f'{{{SVG_NS}}}svg')
+    with ThreadPoolExecutor(max_workers=settings.ICON_BUNDLE['WORKERS']) as pool:
+        for symbol in pool.map(symbol_for, rows):
+            if symbol is not None:
+                sprite.append(symbol)
+
+    content = ET.tostring(sprite, encoding='unicode')
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    sprite_row, _ = CategorySprite.objects.update_or_create(
+        category=category,
+        defaults={'content': content, 'digest': digest, 'icon_count': len(sprite)},
+    )
+    logger.info("Built %s sprite: %d icons, %d bytes", category.name, len(sprite), len(content))
+    return sprite_row
+
+
+def invalidate_sprite(category_id):
+    """
+    Drop a category's sprite so pages fall back to per-icon images, then
+    rebuild it in the background once the current transaction commits
+    """
+    CategorySprite.objects.filter(category_id=category_id).delete()
+    transaction.on_commit(lambda: _schedule_rebuild(category_id))
+
+
+def _schedule_rebuild(category_id):
+    with _pending_lock:
+        if category_id in _pending:
+            return
+        _pending.add(category_id)
+    _rebuilds.submit(_rebuild, category_id)
+
+
+def _rebuild(category_id):
+    with _pending_lock:
+        _pending.discard(category_id)
+    try:
+        category = IconCategory.objects.filter(id=category_id).first()
+        if category is not None:
+            build_sprite(category)
+            # Pages point at the new sprite URL, so their ETag and
+            # Last-Modified have to change with it
+            bump_version()
+            schedule_prerender()
+    except Exception:
+        logger.exception("Sprite rebuild failed for category %s", category_id)
+    finally:
+        connections.close_all()
+
+
+def sprite_url(category_id, digest):
+    return reverse('category_sprite', args=[category_id, digest[:16]])
+
+
+def attach_sprite_urls(categories):
+    """
+    Set ``sprite_url`` on each category: the versioned sprite URL, or None
+    when the sprite has not been built yet
+    """
+    digests = dict(CategorySprite.objects.values_list('category_id', 'digest'))
+    for category in categories:
+        digest = digests.get(category.id)
+        category.sprite_url = sprite_url(category.id, digest) if digest else None
+    return categories
@@ -0,0 +1,402 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from .http import content_etag
+from .ingest import variant_key, variant_keys
+from .s3 import get_s3_client
+
+logger = logging.getLogger(__name__)
+
+MAX_MISSING_KEYS = 10000
+
+
+class LRUByteCache:
+    """
+    Thread-safe in-process LRU holding ``(etag, body, S3 ETag, checked
+    at)`` entries, bounded by the total number of body bytes rather than
+    the number of entries
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, etag, body, s3_etag='', checked_at=None):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (etag, body, s3_etag, time.time() if checked_at is None else checked_at)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted[1])
+                self.evictions += 1
+
+    def touch(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = entry[:3] + (time.time(),)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """
+    Optional on-disk tier; one file per key holding the etag and S3 ETag
+    on the first line followed by the body. The file's mtime is when the
+    entry was last checked against S3.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                # Files written before the S3 ETag was kept have none
+                etag, _, s3_etag = f.readline().rstrip(b'\n').decode().partition(' ')
+                return etag, f.read(), s3_etag, os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, etag, body, s3_etag=''):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(f"{etag} {s3_etag}".rstrip().encode() + b'\n' + body)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            logger.exception("Could not write SVG cache file for %s", key)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def touch(self, key):
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class TieredSVGCache:
+    """
+    SVG payload cache keyed by S3 key: in-process LRU, then an optional
+    shared Django cache (e.g. Redis), then an optional disk directory.
+
+    When the shared tier is enabled it also stores the current ETag of
+    every key. Entries found in the local or disk tiers are only served if
+    their ETag still matches, so an invalidation in one worker is seen by
+    all of them.
+
+    Without it, local and disk entries keep the S3 ETag of the object
+    they were read from and are served for ``revalidate`` seconds after
+    they were last checked. After that get() treats them as misses and
+    the fetch functions below ask S3 for the object with If-None-Match,
+    so an unchanged icon costs a 304 rather than its body, and one
+    changed behind the app's back is picked up.
+    """
+
+    def __init__(self, max_bytes, shared_alias=None, shared_timeout=None, disk_dir=None, miss_ttl=0, revalidate=0):
+        self.local = LRUByteCache(max_bytes)
+        self.shared = caches[shared_alias] if shared_alias else None
+        self.shared_timeout = shared_timeout
+        self.disk = DiskCache(disk_dir) if disk_dir else None
+        self.miss_ttl = miss_ttl
+        self.revalidate = revalidate
+        self._missing = {}
+        self.hits = {'local': 0, 'shared': 0, 'disk': 0}
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        options = settings.ICON_SVG_CACHE
+        return cls(
+            max_bytes=options['MAX_BYTES'],
+            shared_alias=options.get('SHARED_CACHE'),
+            shared_timeout=options.get('SHARED_TIMEOUT'),
+            disk_dir=options.get('DISK_DIR'),
+            miss_ttl=options.get('MISS_TTL', 0),
+            revalidate=options.get('REVALIDATE_SECONDS', 0),
+        )
+
+    def _count(self, tier):
+        with self._lock:
+            if tier is None:
+                self.misses += 1
+            else:
+                self.hits[tier] += 1
+
+    @staticmethod
+    def _etag_key(key):
+        return f'svg:etag:{key}'
+
+    @staticmethod
+    def _body_key(key):
+        return f'svg:body:{key}'
+
+    def _usable(self, entry, expected):
+        if entry is None:
+            return False
+        if self.shared is not None:
+            return entry[0] == expected
+        return not self.revalidate or time.time() - entry[3] < self.revalidate
+
+    def get(self, key):
+        """
+        Return the cached ``(etag, body)`` for an S3 key, or None
+        """
+        expected = None
+        if self.shared is not None:
+            expected = self.shared.get(self._etag_key(key))
+            if expected is None:
+                self._count(None)
+                return None
+
+        entry = self.local.get(key)
+        if self._usable(entry, expected):
+            self._count('local')
+            return entry[:2]
+
+        if self.shared is not None:
+            body = self.shared.get(self._body_key(key))
+            if body is not None:
+                self.local.set(key, expected, body)
+                self._count('shared')
+                return expected, body
+
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if self._usable(entry, expected):
+                self.local.set(key, *entry)
+                self._count('disk')
+                return entry[:2]
+
+        self._count(None)
+        return None
+
+    def get_stale(self, key):
+        """
+        ``(etag, body, S3 ETag)`` of an entry get() no longer serves but
+        S3 can confirm with a 304, or None
+        """
+        if self.shared is not None:
+            return None
+        entry = self.local.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+        if entry is None or not entry[2]:
+            return None
+        return entry[:3]
+
+    def set(self, key, etag, body, s3_etag=''):
+        self.local.set(key, etag, body, s3_etag)
+        if self.shared is not None:
+            self.shared.set_many(
+                {self._etag_key(key): etag, self._body_key(key): body},
+                timeout=self.shared_timeout,
+            )
+        if self.disk is not None:
+            self.disk.set(key, etag, body, s3_etag)
+
+    def revalidated(self, key, stale):
+        """
+        Serve ``stale`` from get_stale() for another ``revalidate``
+        seconds, S3 having answered 304
+        """
+        self.local.set(key, *stale)
+        if self.disk is not None:
+            self.disk.touch(key)
+
+    def is_missing(self, key):
+        """
+        Whether the key was found missing from S3 less than MISS_TTL
+        seconds ago in this process
+        """
+        expires = self._missing.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def mark_missing(self, key):
+        # Kept in process and briefly: the object may be uploaded any time
+        # by the outbox worker, and nothing invalidates blob keys
+        if not self.miss_ttl:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._missing) >= MAX_MISSING_KEYS:
+                self._missing = {k: expires for k, expires in self._missing.items() if expires > now}
+            if len(self._missing) < MAX_MISSING_KEYS:
+                self._missing[key] = now + self.miss_ttl
+
+    def invalidate(self, key):
+        self._missing.pop(key, None)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete_many([self._etag_key(key), self._body_key(key)])
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def stats(self):
+        with self._lock:
+            hits = dict(self.hits)
+            misses = self.misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': self.local.evictions,
+            'entries': len(self.local),
+            'bytes': self.local.size,
+        }
+
+
+_svg_cache = None
+_svg_cache_lock = threading.Lock()
+
+
+def get_svg_cache():
+    """
+    Return the process-wide SVG cache, built from settings on first use
+    """
+    global _svg_cache
+    if _svg_cache is None:
+        with _svg_cache_lock:
+            if _svg_cache is None:
+                _svg_cache = TieredSVGCache.from_settings()
+    return _svg_cache
+
+
+def reset_svg_cache():
+    """
+    Drop the process-wide SVG cache, e.g. after changing settings
+    """
+    global _svg_cache
+    with _svg_cache_lock:
+        _svg_cache = None
+
+
+def conditional_get(svg_cache, key):
+    """
+    ``(stale entry, get_object arguments)`` for reading ``key`` from S3:
+    If-None-Match with the S3 ETag of a cached copy that is due for
+    revalidation, when there is one
+    """
+    stale = svg_cache.get_stale(key)
+    return stale, ({'IfNoneMatch': stale[2]} if stale is not None else {})
+
+
+def is_not_modified(error):
+    # botocore and aiobotocore raise a ClientError for a 304
+    return str(getattr(error, 'response', {}).get('Error', {}).get('Code')) in ('304', 'NotModified')
+
+
+def fetch_svg(key):
+    """
+    Return ``(etag, content)`` for an S3 key, reading through the SVG
+    cache. The ETag is a hash of the content. S3 errors propagate.
+    """
+    svg_cache = get_svg_cache()
+    cached = svg_cache.get(key)
+    if cached is not None:
+        return cached
+
+    stale, conditional = conditional_get(svg_cache, key)
+    try:
+        response = get_s3_client().get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=key, **conditional)
+    except Exception as e:
+        if stale is None or not is_not_modified(e):
+            raise
+        svg_cache.revalidated(key, stale)
+        return stale[:2]
+    content = response['Body'].read()
+    response['Body'].close()
+    etag = content_etag(content)
+    if len(content) <= settings.ICON_SVG_CACHE['MAX_ITEM_BYTES']:
+        svg_cache.set(key, etag, content, response.get('ETag', ''))
+    return etag, content
+
+
+def fetch_variant(key, encoding):
+    """
+    Return ``(etag, content)`` of the precompressed ``encoding`` variant of
+    an S3 key, reading through the SVG cache, or None if the key has no
+    such variant. Misses are remembered for MISS_TTL seconds, so icons
+    stored before ingest cost one S3 miss per worker and TTL rather than
+    one per request, and a variant uploaded later is picked up.
+    """
+    svg_cache = get_svg_cache()
+    cache_key = variant_key(key, encoding)
+    if svg_cache.is_missing(cache_key):
+        return None
+    cached = svg_cache.get(cache_key)
+    # An empty ETag is a miss cached by earlier versions
+    if cached is not None and cached[0]:
+        return cached
+
+    s3_client = get_s3_client()
+    stale, conditional = conditional_get(svg_cache, cache_key)
+    try:
+        response = s3_client.get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=cache_key, **conditional)
+    except s3_client.exceptions.NoSuchKey:
+        svg_cache.mark_missing(cache_key)
+        return None
+    except Exception as e:
+        if stale is None or not is_not_modified(e):
+            raise
+        svg_cache.revalidated(cache_key, stale)
+        return stale[:2]
+    content = response['Body'].read()
+    response['Body'].close()
+    etag = content_etag(content)
+    if len(content) <= settings.ICON_SVG_CACHE['MAX_ITEM_BYTES']:
+        svg_cache.set(cache_key, etag, content, response.get('ETag', ''))
+    return etag, content
+
+
+def invalidate_svg(key):
+    """
+    Drop an S3 key and its compressed variants from the SVG cache
+    """
+    svg_cache = get_svg_cache()
+    for cache_key in [key] + variant_keys(key):
+        svg_cache.invalidate(cache_key)
@@ -0,0 +1,262 @@
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from benchmarks.import_time import loaded_lazy_modules, measure
+from . import autocomplete, metrics, outbox, snapshot
+from .blobs import attach_blobs, release_many
+from .models import Blob, Icon, IconCategory, IconSearchTerm, S3OutboxEntry
+from .search import filter_icons, index_icons
+from .svg_cache import TieredSVGCache
+
+
+def add_icons(categories, count, start=0):
+    Icon.objects.bulk_create(
+        Icon(category=categories[i % len(categories)], name=f"icon-{i}", s3_url=f"icons/{i}.svg")
+        for i in range(start, start + count)
+    )
+
+
+@override_settings(
+    ICON_SNAPSHOT={'ENABLED': False, 'PATH': '', 'LOCK_TIMEOUT': 60},
+    ICON_FRAGMENT_CACHE={'CACHE': 'default', 'TIMEOUT': 60, 'ENABLED': False},
+)
+class HomeQueryCountTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.categories = [IconCategory.objects.create(name=f"category {i}") for i in range(3)]
+
+    def home_queries(self):
+        caches['default'].clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_icons(self):
+        add_icons(self.categories, 5)
+        expected = self.home_queries()
+
+        add_icons(self.categories, 200, start=5)
+        caches['default'].clear()
+        with self.assertNumQueries(expected):
+            response = self.client.get(reverse('home'))
+        self.assertContains(response, 'icon-204')
+
+
+class IndexUsageTests(TestCase):
+    """
+    EXPLAIN the hot catalogue queries and check they are answered from an
+    index, without scanning a table or sorting
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = IconCategory.objects.create(name='Arrows')
+        add_icons([cls.category], 20)
+        index_icons(Icon.objects.all())
+
+    def hot_queries(self):
+        category_id = self.category.id
+        return {
+            'category by slug': IconCategory.objects.filter(slug='arrows'),
+            'icon by category and name': Icon.objects.filter(category_id=category_id, name='icon-1'),
+            'category listing': Icon.objects.filter(category_id=category_id).order_by('name'),
+            'api page': Icon.objects.filter(
+                Q(category_id__gte=category_id),
+                Q(category_id__gt=category_id) | Q(name__gt='icon-1'),
+            ).order_by('category_id', 'name')[:50],
+            'search terms': IconSearchTerm.objects.filter(term__gte='ico', term__lt='ico\uffff').values('icon_id'),
+            'search': filter_icons(Icon.objects.all(), 'icon'),
+        }
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plans')
+    def test_sqlite_plans_use_indexes(self):
+        for name, queryset in self.hot_queries().items():
+            with self.subTest(name):
+                plan = queryset.explain()
+                self.assertRegex(plan, r'USING (COVERING )?INDEX|USING INTEGER PRIMARY KEY')
+                self.assertNotRegex(plan, r'\bSCAN (TABLE )?icons_')
+                self.assertNotIn('TEMP B-TREE', plan)
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL query plans')
+    def test_postgresql_plans_use_indexes(self):
+        # The test tables are tiny, where scanning and sorting them is
+        # cheapest; with those priced out the plan shows whether an index
+        # can serve the query in order
+        with connection.cursor() as cursor:
+            for setting in ('enable_seqscan', 'enable_bitmapscan', 'enable_sort', 'enable_incremental_sort'):
+                cursor.execute(f'SET LOCAL {setting} = off')
+        for name, queryset in self.hot_queries().items():
+            with self.subTest(name):
+                plan = queryset.explain()
+                self.assertIn('Index', plan)
+                self.assertNotIn('Seq Scan', plan)
+                self.assertNotRegex(plan, r'(?m)^\s*(->\s*)?(Incremental )?Sort\b')
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def options(self, **overrides):
+        return {**settings.ICON_METRICS, 'DIR': self.directory.name, **overrides}
+
+    def test_denied_unless_allowed(self):
+        for allowed, status in (([], 403), (['10.0.0.1'], 403), (['127.0.0.1'], 200)):
+            with self.subTest(allowed=allowed), override_settings(ICON_METRICS=self.options(ALLOWED_IPS=allowed)):
+                self.assertEqual(self.client.get(reverse('metrics')).status_code, status)
+
+    def test_sums_workers_and_keeps_counters_of_exited_ones(self):
+        def worker_file(pid, queries, entries):
+            worker = metrics.collect()
+            worker['icons_db_queries_total'][3] = {(('view', 'test'),): queries}
+            worker['icons_svg_cache_entries'][3] = {(): entries}
+            with open(os.path.join(self.directory.name, f"{pid}-test.json"), 'w') as f:
+                json.dump(metrics._dump(worker), f)
+
+        # The parent is alive; pid 2**22 + 1 is beyond Linux's pid_max
+        worker_file(os.getppid(), 5, 7)
+        worker_file(2 ** 22 + 1, 3, 11)
+        merged = metrics.merge(metrics.collect_all(self.directory.name))
+        self.assertEqual(merged['icons_db_queries_total'][3][(('view', 'test'),)], 8)
+        self.assertEqual(merged['icons_svg_cache_entries'][3][()], 7)
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, f"{2 ** 22 + 1}-test.json")))
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, metrics.ARCHIVE_FILE)))
+
+
+class BlobTests(TestCase):
+    def setUp(self):
+        self.category = IconCategory.objects.create(name='Arrows')
+        add_icons([self.category], 40)
+        self.icons = list(Icon.objects.order_by('id'))
+
+    def reimport(self, icons, version):
+        # What load_icons_from_s3 does with a batch of changed objects
+        stored = [(icon, f"{version}{icon.id:063x}", b'<svg/>', {}) for icon in icons]
+        released = attach_blobs(None, None, stored, {digest for _, digest, _, _ in stored})
+        Icon.objects.bulk_update(icons, ['blob', 's3_url'])
+        release_many(released)
+
+    def test_reimport_replaces_blobs(self):
+        self.reimport(self.icons, 1)
+        self.reimport(self.icons, 2)
+        self.assertEqual(Blob.objects.count(), 40)
+        self.assertFalse(Blob.objects.filter(sha256__startswith='1').exists())
+        self.assertEqual(S3OutboxEntry.objects.filter(action=S3OutboxEntry.DELETE).count(), 40 * 3)
+
+    def test_queries_do_not_grow_with_batch(self):
+        self.reimport(self.icons, 1)
+        with CaptureQueriesContext(connection) as few:
+            self.reimport(self.icons[:5], 2)
+        with CaptureQueriesContext(connection) as many:
+            self.reimport(self.icons[5:25], 2)
+        self.assertEqual(len(few), len(many))
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.options = {'ENABLED': True, 'PATH': os.path.join(directory.name, 'catalogue.snap'), 'LOCK_TIMEOUT': 60}
+        add_icons([IconCategory.objects.create(name='Arrows')], 3)
+
+    def test_written_again_for_another_database_at_the_same_version(self):
+        with override_settings(ICON_SNAPSHOT=self.options):
+            self.assertTrue(snapshot.regenerate(7))
+            self.assertFalse(snapshot.regenerate(7))
+            with mock.patch.object(snapshot, 'database_identity', return_value='other'):
+                self.assertFalse(snapshot._is_current(snapshot.open_snapshot(self.options['PATH']), 7))
+                self.assertTrue(snapshot.regenerate(7))
+            self.assertTrue(snapshot.regenerate(7))
+
+
+class SVGCacheTests(TestCase):
+    def test_entries_are_revalidated_without_a_shared_tier(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        svg_cache = TieredSVGCache(1024, disk_dir=directory.name, revalidate=60)
+        svg_cache.set('icons/a/b.svg', '"etag"', b'<svg/>', '"s3"')
+        self.assertEqual(svg_cache.get('icons/a/b.svg'), ('"etag"', b'<svg/>'))
+
+        later = time.time() + 61
+        with mock.patch('icons.svg_cache.time.time', return_value=later):
+            self.assertIsNone(svg_cache.get('icons/a/b.svg'))
+            stale = svg_cache.get_stale('icons/a/b.svg')
+            self.assertEqual(stale, ('"etag"', b'<svg/>', '"s3"'))
+            svg_cache.revalidated('icons/a/b.svg', stale)
+            self.assertEqual(svg_cache.get('icons/a/b.svg'), ('"etag"', b'<svg/>'))
+
+
+class OutboxTests(TestCase):
+    def test_claim_keeps_order_per_key(self):
+        retried = outbox.enqueue_delete('blobs/a.svg')
+        S3OutboxEntry.objects.filter(id=retried.id).update(available_at=timezone.now() + timedelta(minutes=5))
+        upload = S3OutboxEntry.objects.create(action=S3OutboxEntry.UPLOAD, key='blobs/a.svg')
+        other = outbox.enqueue_delete('blobs/b.svg')
+        self.assertEqual([entry.id for entry in outbox.claim(10)], [other.id])
+
+        S3OutboxEntry.objects.filter(id__in=[retried.id, upload.id]).update(available_at=timezone.now())
+        self.assertEqual([entry.id for entry in outbox.claim(10)], [retried.id, upload.id])
+
+
+@override_settings(ICON_SNAPSHOT={'ENABLED': False, 'PATH': '', 'LOCK_TIMEOUT': 60})
+class DownloadCountTests(TestCase):
+    def setUp(self):
+        add_icons([IconCategory.objects.create(name='Arrows')], 3)
+        autocomplete._downloads.clear()
+        self.addCleanup(autocomplete._downloads.clear)
+
+    def test_counts_known_icons_only(self):
+        icon = Icon.objects.first()
+        with self.assertNumQueries(0):
+            autocomplete.record_download(icon.id)
+            autocomplete.record_download(icon.id)
+            autocomplete.record_download(10 ** 9)
+            autocomplete.record_download(10 ** 30)
+        autocomplete.flush_downloads()
+        icon.refresh_from_db()
+        self.assertEqual(icon.downloads, 2)
+        self.assertEqual(sum(Icon.objects.values_list('downloads', flat=True)), 2)
+
+    def test_buffer_is_capped(self):
+        options = {**settings.ICON_AUTOCOMPLETE, 'DOWNLOAD_MAX_IDS': 2, 'DOWNLOAD_FLUSH_INTERVAL': 60}
+        with override_settings(ICON_AUTOCOMPLETE=options):
+            self.assertFalse(autocomplete.record_download(1))
+            self.assertTrue(autocomplete.record_download(2))
+            self.assertTrue(autocomplete.record_download(3))
+        self.assertEqual(set(autocomplete._downloads), {1, 2})
+
+    def test_pages_send_icon_ids(self):
+        icon = Icon.objects.first()
+        self.assertContains(self.client.get(reverse('home')), f'data-icon-id="{icon.id}"')
+        self.assertContains(
+            self.client.get(reverse('category_icons', args=[icon.category.slug])), f'data-icon-id="{icon.id}"',
+        )
+
+
+class ImportTimeTests(TestCase):
+    """
+    Keeps boto3 and the other lazy modules out of startup, so a module-level
+    import fails the suite rather than only the deploy check. The time
+    budget is left to check_import_time, since wall-clock time on a shared
+    CI runner is too noisy to assert on here.
+    """
+
+    def test_lazy_modules_not_imported_at_startup(self):
+        # Runs in a fresh interpreter with the same settings module
+        result = measure(runs=1, cwd=settings.BASE_DIR)
+        eager = loaded_lazy_modules(result['modules'], settings.ICON_STARTUP['LAZY_MODULES'])
+        self.assertNotIn('boto3', eager)
+        self.assertEqual(eager, [])
@@ -1,8 +1,20 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# Under ASGI the S3-bound views run natively async
+s3_views = async_views if settings.ICON_ASYNC_VIEWS else views
 
 urlpatterns = [
     path('', views.home, name='home'),
-    path('download/', views.download_icon, name='download_icon'),
+    path('search/', views.search, name='search'),
+    path('autocomplete/', views.autocomplete, name='autocomplete'),
+    path('api/icons/', views.icon_list_api, name='icon_list_api'),
+    path('catalogue.json', views.catalogue_json, name='catalogue_json'),
+    path('download/', s3_views.download_icon, name='download_icon'),
+    path('download/bundle/', s3_views.download_bundle, name='download_bundle'),
+    path('render/', views.render_icon, name='render_icon'),
+    path('sprites/<int:category_id>-<slug:digest>.svg', views.category_sprite, name='category_sprite'),
     path('icons/<slug:category_slug>/', views.category_icons, name='category_icons'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,28 +1,58 @@
-import os
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 from django.conf import settings
+from .cdn import key_from_url
 
-def upload_icon_to_s3(icon_file, category_name):
+def upload_icon_to_s3(icon_file):
     """
-    Upload an icon file to S3 and return the URL
+    Store an icon file as a content-addressed blob and return
+    ``(key, blob, sizes)``. Icons within ICON_INGEST['MAX_BYTES'] are
+    optimized first and queued with their compressed variants; larger
+    files are spooled to disk in chunks as they are. Nothing is queued
+    when a blob with the same bytes already exists. The field is pointed
+    at the blob key, so the model save neither buffers nor uploads
+    anything inline.
     """
-    # Create a unique filename
-    file_name = f"icons/{category_name}/{icon_file.name}"
-    
-    # Upload to S3
-    path = default_storage.save(file_name, ContentFile(icon_file.read()))
-    
-    # Get the URL
-    url = default_storage.url(path)
-    
-    return url
+    from django.core.files.base import ContentFile
+    from .blobs import acquire, blob_key, content_digest, file_digest
+    from .ingest import ingest_svg, variant_key
+    from .outbox import enqueue_upload
 
-def delete_icon_from_s3(s3_url):
+    if icon_file.size <= settings.ICON_INGEST['MAX_BYTES']:
+        content, variants, sizes = ingest_svg(icon_file.read())
+        blob, created = acquire(content_digest(content), len(content))
+        if created:
+            enqueue_upload(blob.key, ContentFile(content), content_type='image/svg+xml')
+            for encoding, compressed in variants.items():
+                enqueue_upload(
+                    variant_key(blob.key, encoding), ContentFile(compressed),
+                    content_type='image/svg+xml', content_encoding=encoding,
+                )
+    else:
+        blob, created = acquire(file_digest(icon_file), icon_file.size)
+        if created:
+            enqueue_upload(blob.key, icon_file, content_type='image/svg+xml')
+        sizes = {'original_bytes': icon_file.size, 'stored_bytes': icon_file.size}
+    icon_file.name = blob_key(blob.sha256)
+    icon_file._committed = True
+
+    return icon_file.name, blob, sizes
+
+def delete_icon_from_s3(icon):
     """
-    Delete an icon file from S3
+    Release an icon's blob, and queue the deletion of the object it was
+    imported from so the next import does not bring it back. Icons from
+    before content-addressed storage own their object outright.
     """
-    if s3_url:
-        # Extract the key from the URL
-        key = s3_url.replace(f"https://{settings.AWS_S3_CUSTOM_DOMAIN}/", "")
-        default_storage.delete(key) 
\ No newline at end of file
+    from .blobs import release
+    from .ingest import variant_keys
+    from .outbox import enqueue_delete
+
+    if icon.blob_id:
+        release(icon.blob_id)
+        keys = [icon.source_key] if icon.source_key else []
+    elif icon.s3_url:
+        keys = [key_from_url(icon.s3_url)]
+    else:
+        keys = []
+    for key in keys:
+        for k in [key] + variant_keys(key):
+            enqueue_delete(k)
@@ -0,0 +1,55 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import CatalogueVersion
+
+CATALOGUE = 'catalogue'
+
+
+def category_version_key(category_id):
+    return f'category:{category_id}'
+
+
+def bump_version(key=CATALOGUE):
+    """
+    Atomically increment a version stamp, creating it on first use
+    """
+    updated = CatalogueVersion.objects.filter(key=key).update(
+        version=F('version') + 1, updated_at=timezone.now()
+    )
+    if not updated:
+        try:
+            with transaction.atomic():
+                CatalogueVersion.objects.create(key=key, version=1)
+        except IntegrityError:
+            # Another writer created it first
+            bump_version(key)
+
+
+def get_version(key=CATALOGUE):
+    """
+    Return ``(version, updated_at)`` for a stamp, ``(0, None)`` if it was
+    never bumped
+    """
+    row = CatalogueVersion.objects.filter(key=key).values_list('version', 'updated_at').first()
+    return row or (0, None)
+
+
+def get_versions(keys):
+    """
+    Return ``{key: version}`` for several stamps in one query; stamps that
+    were never bumped are 0
+    """
+    versions = dict.fromkeys(keys, 0)
+    versions.update(CatalogueVersion.objects.filter(key__in=versions).values_list('key', 'version'))
+    return versions
+
+
+def get_request_version(request, key=CATALOGUE):
+    """
+    Like get_version, but looked up at most once per request
+    """
+    versions = request.__dict__.setdefault('_catalogue_versions', {})
+    if key not in versions:
+        versions[key] = get_version(key)
+    return versions[key]
@@ -1,127 +1,380 @@
-from django.shortcuts import render,get_object_or_404
-from .models import Icon, IconCategory
+from django.shortcuts import render,get_object_or_404, redirect
+from .models import CategorySprite, Icon, IconCategory
+from .catalogue import API_FIELDS, DEFAULT_API_FIELDS, catalogue_document, encode_cursor, get_categories, get_icon_page, get_icons
+from .search import filter_icons, search_icons, DEFAULT_LIMIT, MAX_LIMIT
+from .bundle import iter_bundle
+from .sprites import sprite_url
 from django.conf import settings
 import logging
-import requests
-from django.http import HttpResponse
-from django.views.decorators.http import require_GET
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import condition, require_GET
 from urllib.parse import unquote
-import boto3
+from .cdn import key_from_url
+from .s3 import get_s3_client, stream_body
+from .svg_cache import conditional_get, fetch_svg, fetch_variant, get_svg_cache, is_not_modified
+from .render import FORMATS, RenderBusy, RenderError, parse_render_spec, render_variant, spec_digest
+from .http import cache_policy, content_etag, page_etag, page_last_modified, vary_on_encoding
+from .fragments import cached_fragment, render_category_grids
+from .autocomplete import flush_downloads, record_download, suggest
+from .blobs import is_blob_key
+from .delivery import delivery_response
+from .ingest import accepted_encodings
+from .versioning import category_version_key, get_request_version
+from .metrics import render_metrics
 
 logger = logging.getLogger(__name__)
 
+@cache_policy('page')
+@condition(etag_func=page_etag, last_modified_func=page_last_modified)
 def home(request):
     query = request.GET.get("q", "")
-    categories = IconCategory.objects.all()
-    icons = Icon.objects.all()
-    
-    if query:
-        icons = icons.filter(name__icontains=query) | icons.filter(tags__icontains=query)
-    
-    # Debug logging
-    for icon in icons:
-        logger.debug(f"Icon: {icon.name}, Category: {icon.category.name}, S3 URL: {icon.s3_url}")
-        if not icon.s3_url.startswith('https://'):
-            icon.s3_url = f"https://{settings.AWS_S3_CUSTOM_DOMAIN}/icons/{icon.category.name}/{icon.name}.svg"
-            logger.debug(f"Updated S3 URL: {icon.s3_url}")
+    categories = get_categories()
+    icons = render_category_grids(categories, query)
+    version, _ = get_request_version(request)
     
     context = {
         "icons": icons,
         "categories": categories,
+        "sidebar": cached_fragment('home-sidebar', [version], 'icons/_home_sidebar.html', lambda: {'categories': categories}),
         "debug": settings.DEBUG  # Add debug setting to context
     }
     
     # Debug logging for context
-    logger.debug(f"Number of icons: {icons.count()}")
-    logger.debug(f"Number of categories: {categories.count()}")
+    logger.debug("Number of icons rendered: %d", len(icons))
+    logger.debug("Number of categories: %d", len(categories))
     
     return render(request, "icons/home.html", context)
 
 @require_GET
+def search(request):
+    query = request.GET.get("q", "")
+    try:
+        limit = min(int(request.GET.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({"error": "limit must be an integer"}, status=400)
+    
+    results = [
+        {
+            "id": icon.id,
+            "name": icon.name,
+            "category": icon.category.name,
+            "url": icon.url,
+            "score": icon.score,
+        }
+        for icon in search_icons(query, limit=max(limit, 0))
+    ]
+    return JsonResponse({"query": query, "results": results})
+
+@require_GET
+def autocomplete(request):
+    query = request.GET.get("q", "")
+    try:
+        limit = int(request.GET.get("limit", settings.ICON_AUTOCOMPLETE['LIMIT']))
+    except ValueError:
+        return JsonResponse({"error": "limit must be an integer"}, status=400)
+    
+    icons, categories = suggest(query, limit=max(limit, 0))
+    return JsonResponse(
+        {"query": query, "icons": icons, "categories": categories}, json_dumps_params={'separators': (',', ':')}
+    )
+
+@require_GET
+def icon_list_api(request):
+    fields = [f for f in request.GET.get('fields', '').split(',') if f] or DEFAULT_API_FIELDS
+    unknown = set(fields) - set(API_FIELDS)
+    if unknown:
+        return JsonResponse({"error": f"Unknown fields: {', '.join(sorted(unknown))}"}, status=400)
+    
+    try:
+        limit = min(int(request.GET.get('limit', settings.ICON_API_PAGE_SIZE)), settings.ICON_API_MAX_PAGE_SIZE)
+        category_id = int(request.GET['category']) if request.GET.get('category') else None
+        icons, next_cursor = get_icon_page(
+            cursor=request.GET.get('cursor'),
+            limit=max(limit, 1),
+            category_id=category_id,
+            query=request.GET.get('q', ''),
+            fields=fields,
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    
+    return JsonResponse({"icons": icons, "next": next_cursor}, json_dumps_params={'separators': (',', ':')})
+
+@require_GET
+@cache_policy('page')
+@condition(etag_func=page_etag, last_modified_func=page_last_modified)
+def catalogue_json(request):
+    return JsonResponse(catalogue_document(), json_dumps_params={'separators': (',', ':')})
+
+def counted_download(request):
+    """
+    Count a download of the icon whose id the download buttons send in
+    the ``icon`` parameter; True when the buffered counts are due to be
+    flushed
+    """
+    icon_id = request.GET.get('icon', '')
+    return icon_id.isdigit() and record_download(int(icon_id))
+
+def cached_response(request, cached, name, encoding=None):
+    """
+    Serve the icon from the SVG cache's ``(etag, content)``, a
+    precompressed variant when ``encoding`` is given, or a 304
+    """
+    etag, content = cached
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    http_response = HttpResponse(content, content_type='image/svg+xml')
+    if encoding:
+        http_response['Content-Encoding'] = encoding
+    http_response['ETag'] = etag
+    http_response['Content-Disposition'] = f'attachment; filename="{name}.svg"'
+    return http_response
+
+
+@require_GET
+@cache_policy('svg')
+@vary_on_encoding
 def download_icon(request):
     url = unquote(request.GET.get('url', ''))
     name = unquote(request.GET.get('name', 'icon'))
     
-    logger.debug(f"Download request received:")
-    logger.debug(f"Raw URL parameter: {request.GET.get('url', '')}")
-    logger.debug(f"Decoded URL: {url}")
-    logger.debug(f"Raw name parameter: {request.GET.get('name', '')}")
-    logger.debug(f"Decoded name: {name}")
+    logger.debug("Download request received: url=%s name=%s", url, name)
     
     if not url:
         return HttpResponse('No URL provided', status=400)
+    if counted_download(request):
+        flush_downloads()
     
-    try:
-        # Initialize S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME
-        )
-        
-        # Extract bucket and key from URL
-        bucket = settings.AWS_STORAGE_BUCKET_NAME
-        
-        # Extract the key from the URL
-        # URL format: https://bundled-icons-dev.s3.amazonaws.com/icons/actions/save.svg
-        # We want to get: icons/actions/save.svg
-        key = url.split('.com/')[-1]
-        
-        logger.debug(f"Attempting to download from S3:")
-        logger.debug(f"Bucket: {bucket}")
-        logger.debug(f"Key: {key}")
-        logger.debug(f"Full URL: {url}")
-        
+    s3_client = get_s3_client()
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    
+    key = key_from_url(url)
+    if is_blob_key(key):
+        # Content-addressed, so the URL changes whenever the bytes do
+        request.cache_policy = 'blob'
+    delivered = delivery_response(key, f"{name}.svg")
+    if delivered is not None:
+        return delivered
+    
+    for encoding in accepted_encodings(request.headers.get('Accept-Encoding', '')):
         try:
-            # Get the object from S3
-            response = s3_client.get_object(Bucket=bucket, Key=key)
-            content = response['Body'].read()
-            
-            # Create the response with the SVG content
-            http_response = HttpResponse(
-                content,
-                content_type='image/svg+xml'
-            )
-            
-            # Set the Content-Disposition header to trigger download
-            http_response['Content-Disposition'] = f'attachment; filename="{name}.svg"'
-            
-            return http_response
-            
-        except s3_client.exceptions.NoSuchKey:
-            logger.error(f"File not found in S3: {key}")
-            return HttpResponse(f'File not found in S3: {key}', status=404)
+            variant = fetch_variant(key, encoding)
         except Exception as e:
-            logger.error(f"Error getting object from S3: {str(e)}")
-            return HttpResponse(f'Error getting file from S3: {str(e)}', status=500)
-            
+            # Fall back to the next encoding, then the uncompressed object
+            logger.error("Error getting %s variant from S3: %s", encoding, e)
+            continue
+        if variant is not None:
+            return cached_response(request, variant, name, encoding)
+    
+    svg_cache = get_svg_cache()
+    
+    cached = svg_cache.get(key)
+    if cached is not None:
+        return cached_response(request, cached, name)
+    
+    logger.debug("Attempting to download from S3: bucket=%s key=%s", bucket, key)
+    
+    stale, conditional = conditional_get(svg_cache, key)
+    try:
+        # Get the object from S3; the body is streamed, not buffered
+        response = s3_client.get_object(Bucket=bucket, Key=key, **conditional)
+    except s3_client.exceptions.NoSuchKey:
+        logger.error("File not found in S3: %s", key)
+        return HttpResponse(f'File not found in S3: {key}', status=404)
+    except Exception as e:
+        if stale is not None and is_not_modified(e):
+            svg_cache.revalidated(key, stale)
+            return cached_response(request, stale[:2], name)
+        logger.error("Error getting object from S3: %s", e)
+        return HttpResponse(f'Error getting file from S3: {str(e)}', status=500)
+    
+    last_modified = response['LastModified'].timestamp() if response.get('LastModified') else None
+    
+    if response['ContentLength'] <= settings.ICON_SVG_CACHE['MAX_ITEM_BYTES']:
+        # Small icons are read whole so they can be cached under a content hash
+        content = response['Body'].read()
+        response['Body'].close()
+        etag = content_etag(content)
+        svg_cache.set(key, etag, content, response.get('ETag', ''))
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+        http_response = HttpResponse(content, content_type='image/svg+xml')
+    else:
+        etag = response.get('ETag')
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            response['Body'].close()
+            return not_modified
+        http_response = StreamingHttpResponse(
+            stream_body(response['Body']),
+            content_type='image/svg+xml'
+        )
+        http_response['Content-Length'] = response['ContentLength']
+    if etag:
+        http_response['ETag'] = etag
+    if last_modified:
+        http_response['Last-Modified'] = http_date(last_modified)
+    
+    # Set the Content-Disposition header to trigger download
+    http_response['Content-Disposition'] = f'attachment; filename="{name}.svg"'
+    
+    return http_response
+    
+def bundle_request(request):
+    """
+    Parse a bundle request into ``(icon rows, render spec, archive name)``,
+    or return the error response to send instead
+    """
+    category_name = request.GET.get('category', '')
+    query = request.GET.get('q', '')
+    ids = [i for value in request.GET.getlist('ids') for i in value.split(',') if i]
+    
+    if not (category_name or query or ids):
+        return HttpResponse('Provide a category, a search query or icon ids', status=400)
+    
+    try:
+        ids = [int(i) for i in ids]
+        spec = None
+        if any(request.GET.get(param) for param in ('color', 'size', 'background', 'format')):
+            spec = parse_render_spec(request.GET)
+    except ValueError:
+        return HttpResponse('ids must be icon ids', status=400)
+    except RenderError as e:
+        return HttpResponse(str(e), status=e.status)
+    
+    icons = Icon.objects.order_by('category__name', 'name')
+    if category_name:
+        category = get_object_or_404(IconCategory, slug=category_name)
+        icons = icons.filter(category=category)
+    if query:
+        icons = filter_icons(icons, query)
+    if ids:
+        icons = icons.filter(id__in=ids)
+    icons = icons[:settings.ICON_BUNDLE['MAX_ICONS']].values_list('id', 'name', 'category__name', 's3_url')
+    
+    logger.debug("Bundle request: category=%s q=%s ids=%d spec=%s", category_name, query, len(ids), spec)
+    return icons, spec, category_name or 'icons'
+
+@require_GET
+def download_bundle(request):
+    parsed = bundle_request(request)
+    if isinstance(parsed, HttpResponse):
+        return parsed
+    icons, spec, filename = parsed
+    
+    http_response = StreamingHttpResponse(iter_bundle(icons.iterator(), spec), content_type='application/zip')
+    http_response['Content-Disposition'] = f'attachment; filename="{filename}.zip"'
+    return http_response
+
+@require_GET
+@cache_policy('svg')
+def render_icon(request):
+    try:
+        spec = parse_render_spec(request.GET)
+        icon_id = int(request.GET.get('icon', ''))
+    except ValueError:
+        return HttpResponse('icon must be an icon id', status=400)
+    except RenderError as e:
+        return HttpResponse(str(e), status=e.status)
+    
+    icon = get_object_or_404(Icon, pk=icon_id)
+    key = key_from_url(icon.s3_url)
+    
+    try:
+        source_etag, content = fetch_svg(key)
+    except get_s3_client().exceptions.NoSuchKey:
+        logger.error("File not found in S3: %s", key)
+        return HttpResponse(f'File not found in S3: {key}', status=404)
     except Exception as e:
-        logger.error(f"Error in download_icon: {str(e)}")
-        return HttpResponse(f'Error downloading file: {str(e)}', status=500)
+        logger.error("Error getting object from S3: %s", e)
+        return HttpResponse(f'Error getting file from S3: {str(e)}', status=500)
+    
+    # The variant ETag is known before rendering, so revalidations are free
+    etag = '"%s"' % spec_digest(source_etag, spec)[:32]
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
     
+    try:
+        rendered = render_variant(source_etag, content, spec)
+    except RenderError as e:
+        http_response = HttpResponse(str(e), status=e.status)
+        if isinstance(e, RenderBusy):
+            http_response['Retry-After'] = '1'
+        return http_response
+    
+    http_response = HttpResponse(rendered, content_type=FORMATS[spec['format']])
+    http_response['ETag'] = etag
+    if request.GET.get('download'):
+        if record_download(icon.id):
+            flush_downloads()
+        suffix = f"-{spec['size']}" if spec['size'] else ''
+        http_response['Content-Disposition'] = f'attachment; filename="{icon.name}{suffix}.{spec["format"]}"'
+    return http_response
+    
+@require_GET
+@cache_policy('sprite')
+def category_sprite(request, category_id, digest):
+    sprite = get_object_or_404(CategorySprite, category_id=category_id)
+    if not sprite.digest.startswith(digest):
+        # An older version was requested; point at the current one
+        return redirect(sprite_url(category_id, sprite.digest))
+    
+    etag = '"%s"' % sprite.digest[:32]
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    
+    http_response = HttpResponse(sprite.content, content_type='image/svg+xml')
+    http_response['ETag'] = etag
+    return http_response
+
+@cache_policy('page')
+@condition(etag_func=page_etag, last_modified_func=page_last_modified)
 def category_icons(request, category_slug):
-    categories = IconCategory.objects.all()
-    category = get_object_or_404(IconCategory, name=category_slug.replace('-', ' '))
-    icons = Icon.objects.filter(category=category)
-    
-    # Debug logging
-    for icon in icons:
-        logger.debug(f"Icon: {icon.name}, Category: {icon.category.name}, S3 URL: {icon.s3_url}")
-        # Ensure consistent URL construction
-        if not icon.s3_url.startswith('https://'):
-            icon.s3_url = f"https://{settings.AWS_S3_CUSTOM_DOMAIN}/icons/{icon.category.name}/{icon.name}.svg"
-            logger.debug(f"Updated S3 URL: {icon.s3_url}")
+    categories = get_categories()
+    category = get_object_or_404(IconCategory, slug=category_slug)
+    category.sprite_url = next((c.sprite_url for c in categories if c.id == category.id), None)
     
-    # Debug logging for context
-    logger.debug(f"Number of icons in category {category.name}: {icons.count()}")
-    logger.debug(f"Number of categories: {categories.count()}")
+    version, _ = get_request_version(request)
+    category_version, _ = get_request_version(request, category_version_key(category.id))
+    
+    def icon_list_context():
+        # Render the first screenful in keyset order; the page lazy-loads
+        # the rest from the JSON API starting at next_cursor
+        page_size = settings.ICON_API_PAGE_SIZE
+        icons = get_icons(category=category, order_by=('name',), limit=page_size + 1)
+        next_cursor = None
+        if len(icons) > page_size:
+            icons = icons[:page_size]
+            next_cursor = encode_cursor(category.id, icons[-1].name, icons[-1].id)
+        logger.debug("Number of icons in category %s: %d", category.name, len(icons))
+        return {'category': category, 'icons': icons, 'next_cursor': next_cursor, 'debug': settings.DEBUG}
+    
+    logger.debug("Number of categories: %d", len(categories))
     
     context = {
         'category': category,
-        'icons': icons,
+        'icon_list': cached_fragment(
+            'category-list', [category.id, category_version, category.sprite_url or ''],
+            'icons/_category_list.html', icon_list_context,
+        ),
+        'sidebar': cached_fragment(
+            'category-sidebar', [version, category.id],
+            'icons/_category_sidebar.html', lambda: {'categories': categories, 'category': category},
+        ),
         'categories': categories,
         'debug': settings.DEBUG  # Add debug setting to context
     }
     
-    return render(request, 'icons/category_icons.html', context)
\ No newline at end of file
+    return render(request, 'icons/category_icons.html', context)
+
+@require_GET
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in settings.ICON_METRICS['ALLOWED_IPS']:
+        return HttpResponse('Forbidden', status=403)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
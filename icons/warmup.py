@@ -0,0 +1,127 @@
+"""
+Cache warm-up for freshly started workers, run by ``manage.py warm_caches``
+and by the gunicorn hook in gunicorn.conf.py.
+
+A new worker would otherwise spend its first requests importing the views,
+mapping the catalogue snapshot, building the autocomplete index, fetching
+SVGs from S3 and compiling templates, which is what makes cold-start p99
+worse than steady state. Each step here does one of those ahead of time
+and is timed on its own; a failing step is logged and skipped, so a worker
+that cannot warm up still starts.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver, reverse
+from .autocomplete import get_index
+from .cdn import icon_key
+from .models import Icon
+from .prerender import render_page
+from .snapshot import get_snapshot, regenerate
+from .svg_cache import fetch_svg, fetch_variant
+from .versioning import get_version
+
+logger = logging.getLogger(__name__)
+
+STEPS = ('urls', 'snapshot', 'autocomplete', 'svg', 'pages')
+
+
+def warm_urls():
+    # Resolving the URLconf imports the views and everything behind them
+    return len(get_resolver().url_patterns)
+
+
+def warm_snapshot():
+    """
+    Map the catalogue snapshot, writing it first if it is missing or stale
+    and no other worker is already doing so
+    """
+    if not settings.ICON_SNAPSHOT['ENABLED']:
+        return 0
+    version, _ = get_version()
+    regenerate(version)
+    snapshot = get_snapshot(version)
+    return len(snapshot) if snapshot is not None else 0
+
+
+def warm_autocomplete():
+    return len(get_index())
+
+
+def hot_keys(limit):
+    """
+    The object keys of the ``limit`` most downloaded icons
+    """
+    rows = Icon.objects.order_by('-downloads', 'id').values_list('s3_url', 'category__name', 'name')[:limit]
+    return [icon_key(s3_url, category_name, name) for s3_url, category_name, name in rows]
+
+
+def _fetch(key):
+    try:
+        fetch_svg(key)
+        for encoding in settings.ICON_INGEST['ENCODINGS']:
+            fetch_variant(key, encoding)
+        return True
+    except Exception as e:
+        logger.debug("Could not warm %s: %s", key, e)
+        return False
+    finally:
+        connections.close_all()
+
+
+def warm_svg(limit=None):
+    """
+    Read the most downloaded icons and their compressed variants through
+    the SVG cache
+    """
+    options = settings.ICON_STARTUP
+    limit = options['WARM_SVG_ICONS'] if limit is None else limit
+    keys = hot_keys(limit) if limit > 0 else []
+    if not keys:
+        return 0
+    with ThreadPoolExecutor(max_workers=options['WARM_SVG_WORKERS'], thread_name_prefix='warmup') as pool:
+        warmed = sum(pool.map(_fetch, keys))
+    if warmed < len(keys):
+        logger.warning("Could only read %d of the %d most downloaded icons into the SVG cache", warmed, len(keys))
+    return warmed
+
+
+def warm_pages():
+    """
+    Render the WARM_PAGES views, compiling their templates and filling
+    the fragment cache
+    """
+    pages = settings.ICON_STARTUP['WARM_PAGES']
+    for name in pages:
+        render_page(reverse(name))
+    return len(pages)
+
+
+def warm_caches(steps=STEPS, svg_limit=None, progress=None):
+    """
+    Run the warm-up ``steps`` in order and return ``{step: (count,
+    seconds)}``, with count None for steps that failed. ``progress`` is
+    called after every step, e.g. to keep a gunicorn worker's heartbeat
+    going.
+    """
+    actions = {
+        'urls': warm_urls,
+        'snapshot': warm_snapshot,
+        'autocomplete': warm_autocomplete,
+        'svg': lambda: warm_svg(svg_limit),
+        'pages': warm_pages,
+    }
+    results = {}
+    for step in steps:
+        started = time.perf_counter()
+        try:
+            count = actions[step]()
+        except Exception:
+            logger.exception("Warming up %s failed", step)
+            count = None
+        results[step] = (count, time.perf_counter() - started)
+        if progress is not None:
+            progress()
+    return results